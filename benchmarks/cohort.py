@@ -0,0 +1,234 @@
+import argparse
+import gzip
+import os
+import numpy as np
+import pandas as pd
+from src.allium_prepro.reference_preprocessor import default_ref_dir
+from src.allium_prepro.subtype_thesaurus import SubtypeThesaurus
+
+REF_GENOME = 'Homo_sapiens.GRCh38.103'
+
+# Rows htseq-count style files end with, dropped by GexConcatenator
+_META_ROWS = ['__no_feature', '__ambiguous', '__too_low_aQual',
+              '__not_aligned', '__alignment_not_unique']
+
+# Samples generated at a time, so memory stays flat at any scale
+_BLOCK_SIZE = 256
+
+
+class SyntheticCohort():
+    # A made-up cohort shaped like the MPM ones: per-sample count files,
+    # count matrices with symbol and Ensembl gene ids, batches and a
+    # St. Jude style SAMPLE_INFO table, plus a GTF to build a reference from
+    def __init__(self,
+                 output_dir,
+                 n_samples,
+                 n_genes=None,
+                 n_batches=3,
+                 seed=0):
+        self._n_samples = n_samples
+        self._n_genes = n_genes
+        self._n_batches = n_batches
+        self._seed = seed
+
+        # Each scale and seed gets its own directory, generated once
+        name = f'n{n_samples}_g{n_genes or "all"}_b{n_batches}_s{seed}'
+        self.output_dir = os.path.join(output_dir, name)
+        self.feature_counts_dir = os.path.join(self.output_dir,
+                                               'feature_counts')
+        self.symbol_counts_path = os.path.join(
+            self.output_dir, 'bench.symbol.counts.raw.csv')
+        self.ensembl_counts_path = os.path.join(
+            self.output_dir, 'bench.ensembl.counts.raw.csv')
+        self.batches_path = os.path.join(self.output_dir,
+                                         'bench.batches.csv')
+        self.sample_info_path = os.path.join(self.output_dir,
+                                             'SAMPLE_INFO.txt')
+        self.gtf_path = os.path.join(self.output_dir, 'bench.gtf.gz')
+        self._done_path = os.path.join(self.output_dir, '.done')
+
+    def n_samples(self):
+        return self._n_samples
+
+    def generate(self):
+        if os.path.exists(self._done_path):
+            print(f'Using synthetic cohort in {self.output_dir}')
+            return self
+
+        print(f'Generating synthetic cohort of {self._n_samples} samples '
+              f'in {self.output_dir}...')
+        os.makedirs(self.feature_counts_dir, exist_ok=True)
+        rng = np.random.default_rng(self._seed)
+        genes = self._genes(rng)
+        samples = [f'SJ{i:06d}' for i in range(1, self._n_samples + 1)]
+        batch = rng.integers(self._n_batches, size=self._n_samples)
+
+        counts = self._write_counts(rng, genes, samples, batch)
+        self._write_matrices(genes, samples, counts)
+        self._write_batches(samples, batch)
+        self._write_sample_info(rng, samples, batch)
+        self._write_gtf(genes)
+        del counts
+        os.remove(os.path.join(self.output_dir, 'counts.int32'))
+
+        open(self._done_path, 'w').close()
+        return self
+
+    def _genes(self, rng):
+        # Genes of the bundled reference, including non-coding ones, which
+        # GexPreprocessor drops
+        genes = pd.read_csv(os.path.join(
+            default_ref_dir(), f'{REF_GENOME}.allium.annotations.full.csv'))
+        if self._n_genes and self._n_genes < len(genes):
+            genes = genes.iloc[np.sort(rng.choice(len(genes),
+                                                  self._n_genes,
+                                                  replace=False))]
+        genes = genes.reset_index(drop=True)
+
+        # Symbols as count files have them: ids for unnamed genes, and a few
+        # in lowercase for the symbol standardization to fix
+        symbols = genes['name'].fillna(genes['id'])
+        lower = rng.random(len(genes)) < 0.01
+        symbols[lower] = symbols[lower].str.lower()
+        genes['symbol'] = symbols
+
+        # Plus genes that are in no reference
+        unknown = pd.DataFrame({
+            'id': [f'ENSG9{i:010d}' for i in range(20)],
+            'symbol': [f'NOVEL{i}' for i in range(20)]})
+        return pd.concat([genes, unknown], ignore_index=True)
+
+    def _write_counts(self, rng, genes, samples, batch):
+        # Negative binomial counts, with gene means spanning orders of
+        # magnitude, and library size and batch effects per sample
+        n_genes = len(genes)
+        mean = rng.lognormal(1, 2.5, n_genes).clip(max=1e5)
+        size = 1 / rng.uniform(0.05, 0.5, n_genes)
+        batch_effect = rng.lognormal(0, 0.2, (n_genes, self._n_batches))
+
+        # Kept on disk, as the matrices are written one gene block at a time
+        counts = np.memmap(os.path.join(self.output_dir, 'counts.int32'),
+                           dtype=np.int32, mode='w+',
+                           shape=(n_genes, len(samples)))
+        symbols = genes['symbol'].tolist() + _META_ROWS
+        for start in range(0, len(samples), _BLOCK_SIZE):
+            block = slice(start, start + _BLOCK_SIZE)
+            library = rng.lognormal(0, 0.3, len(samples[block]))
+            mu = mean[:, None] * library[None, :] * \
+                batch_effect[:, batch[block]]
+            values = rng.negative_binomial(size[:, None],
+                                           size[:, None] /
+                                           (size[:, None] + mu))
+            counts[:, block] = values
+
+            # One two column file per sample, like the St. Jude ones
+            meta = rng.integers(1e5, 1e6, (len(_META_ROWS), values.shape[1]))
+            values = np.vstack([values, meta])
+            for i, sample in enumerate(samples[block]):
+                path = os.path.join(self.feature_counts_dir,
+                                    f'{sample}.counts.txt')
+                with open(path, 'w') as f:
+                    f.write('\n'.join(f'{symbol}\t{count}' for symbol, count
+                                      in zip(symbols, values[:, i].tolist())))
+                    f.write('\n')
+        counts.flush()
+        return counts
+
+    def _write_matrices(self, genes, samples, counts):
+        for path, index in [(self.symbol_counts_path, genes['symbol']),
+                            (self.ensembl_counts_path, genes['id'])]:
+            index = index.values
+            with open(path, 'w') as f:
+                step = max(1, 2 * 10**7 // len(samples))
+                for start in range(0, len(genes), step):
+                    block = pd.DataFrame(counts[start:start + step],
+                                         index=index[start:start + step],
+                                         columns=samples)
+                    block.to_csv(f, header=start == 0)
+
+    def _write_batches(self, samples, batch):
+        batches = pd.DataFrame({'batch': [f'batch{b}' for b in batch]},
+                               index=pd.Index(samples, name='id'))
+        batches.to_csv(self.batches_path)
+
+    def _write_sample_info(self, rng, samples, batch):
+        # Subtypes as they are spelled in the wild, some unknown or missing
+        vocabulary = list(SubtypeThesaurus.shared().thesaurus().keys())
+        vocabulary += ['Unknown fusion', 'KMT2A-like', '']
+        primary = rng.choice(vocabulary, len(samples))
+        secondary = np.where(rng.random(len(samples)) < 0.2,
+                             rng.choice(vocabulary, len(samples)), '')
+        unsure = rng.random(len(samples)) < 0.05
+        primary = np.char.add(primary.astype(str),
+                              np.where(unsure, '?', ''))
+        lineage = np.where(rng.random(len(samples)) < 0.1, 'T', 'B')
+        diagnosis = [f'Lineage:{lin},Primary_subtype:{p}' +
+                     (f',Secondary_subtype:{s}' if s else '')
+                     for lin, p, s in zip(lineage, primary, secondary)]
+
+        info = pd.DataFrame({
+            'sample_name': samples,
+            'attr_diagnosis': diagnosis,
+            'attr_library_selection_protocol': [f'batch{b}' for b in batch],
+            'attr_sequencing_platform': rng.choice(['HiSeq', 'NovaSeq'],
+                                                   len(samples)),
+            'attr_lab_strandedness': rng.choice(['stranded', 'unstranded'],
+                                                len(samples))})
+
+        # AML cases, which the parser drops
+        n_aml = max(1, len(samples) // 20)
+        aml = pd.DataFrame({
+            'sample_name': [f'SJAML{i:06d}' for i in range(1, n_aml + 1)],
+            'attr_diagnosis': 'AML',
+            'attr_library_selection_protocol': 'batch0',
+            'attr_sequencing_platform': 'HiSeq',
+            'attr_lab_strandedness': 'stranded'})
+        pd.concat([info, aml]).to_csv(self.sample_info_path, sep='\t',
+                                      index=False)
+
+    def _write_gtf(self, genes):
+        # A gene, a transcript and two overlapping exons per reference gene,
+        # whose union is the gene's length in the reference
+        genes = genes.dropna(subset=['chr'])
+        with gzip.open(self.gtf_path, 'wt') as f:
+            f.write('#!genome-build synthetic\n')
+            position = {}
+            for gene in genes.itertuples():
+                length = int(gene.length)
+                start = position.get(gene.chr, 1000)
+                end = start + length - 1
+                position[gene.chr] = end + 1000
+
+                name = f' gene_name "{gene.name}";' \
+                    if isinstance(gene.name, str) else ''
+                attributes = f'gene_id "{gene.id}";{name} ' \
+                    f'gene_biotype "{gene.biotype}";'
+                transcript = f'{attributes} transcript_id "{gene.id}.1";'
+                f.write(f'{gene.chr}\tsynthetic\tgene\t{start}\t{end}\t.\t+'
+                        f'\t.\t{attributes}\n')
+                f.write(f'{gene.chr}\tsynthetic\ttranscript\t{start}\t{end}'
+                        f'\t.\t+\t.\t{transcript}\n')
+                split = start + length // 2
+                for exon_start, exon_end in [(start, min(split + 5, end)),
+                                             (max(split - 5, start), end)]:
+                    f.write(f'{gene.chr}\tsynthetic\texon\t{exon_start}\t'
+                            f'{exon_end}\t.\t+\t.\t{transcript}\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Generate synthetic cohorts for the benchmarks')
+    parser.add_argument('--samples', type=int, nargs='+', default=[100])
+    parser.add_argument('--genes', type=int,
+                        help='subsample the reference genes')
+    parser.add_argument('--batches', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output-dir', default='/tmp/allium_benchmarks')
+    args = parser.parse_args(argv)
+    for n_samples in args.samples:
+        SyntheticCohort(args.output_dir, n_samples, args.genes,
+                        args.batches, args.seed).generate()
+
+
+if __name__ == '__main__':
+    main()
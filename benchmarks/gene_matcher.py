@@ -0,0 +1,58 @@
+import argparse
+import os
+import time
+import numpy as np
+import pandas as pd
+from src.allium_prepro.gene_matcher import GeneMatcher
+from src.allium_prepro.reference_preprocessor import default_ref_dir
+
+REF_GENOME = 'Homo_sapiens.GRCh38.103'
+
+
+def _genes(ref, n_genes, rng):
+    # Count matrix style genes: mostly reference ids, some symbols only,
+    # some unknown, and symbols with gaps
+    ids = np.concatenate([ref['id'].values,
+                          ref['name'].dropna().values,
+                          [f'ENSG9{i:010d}' for i in range(1000)]])
+    symbols = np.concatenate([ref['name'].values,
+                              ['NOVEL', np.nan]]).astype(object)
+    return (rng.choice(ids, n_genes).astype(object),
+            rng.choice(symbols, n_genes))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark matching genes against the reference')
+    parser.add_argument('--genes', type=int, nargs='+',
+                        default=[20000, 60000, 200000])
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per size, of which the fastest counts')
+    args = parser.parse_args(argv)
+
+    ref = pd.read_csv(os.path.join(
+        default_ref_dir(), f'{REF_GENOME}.allium.annotations.filtered.csv'))
+    matcher = GeneMatcher(ref['id'].tolist(), ref['name'].tolist())
+    rng = np.random.default_rng(0)
+
+    # The vectorized match against the per gene lookup it replaces
+    print('Genes     match     per gene  Speedup')
+    for n_genes in args.genes:
+        gene_ids, symbols = _genes(ref, n_genes, rng)
+        timings = []
+        for run in [lambda: matcher.match(gene_ids, symbols),
+                    lambda: [matcher.find_ref_key(gene_id, symbol)
+                             for gene_id, symbol in zip(gene_ids, symbols)]]:
+            best = None
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                run()
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            timings.append(best)
+        print(f'{n_genes:<9} {timings[0]:<9.3f} {timings[1]:<9.3f} '
+              f'{timings[1] / timings[0]:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
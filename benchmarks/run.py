@@ -0,0 +1,180 @@
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from benchmarks.cohort import SyntheticCohort
+from benchmarks.stages import STAGES, run_stage
+
+HISTORY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'history.json')
+
+# Stages that don't depend on the number of samples run once per benchmark
+_PER_REFERENCE_STAGES = ['reference']
+
+# Changes smaller than this are noise, whatever their ratio
+_MIN_CHANGE_S = 0.25
+
+
+def _git(*args):
+    try:
+        return subprocess.run(['git', *args], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _environment():
+    # What a result depends on besides the code
+    return {'commit': _git('rev-parse', 'HEAD'),
+            'dirty': bool(_git('status', '--porcelain', '--',
+                               'src', 'benchmarks')),
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'host': platform.node(),
+            'cpus': os.cpu_count(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__}
+
+
+class BenchmarkRunner():
+    # Runs each stage on synthetic cohorts of each scale, each stage in a
+    # fresh process, and appends the results to a JSON history
+    def __init__(self,
+                 samples=(100, 1000),
+                 stages=None,
+                 n_genes=None,
+                 work_dir='/tmp/allium_benchmarks',
+                 history_file=HISTORY_FILE,
+                 repeat=1,
+                 batch_corrector='r',
+                 memory_budget=512 * 1024**2,
+                 tolerance=0.1):
+        self._samples = samples
+        self._stages = stages or list(STAGES)
+        unknown = [stage for stage in self._stages if stage not in STAGES]
+        if unknown:
+            raise ValueError(f'Unknown stages: {", ".join(unknown)}. '
+                             f'Stages are {", ".join(STAGES)}')
+        self._n_genes = n_genes
+        self._work_dir = work_dir
+        self._history_file = history_file
+        self._repeat = repeat
+        self._tolerance = tolerance
+        self._options = {'tmp_dir': os.path.join(work_dir, 'tmp'),
+                         'batch_corrector': batch_corrector,
+                         'memory_budget': memory_budget}
+        os.makedirs(self._options['tmp_dir'], exist_ok=True)
+
+    def run(self):
+        results = []
+        for i, n_samples in enumerate(self._samples):
+            cohort = SyntheticCohort(os.path.join(self._work_dir, 'cohorts'),
+                                     n_samples, self._n_genes).generate()
+            for stage in self._stages:
+                if stage in _PER_REFERENCE_STAGES and i > 0:
+                    continue
+                results.append(self._run_stage(stage, cohort))
+
+        entry = dict(_environment(), results=results)
+        history = self._load_history()
+        self._compare(entry, history)
+        history.append(entry)
+        with open(self._history_file, 'w') as f:
+            json.dump(history, f, indent=1)
+        print(f'Appended results to {self._history_file}')
+        return entry
+
+    def _run_stage(self, stage, cohort):
+        print(f'Benchmarking {stage} on {cohort.n_samples()} samples...')
+        output_dir = os.path.join(self._work_dir, 'output',
+                                  os.path.basename(cohort.output_dir), stage)
+
+        # Best of the repeats, as the others measure noise
+        best = None
+        for _ in range(self._repeat):
+            with ProcessPoolExecutor(
+                    max_workers=1,
+                    mp_context=multiprocessing.get_context('spawn')) \
+                    as executor:
+                result = executor.submit(run_stage, stage, cohort,
+                                         output_dir, self._options).result()
+            if best is None or result['wall_s'] < best['wall_s']:
+                best = result
+
+        samples = None if stage in _PER_REFERENCE_STAGES \
+            else cohort.n_samples()
+        return dict({'stage': stage,
+                     'samples': samples,
+                     'genes': self._n_genes}, **best)
+
+    def _load_history(self):
+        if not os.path.exists(self._history_file):
+            return []
+        with open(self._history_file, 'r') as f:
+            return json.load(f)
+
+    def _compare(self, entry, history):
+        # Against the latest result of another commit on this host
+        print('Stage               Samples   Time      Peak RSS  Change')
+        for result in entry['results']:
+            previous = None
+            for old in reversed(history):
+                if old['commit'] == entry['commit'] or \
+                        old['host'] != entry['host']:
+                    continue
+                previous = next((r for r in old['results'] if
+                                 (r['stage'], r['samples'], r['genes']) ==
+                                 (result['stage'], result['samples'],
+                                  result['genes'])), None)
+                if previous:
+                    break
+
+            change = ''
+            if previous:
+                ratio = result['wall_s'] / max(previous['wall_s'], 1e-9)
+                change = f'{ratio - 1:+.0%}'
+                if ratio > 1 + self._tolerance and \
+                        result['wall_s'] - previous['wall_s'] > _MIN_CHANGE_S:
+                    change += ' slower'
+            samples = result['samples'] or '-'
+            print(f'{result["stage"]:<19} {samples:<9} '
+                  f'{result["wall_s"]:<9.2f} '
+                  f'{result["peak_rss_bytes"] / 1024**2:<9.0f} {change}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark every stage on synthetic cohorts')
+    parser.add_argument('--samples', type=int, nargs='+',
+                        default=[100, 1000])
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES))
+    parser.add_argument('--genes', type=int,
+                        help='subsample the reference genes')
+    parser.add_argument('--work-dir', default='/tmp/allium_benchmarks')
+    parser.add_argument('--history', default=HISTORY_FILE)
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='runs per stage, of which the fastest counts')
+    parser.add_argument('--batch-corrector', choices=['r', 'python'],
+                        default='r')
+    parser.add_argument('--memory-budget-mb', type=int, default=512,
+                        help='memory_budget of the chunked stage')
+    args = parser.parse_args(argv)
+
+    BenchmarkRunner(samples=args.samples,
+                    stages=args.stages,
+                    n_genes=args.genes,
+                    work_dir=args.work_dir,
+                    history_file=args.history,
+                    repeat=args.repeat,
+                    batch_corrector=args.batch_corrector,
+                    memory_budget=args.memory_budget_mb * 1024**2).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+import json
+import os
+
+# Each stage imports only what it runs, so a stage's peak RSS doesn't
+# include the libraries of the others, such as umap's numba
+
+
+def _sample_name_extractor(x):
+    return x.split('.')[0]
+
+
+def reference(cohort, output_dir, options):
+    from src.allium_prepro.reference_preprocessor import \
+        ReferencePreprocessor
+    ReferencePreprocessor(genome_version='bench',
+                          gtf_file=cohort.gtf_path,
+                          ref_dir=output_dir,
+                          tmp_dir=options['tmp_dir'],
+                          profile=True).run()
+    return 'bench.reference_preprocessor'
+
+
+def concatenate(cohort, output_dir, options):
+    from src.allium_prepro.gex_concatenator import GexConcatenator
+    GexConcatenator('bench',
+                    cohort.feature_counts_dir,
+                    output_dir,
+                    _sample_name_extractor,
+                    profile=True).concatenate()
+    return 'bench.gex_concatenator'
+
+
+def phenotype(cohort, output_dir, options):
+    from src.allium_prepro.jude_phenotype_parser import JudePhenotypeParser
+    JudePhenotypeParser('bench',
+                        cohort.sample_info_path,
+                        output_dir,
+                        profile=True).parse()
+    return 'bench.jude_phenotype_parser'
+
+
+def preprocess_symbol(cohort, output_dir, options):
+    from src.allium_prepro.gex_preprocessor import GexPreprocessor
+    GexPreprocessor(prefix='bench',
+                    input_file=cohort.symbol_counts_path,
+                    output_dir=output_dir,
+                    gene_format='symbol',
+                    sample_col_regex='^SJ.*',
+                    tmp_dir=options['tmp_dir'],
+                    profile=True).run()
+    return 'bench.gex_preprocessor'
+
+
+def preprocess_ensembl(cohort, output_dir, options):
+    from src.allium_prepro.gex_preprocessor import GexPreprocessor
+
+    # With batch correction, which the symbol run leaves out
+    GexPreprocessor(prefix='bench',
+                    input_file=cohort.ensembl_counts_path,
+                    output_dir=output_dir,
+                    gene_format='ensembl',
+                    sample_col_regex='^SJ.*',
+                    batches_file=cohort.batches_path,
+                    batch_corrector=options['batch_corrector'],
+                    tmp_dir=options['tmp_dir'],
+                    profile=True).run()
+    return 'bench.gex_preprocessor'
+
+
+def preprocess_chunked(cohort, output_dir, options):
+    from src.allium_prepro.gex_preprocessor import GexPreprocessor
+    GexPreprocessor(prefix='bench',
+                    input_file=cohort.symbol_counts_path,
+                    output_dir=output_dir,
+                    gene_format='symbol',
+                    sample_col_regex='^SJ.*',
+                    tmp_dir=options['tmp_dir'],
+                    memory_budget=options['memory_budget'],
+                    profile=True).run()
+    return 'bench.gex_preprocessor'
+
+
+def umap(cohort, output_dir, options):
+    from src.allium_prepro.batch_umap import BatchUmap
+    BatchUmap(prefix='bench',
+              counts_file=cohort.symbol_counts_path,
+              output_dir=output_dir,
+              do_transform=True,
+              batches_file=cohort.batches_path,
+              profile=True).run()
+    return 'bench.batch_umap'
+
+
+def umap_pca(cohort, output_dir, options):
+    from src.allium_prepro.batch_umap import BatchUmap
+
+    # Neighbors searched in 50 PCs rather than every gene
+    BatchUmap(prefix='bench',
+              counts_file=cohort.symbol_counts_path,
+              output_dir=output_dir,
+              do_transform=True,
+              batches_file=cohort.batches_path,
+              n_pcs=50,
+              profile=True).run()
+    return 'bench.batch_umap'
+
+
+# Benchmarked stages, in the order they run
+STAGES = {'reference': reference,
+          'concatenate': concatenate,
+          'phenotype': phenotype,
+          'preprocess_symbol': preprocess_symbol,
+          'preprocess_ensembl': preprocess_ensembl,
+          'preprocess_chunked': preprocess_chunked,
+          'umap': umap,
+          'umap_pca': umap_pca}
+
+
+def run_stage(name, cohort, output_dir, options):
+    # Runs in a fresh process, so peak RSS is the stage's own
+    os.makedirs(output_dir, exist_ok=True)
+    profile_name = STAGES[name](cohort, output_dir, options)
+    with open(os.path.join(output_dir,
+                           f'{profile_name}.profile.json'), 'r') as f:
+        records = json.load(f)['stages']
+
+    # The outermost record covers the whole stage, and the inner ones add
+    # up per name
+    result = {key: records[0][key] for key in
+              ['wall_s', 'cpu_s', 'peak_rss_bytes', 'read_bytes',
+               'write_bytes'] if key in records[0]}
+    result['stages'] = {}
+    for record in records[1:]:
+        result['stages'][record['name']] = \
+            result['stages'].get(record['name'], 0) + record['wall_s']
+    return result
@@ -1,4 +1,9 @@
-from lib.reference_preprocessor import ReferencePreprocessor
+from src.allium_prepro.reference_preprocessor import ReferencePreprocessor
+from src.allium_prepro.reference_builder import ReferenceBuilder
 
 r = ReferencePreprocessor()
 r.run()
+
+# Several Ensembl releases and/or local GTF files can be built concurrently
+# b = ReferenceBuilder([103, 110, '/path/to/custom.gtf.gz'])
+# b.run()
@@ -1,11 +1,10 @@
-
+import sys
 import pandas as pd
 import os
 from src.allium_prepro.subtype_thesaurus import SubtypeThesaurus
-from src.allium_prepro.gex_preprocessor import GexPreprocessor
+from mpm_experiments.run_all import main
 
 dataset_name = 'diedrich'
-print(f"Processing {dataset_name}...")
 path_to_raw_data = '/home/mariya/Data/for_allium/raw/diedrich'
 pheno_input_file = f'{path_to_raw_data}/SupplementaryInfo.xlsx'
 counts_input_file = \
@@ -16,41 +15,40 @@ output_dir = '/home/mariya/Data/for_allium/allium'
 pheno_output_file = f'{output_dir}/diedrich.pheno.allium.csv'
 counts_output_file = f'{output_dir}/diedrich.counts.raw.csv'
 
-# PROCESS PHENO ########
-print("Processing phenotype data...")
-# Load the data
-data = pd.read_excel(pheno_input_file,
-                     sheet_name='Supplemental Table 1',
-                     header=2,
-                     index_col='Sample SJ ID')
-
-# Keep only index and subtype cols
-data = data.iloc[:, :1]
-
-# Rename columns
-data = data.rename(columns={'Subtype_name': 'subtype'})
-data.index.name = 'id'
-
-# In subtype column, strip out everything after the underscore
-data['subtype'] = data['subtype'].str.split('_').str[0]
-
-# Get subtype translation
-st = SubtypeThesaurus()
-data['subtype'] = st.translate_subtype_column(data['subtype'])
-
-# Dump to output file
-data.to_csv(pheno_output_file, sep=';')
-
-# PROCESS COUNTS ########
-# We just need to change the separator from tab to comma and remove index name
-data = pd.read_csv(counts_input_file, index_col=0, sep='\t')
-data.index.name = None
-data.to_csv(counts_output_file)
-
-# GENE NAME STANDARDIZATION, COUNT NORMALIZATION, ALLIUM FORMATTING #
-p = GexPreprocessor(prefix='diedrich',
-                    input_file=counts_output_file,
-                    output_dir=output_dir,
-                    gene_format='symbol',
-                    sample_col_regex='^SJ.*')
-p.run()
+
+def prepare():
+    print(f"Processing {dataset_name}...")
+    # PROCESS PHENO ########
+    print("Processing phenotype data...")
+    # Load the data
+    data = pd.read_excel(pheno_input_file,
+                         sheet_name='Supplemental Table 1',
+                         header=2,
+                         index_col='Sample SJ ID')
+
+    # Keep only index and subtype cols
+    data = data.iloc[:, :1]
+
+    # Rename columns
+    data = data.rename(columns={'Subtype_name': 'subtype'})
+    data.index.name = 'id'
+
+    # In subtype column, strip out everything after the underscore
+    data['subtype'] = data['subtype'].str.split('_').str[0]
+
+    # Get subtype translation
+    st = SubtypeThesaurus.shared()
+    data['subtype'] = st.translate_subtype_column(data['subtype'])
+
+    # Dump to output file
+    data.to_csv(pheno_output_file, sep=';')
+
+    # PROCESS COUNTS ########
+    # We just need to change the separator from tab to comma and remove index name
+    data = pd.read_csv(counts_input_file, index_col=0, sep='\t')
+    data.index.name = None
+    data.to_csv(counts_output_file)
+
+
+if __name__ == '__main__':
+    main(['diedrich'] + sys.argv[1:])
@@ -1,10 +1,10 @@
+import sys
 import pandas as pd
 import os
 from src.allium_prepro.subtype_thesaurus import SubtypeThesaurus
-from src.allium_prepro.gex_preprocessor import GexPreprocessor
+from mpm_experiments.run_all import main
 
 dataset_name = 'krali'
-print(f"Processing {dataset_name}...")
 path_to_raw_data = '/home/mariya/Data/for_allium/raw/krali'
 meta_input_file = f'{path_to_raw_data}/41698_2023_479_MOESM2_ESM.xlsx'
 counts_input_file = \
@@ -16,65 +16,63 @@ pheno_output_file = f'{output_dir}/krali.pheno.allium.csv'
 batches_output_file = f'{output_dir}/krali.batches.allium.csv'
 counts_output_file = f'{output_dir}/krali.counts.raw.csv'
 
-# PROCESS METADATA ########
-print("Processing metadata...")
 
-# Load the data
-data = pd.read_excel(meta_input_file,
-                     sheet_name='Supplementary Data 2',
-                     header=1,
-                     index_col='public_id')
+def prepare():
+    print(f"Processing {dataset_name}...")
+    # PROCESS METADATA ########
+    print("Processing metadata...")
 
-# This column has a newline character that makes it tricky
-subtype_col_name = data.columns[1]
+    # Load the data
+    data = pd.read_excel(meta_input_file,
+                         sheet_name='Supplementary Data 2',
+                         header=1,
+                         index_col='public_id')
 
-data = data[[subtype_col_name,
-             'GEX dataset',
-             'library'
-             ]]
+    # This column has a newline character that makes it tricky
+    subtype_col_name = data.columns[1]
 
-# Rename cols
-data = data.rename(columns={subtype_col_name: 'subtype',
-                            'GEX dataset': 'partition',
-                            'library': 'batch'})
-# Rename index
-data.index.name = 'id'
+    data = data[[subtype_col_name,
+                 'GEX dataset',
+                 'library'
+                 ]]
 
-# Extract only hold out data and b-others
-data = data[(data['partition'] == 'held-out') | (data['partition'] == 'B-other')]
+    # Rename cols
+    data = data.rename(columns={subtype_col_name: 'subtype',
+                                'GEX dataset': 'partition',
+                                'library': 'batch'})
+    # Rename index
+    data.index.name = 'id'
 
-# Extract batches info into a separate file
-batches = data[['batch']]
-batches.to_csv(batches_output_file, sep=',')
+    # Extract only hold out data and b-others
+    data = data[(data['partition'] == 'held-out') | (data['partition'] == 'B-other')]
 
-print("Processing phenotype data...")
-# Just keep subtype column
-data = data[['subtype']]
+    # Extract batches info into a separate file
+    batches = data[['batch']]
+    batches.to_csv(batches_output_file, sep=',')
 
-# Get subtype translation
-st = SubtypeThesaurus()
-data['subtype'] = st.translate_subtype_column(data['subtype'])
+    print("Processing phenotype data...")
+    # Just keep subtype column
+    data = data[['subtype']]
 
-# Dump to output file
-data.to_csv(pheno_output_file, sep=';')
+    # Get subtype translation
+    st = SubtypeThesaurus.shared()
+    data['subtype'] = st.translate_subtype_column(data['subtype'])
 
-# Save subtypes data
-subtypes = data
+    # Dump to output file
+    data.to_csv(pheno_output_file, sep=';')
 
-# FILTER FOR ONLY HOLDOUT DATA AND PROCESS COUNTS ########
-# Load the data
-data = pd.read_csv(counts_input_file, index_col=0, sep='\t')
+    # Save subtypes data
+    subtypes = data
 
-# Only keep the columns that correlate to an id in subtypes
-data = data[data.columns.intersection(subtypes.index)]
+    # FILTER FOR ONLY HOLDOUT DATA AND PROCESS COUNTS ########
+    # Load the data
+    data = pd.read_csv(counts_input_file, index_col=0, sep='\t')
 
-data.to_csv(counts_output_file)
+    # Only keep the columns that correlate to an id in subtypes
+    data = data[data.columns.intersection(subtypes.index)]
 
-# GENE NAME STANDARDIZATION, COUNT NORMALIZATION, ALLIUM FORMATTING #
-p = GexPreprocessor(prefix='krali',
-                    input_file=counts_output_file,
-                    output_dir=output_dir,
-                    gene_format='ensembl',
-                    sample_col_regex='^ALL.*',
-                    batches_file=batches_output_file)
-p.run()
+    data.to_csv(counts_output_file)
+
+
+if __name__ == '__main__':
+    main(['krali'] + sys.argv[1:])
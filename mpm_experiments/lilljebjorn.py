@@ -32,7 +32,7 @@ data.index.name = 'id'
 data.index = data.index.map(lambda x: f'Case_{x:03d}')
 
 # Get subtype translation
-st = SubtypeThesaurus()
+st = SubtypeThesaurus.shared()
 subtypes_dict = st.thesaurus()
 data['subtype'] = st.translate_subtype_column(data['subtype'])
 
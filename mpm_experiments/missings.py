@@ -1,21 +1,25 @@
-
 import pandas as pd
+from src.allium_prepro.signature_coverage import IMPORTANCE_COL, \
+    SignatureCoverage, read_missing_genes
 
 datasets = ['diedrich', 'heinaniemi', 'jude', 'krali', 'lilljebjorn', 'tran']
+data_dir = '/home/mariya/Data/allium'
+signature_file = '/home/mariya/Development/allium/data/signatures/signature_genes_v3.csv'
 
-for DATASET_PREFIX in datasets:
-    print("Processing ", DATASET_PREFIX)
-    # Load the data
-    data = pd.read_csv(f"/home/mariya/Data/allium/{DATASET_PREFIX}.missing_genes.csv", index_col=0)
-    sigs = pd.read_csv("/home/mariya/Development/allium/data/signatures/signature_genes_v3.csv", index_col=0)
-
-    ids = set(sigs['Gene ID']) & set(data.index)
+if __name__ == '__main__':
+    coverage = SignatureCoverage(signature_file)
+    missing = {dataset: read_missing_genes(
+        f'{data_dir}/{dataset}.missing_genes.csv') for dataset in datasets}
 
-    print("Missing genes in signatures:")
-    # Print all rows in sigs where the Gene ID is in ids
-    cols = ['Gene ID', 'feature_importance_mean']
+    # All datasets at once
+    genes, summary = coverage.summarize(missing)
+    genes.to_csv(f'{data_dir}/signature_coverage.genes.csv')
+    summary.to_csv(f'{data_dir}/signature_coverage.datasets.csv')
 
-    # Drop all colums in sigs except cols
-    sigs = sigs[cols]
-    print(sigs[sigs['Gene ID'].isin(ids)])
-    print('\n\n\n')
+    with pd.option_context('display.max_rows', None,
+                           'display.width', 200):
+        print(summary)
+        print('\nMissing genes in signatures:')
+        print(genes)
+    print(f'\nWrote summary to {data_dir}/signature_coverage.*.csv, '
+          f'genes ranked by {IMPORTANCE_COL}')
@@ -0,0 +1,38 @@
+import argparse
+import os
+from src.allium_prepro.batch_runner import BatchRunner
+from src.allium_prepro.gex_preprocessor import STAGES
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'datasets.yml')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Preprocess the MPM datasets in parallel')
+    parser.add_argument('datasets', nargs='*',
+                        help='datasets to run, all in the config by default')
+    parser.add_argument('--config', default=CONFIG_FILE)
+    parser.add_argument('--workers', type=int,
+                        help='datasets run at once, overrides the config')
+    parser.add_argument('--max-memory-gb', type=float,
+                        help='memory the running datasets may take together')
+    parser.add_argument('--force-stage', choices=STAGES,
+                        help='recompute this stage and the ones after it')
+    parser.add_argument('--skip-prepare', action='store_true',
+                        help='reuse the raw counts and phenotype files')
+    args = parser.parse_args(argv)
+
+    max_memory = None
+    if args.max_memory_gb:
+        max_memory = args.max_memory_gb * 1024**3
+    runner = BatchRunner(args.config,
+                         n_workers=args.workers,
+                         max_memory=max_memory,
+                         force_stage=args.force_stage,
+                         prepare=not args.skip_prepare)
+    runner.run(args.datasets)
+
+
+if __name__ == '__main__':
+    main()
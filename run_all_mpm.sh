@@ -1,5 +1 @@
-python -m mpm_experiments.diedrich
-python -m mpm_experiments.heinaniemi
-python -m mpm_experiments.jude
-python -m mpm_experiments.krali
-python -m mpm_experiments.tran
+python -m mpm_experiments.run_all "$@"
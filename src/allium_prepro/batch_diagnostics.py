@@ -0,0 +1,183 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+import matplotlib
+import matplotlib.pyplot as plt
+from sklearn.decomposition import PCA
+from sklearn.metrics import silhouette_score
+from sklearn.neighbors import NearestNeighbors
+from sklearn.preprocessing import StandardScaler
+from .sparse_counts import SparseCounts
+
+# Components shown in the scree plot
+_SCREE_PCS = 10
+
+
+class BatchDiagnostics():
+    # How strongly samples group by batch in each matrix added, e.g. before
+    # and after batch correction. Each matrix is scaled and decomposed once,
+    # and the explained variance, UMAP and batch mixing metrics are all
+    # computed from its principal components:
+    # - silhouette of the batches, near 0 or below when batches mix
+    # - kBET style entropy of the batches among each sample's neighbors,
+    #   relative to the entropy of the batch sizes, near 1 when batches mix
+    # - R² of each PC on batch, near 0 when no PC follows the batches
+    def __init__(self,
+                 prefix,
+                 output_dir,
+                 batches,
+                 n_pcs=50,
+                 n_neighbors=15,
+                 do_umap=True,
+                 random_state=42):
+        self._prefix = prefix
+        self._output_dir = output_dir
+        self._batches = batches.dropna()
+        self._n_pcs = n_pcs
+        self._n_neighbors = n_neighbors
+        self._do_umap = do_umap
+        self._random_state = random_state
+        self._results = {}
+        self._embeddings = {}
+
+    def add(self, name, data, cached=False):
+        # data has genes in rows and samples in columns, like the matrices
+        # of GexPreprocessor, and is only read. cached records whether it
+        # was read from the stage cache rather than computed in this run
+        print(f'Computing batch diagnostics of {name} data...')
+        if isinstance(data, SparseCounts):
+            data = data.to_frame()
+        samples = data.columns.intersection(self._batches.index, sort=False)
+        if len(samples) < 3:
+            raise ValueError(f'Fewer than 3 samples of the {name} data '
+                             'have a batch')
+        batch = self._batches.reindex(samples).astype(str).values
+
+        # The shared decomposition, of samples by genes. Genes that are
+        # constant across samples carry no information
+        x = data[samples].values.T.astype(np.float64)
+        x = x[:, x.std(axis=0) > 0]
+        x = StandardScaler().fit_transform(x)
+        n_pcs = min(self._n_pcs, *x.shape)
+        pca = PCA(n_components=n_pcs,
+                  svd_solver='randomized',
+                  random_state=self._random_state)
+        pcs = pca.fit_transform(x)
+        del x
+
+        result = {
+            'cached': cached,
+            'samples': len(samples),
+            'genes': int(data.shape[0]),
+            'explained_variance_ratio':
+                pca.explained_variance_ratio_.tolist()}
+        result.update(self._mixing(pcs, batch, pca.explained_variance_))
+        self._results[name] = result
+
+        if self._do_umap:
+            import umap.umap_ as umap
+            reducer = umap.UMAP(n_neighbors=self._n_neighbors,
+                                min_dist=0.1,
+                                n_components=2,
+                                random_state=self._random_state)
+            self._embeddings[name] = (reducer.fit_transform(pcs), batch)
+        return result
+
+    def _mixing(self, pcs, batch, variance):
+        levels, codes = np.unique(batch, return_inverse=True)
+        if len(levels) < 2:
+            return {'silhouette_batch': None,
+                    'neighbor_batch_entropy': None,
+                    'pc_batch_r2': None,
+                    'pc_batch_r2_weighted': None}
+
+        # Batch composition of each sample's neighbors, itself excluded
+        k = min(self._n_neighbors, len(batch) - 1)
+        neighbors = NearestNeighbors(n_neighbors=k + 1).fit(pcs) \
+            .kneighbors(pcs, return_distance=False)[:, 1:]
+        counts = np.zeros((len(batch), len(levels)))
+        np.add.at(counts, (np.arange(len(batch))[:, None],
+                           codes[neighbors]), 1)
+        entropy = self._entropy(counts / k)
+
+        # Against the entropy of a perfectly mixed neighborhood
+        sizes = np.bincount(codes) / len(codes)
+        expected = self._entropy(sizes[None, :])[0]
+
+        # Between batch share of each PC's variance
+        means = np.zeros((len(levels), pcs.shape[1]))
+        np.add.at(means, codes, pcs)
+        means /= np.bincount(codes)[:, None]
+        total = ((pcs - pcs.mean(axis=0)) ** 2).sum(axis=0)
+        between = ((means[codes] - pcs.mean(axis=0)) ** 2).sum(axis=0)
+        r2 = between / np.where(total > 0, total, 1)
+
+        return {'silhouette_batch': float(silhouette_score(pcs, codes)),
+                'neighbor_batch_entropy': float(entropy.mean() / expected),
+                'pc_batch_r2': r2.tolist(),
+                'pc_batch_r2_weighted':
+                    float((r2 * variance).sum() / variance.sum())}
+
+    @staticmethod
+    def _entropy(p):
+        # Row wise, with 0 log 0 taken as 0
+        logs = np.log(np.where(p > 0, p, 1))
+        return -(p * logs).sum(axis=1)
+
+    def write(self):
+        if not self._results:
+            return None
+        path = os.path.join(self._output_dir,
+                            f'{self._prefix}.batch_diagnostics.json')
+        with open(path, 'w') as f:
+            json.dump({'n_neighbors': self._n_neighbors,
+                       'batches': self._batches.astype(str)
+                       .value_counts().to_dict(),
+                       'matrices': self._results}, f, indent=1)
+        print(f'Wrote batch diagnostics to {path}')
+        self._plot()
+        return path
+
+    def _plot(self):
+        # A scree plot and, if computed, a UMAP per matrix, one row each
+        names = list(self._results)
+        columns = 2 if self._do_umap else 1
+        fig, axes = plt.subplots(len(names), columns,
+                                 figsize=(8 * columns, 5 * len(names)),
+                                 squeeze=False)
+        colormap = matplotlib.colormaps['tab20']
+        for row, name in zip(axes, names):
+            result = self._results[name]
+            variance = result['explained_variance_ratio'][:_SCREE_PCS]
+            row[0].plot(range(1, len(variance) + 1), variance,
+                        marker='o', linestyle='-')
+            row[0].set_xlabel('Principal Component')
+            row[0].set_ylabel('Explained Variance Ratio')
+            row[0].set_title(f'Scree plot, {name}')
+            row[0].grid(True)
+
+            if self._do_umap:
+                embedding, batch = self._embeddings[name]
+                for i, level in enumerate(pd.unique(batch)):
+                    selected = batch == level
+                    row[1].scatter(embedding[selected, 0],
+                                   embedding[selected, 1],
+                                   s=10,
+                                   color=colormap(i % colormap.N),
+                                   label=level)
+                row[1].set_xlabel('UMAP1')
+                row[1].set_ylabel('UMAP2')
+                silhouette = result['silhouette_batch']
+                title = f'UMAP, {name}'
+                if silhouette is not None:
+                    title += f' (batch silhouette {silhouette:.2f})'
+                row[1].set_title(title)
+                row[1].legend(title='Batch', bbox_to_anchor=(1.05, 1),
+                              loc='upper left')
+
+        fig.tight_layout()
+        path = os.path.join(self._output_dir,
+                            f'{self._prefix}.batch_diagnostics.png')
+        fig.savefig(path)
+        plt.close(fig)
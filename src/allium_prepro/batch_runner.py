@@ -0,0 +1,194 @@
+import importlib
+import multiprocessing
+import os
+import time
+import traceback
+import yaml
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from .gex_preprocessor import GexPreprocessor
+from .reference_builder import resolve_reference
+from .reference_index import ReferenceIndex
+from .reference_preprocessor import default_ref_dir
+from .translation_cache import TranslationCache
+
+# Keys of a dataset entry that are for the runner, not for GexPreprocessor
+_RUNNER_KEYS = ['prepare', 'memory_gb']
+
+# Memory a dataset is assumed to need per byte of its counts file, when the
+# config doesn't say: the parsed matrix and the copies the stages make
+_MEMORY_PER_INPUT_BYTE = 8
+
+# Assumed when neither the config nor an existing counts file tells
+_DEFAULT_MEMORY = 4 * 1024**3
+
+# References opened by the parent process, inherited by forked workers
+_REFERENCES = {}
+
+
+def _physical_memory():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def _reference_path(kwargs):
+    return resolve_reference(kwargs.get('ref_data_dir') or default_ref_dir(),
+                             kwargs.get('ref_genome',
+                                        'Homo_sapiens.GRCh38.103'))
+
+
+def run_job(function, *args):
+    # Runs function(*args) in a worker process, returning its status, time
+    # and result, or the traceback it failed with in place of the result
+    start = time.time()
+    try:
+        return 'done', time.time() - start, function(*args)
+    except Exception:
+        return 'failed', time.time() - start, traceback.format_exc()
+
+
+def job_result(future):
+    # What run_job returned, also when the worker died, e.g. killed for
+    # running out of memory
+    try:
+        return future.result()
+    except Exception as e:
+        return 'failed', None, repr(e)
+
+
+def summarize_jobs(names, results, column='Dataset', jobs='datasets',
+                   total=None):
+    # Prints a status table of the run_job results by name, and total if
+    # given. Raises RuntimeError after the tracebacks if any job failed
+    print(f'{column:<10} Status    Time')
+    for name in names:
+        status, elapsed, _ = results[name]
+        elapsed = '-' if elapsed is None else f'{elapsed:.1f}s'
+        print(f'{name:<10} {status:<9} {elapsed}')
+    if total:
+        print(total)
+
+    failed = [name for name in names if results[name][0] != 'done']
+    if failed:
+        for name in failed:
+            print(f'{name} failed:\n{results[name][2]}')
+        raise RuntimeError(
+            f'{len(failed)} of {len(names)} {jobs} failed: '
+            f'{", ".join(failed)}')
+
+
+def _run_dataset(prepare, kwargs):
+    # Runs in a worker process, which is reused for later datasets, so each
+    # worker starts at most one R interpreter
+    if prepare:
+        importlib.import_module(prepare).prepare()
+    reference = _REFERENCES.get(_reference_path(kwargs))
+    GexPreprocessor(reference=reference, **kwargs).run()
+
+
+class BatchRunner():
+    # Runs the datasets of a YAML config through GexPreprocessor in parallel,
+    # only starting a dataset while its estimated memory fits in max_memory
+    def __init__(self,
+                 config_file,
+                 n_workers=None,
+                 max_memory=None,
+                 force_stage=None,
+                 prepare=True):
+        with open(config_file, 'r') as f:
+            config = yaml.safe_load(f)
+
+        self._n_workers = n_workers or config.get('n_workers') or \
+            os.cpu_count()
+        if max_memory is None and config.get('max_memory_gb'):
+            max_memory = config['max_memory_gb'] * 1024**3
+        self._max_memory = max_memory or _physical_memory()
+        self._prepare = prepare
+
+        # Entries override the defaults, and are named after their prefix
+        defaults = config.get('defaults') or {}
+        self._datasets = {}
+        for name, entry in config['datasets'].items():
+            entry = dict(defaults, **(entry or {}))
+            entry.setdefault('prefix', name)
+            if force_stage:
+                entry['force_stage'] = force_stage
+            self._datasets[name] = entry
+
+    def datasets(self):
+        return list(self._datasets)
+
+    def run(self, names=None):
+        names = names or self.datasets()
+        unknown = [name for name in names if name not in self._datasets]
+        if unknown:
+            raise ValueError(f'Unknown datasets: {", ".join(unknown)}')
+
+        print(f'Running {len(names)} datasets on {self._n_workers} '
+              f'workers...')
+        start = time.time()
+        self._open_references(names)
+
+        pending = list(names)
+        running = {}
+        results = {}
+        with ProcessPoolExecutor(max_workers=self._n_workers,
+                                 mp_context=self._context()) as executor:
+            while pending or running:
+                # Start datasets in config order while they fit, letting
+                # smaller ones past a large one. An idle pool always takes
+                # the next dataset, even one over the budget
+                in_use = sum(memory for _, memory in running.values())
+                for name in list(pending):
+                    if len(running) == self._n_workers:
+                        break
+                    memory = self._estimate_memory(name)
+                    if running and in_use + memory > self._max_memory:
+                        continue
+                    future = executor.submit(*self._job(name))
+                    running[future] = (name, memory)
+                    in_use += memory
+                    pending.remove(name)
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name, _ = running.pop(future)
+                    results[name] = job_result(future)
+                    print(f'Finished {name}: {results[name][0]}')
+
+        seconds = time.time() - start
+        summarize_jobs(names, results,
+                       total=f'Ran {len(names)} datasets in {seconds:.1f}s')
+        return results
+
+    def _job(self, name):
+        entry = self._datasets[name]
+        prepare = entry.get('prepare') if self._prepare else None
+        kwargs = {key: value for key, value in entry.items()
+                  if key not in _RUNNER_KEYS}
+        return run_job, _run_dataset, prepare, kwargs
+
+    def _estimate_memory(self, name):
+        entry = self._datasets[name]
+        if entry.get('memory_gb'):
+            return entry['memory_gb'] * 1024**3
+        if os.path.exists(entry['input_file']):
+            return os.path.getsize(entry['input_file']) * \
+                _MEMORY_PER_INPUT_BYTE
+        return _DEFAULT_MEMORY
+
+    def _open_references(self, names):
+        # Opened once here instead of once per dataset
+        for name in names:
+            entry = self._datasets[name]
+            path = _reference_path(entry)
+            if path not in _REFERENCES:
+                print(f'Loading reference {path}...')
+                gt = TranslationCache(data_dir=entry.get('tmp_dir', '/tmp'))
+                _REFERENCES[path] = ReferenceIndex.open(path, gt)
+
+    @staticmethod
+    def _context():
+        # Forked workers inherit the opened references, whose memory mapped
+        # pages are then shared. Elsewhere each worker opens its own
+        if 'fork' in multiprocessing.get_all_start_methods():
+            return multiprocessing.get_context('fork')
+        return None
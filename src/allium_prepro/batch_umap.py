@@ -1,10 +1,17 @@
+import os
+import pickle
+import time
+from contextlib import contextmanager
 import pandas as pd
 import numpy as np
 import seaborn as sns
 import matplotlib.pyplot as plt
+from sklearn.decomposition import PCA
 from sklearn.preprocessing import StandardScaler
 import umap.umap_ as umap
+from .profiling import StageProfiler
 from .subtype_thesaurus import SubtypeThesaurus
+from .matrix_io import FORMATS, check_format, read_matrix, write_matrix
 
 
 class BatchUmap():
@@ -23,7 +30,14 @@ class BatchUmap():
                  counts_file,
                  output_dir,
                  do_transform=False,
-                 batches_file=None):
+                 batches_file=None,
+                 output_format=None,
+                 n_pcs=None,
+                 approximate_neighbors=False,
+                 random_state=42,
+                 save_model=False,
+                 model_file=None,
+                 profile=False):
         self._prefix = prefix
         self._counts_file = counts_file
         self._batches_file = batches_file
@@ -32,9 +46,42 @@ class BatchUmap():
         self._FIG_SIZE = (8, 8)
         self._do_transform = do_transform
 
+        # Optionally keep the embedding as a matrix file too
+        if output_format:
+            check_format(output_format)
+        self._output_format = output_format
+
+        # Optionally reduce to this many principal components before UMAP,
+        # so neighbors are searched in n_pcs rather than ~20k dimensions
+        if n_pcs is not None and n_pcs < 2:
+            raise ValueError('n_pcs must be at least 2')
+        self._n_pcs = n_pcs
+
+        # Nearest neighbor descent even for small datasets, for which UMAP
+        # otherwise computes exact neighbors. With random_state=None UMAP
+        # also runs in parallel, at the cost of reproducibility
+        self._approximate_neighbors = approximate_neighbors
+        self._random_state = random_state
+
+        # The fitted scaler, PCA and UMAP can be kept, and a kept model
+        # projects new samples instead of fitting a new embedding
+        self._save_model = save_model
+        self._model_file = model_file
+
+        # Optional timing and resource use of every stage
+        self._profiler = StageProfiler(f'{prefix}.batch_umap',
+                                       output_dir,
+                                       profile)
+
     def run(self):
-        # Load your dataset
-        data = pd.read_csv(self._counts_file, index_col=0)
+        with self._profiler.stage('run'):
+            self._run()
+
+    def _run(self):
+        # Load your dataset, in whichever format it was written
+        with self._profiler.stage('read') as profiled:
+            data = read_matrix(self._counts_file)
+            profiled.shape(data)
 
         if self._do_transform:
             data = data.T
@@ -53,35 +100,117 @@ class BatchUmap():
         data = data.sort_index()
         batch_labels = batch_labels.sort_index()
 
-        # Normalize and scale the data
-        scaler = StandardScaler()
-        scaled_data = scaler.fit_transform(data)
-
-        # Apply UMAP for dimensionality reduction
-        reducer = umap.UMAP(n_neighbors=15,
-                            min_dist=0.1,
-                            n_components=2,
-                            random_state=42)
-        umap_embedding = reducer.fit_transform(scaled_data)
+        if self._model_file:
+            umap_embedding = self._transform(data)
+        else:
+            umap_embedding = self._fit_transform(data)
 
         # Create a DataFrame for visualization
         umap_df = pd.DataFrame(umap_embedding, columns=['UMAP1', 'UMAP2'])
         umap_df['Batch'] = batch_labels.values
 
-        # Plot UMAP
-        plt.figure(figsize=(10, 8))
-        sns.scatterplot(
-            x='UMAP1',
-            y='UMAP2',
-            hue='Batch',
-            palette=colormap,
-            data=umap_df,
-            s=50
-        )
-        plt.title('UMAP of Gene Expression Data Showing Batch Effects')
-        plt.legend(title='Batch', bbox_to_anchor=(1.05, 1), loc='upper left')
-        plt.xlabel('UMAP1')
-        plt.ylabel('UMAP2')
-        plt.tight_layout()
-
-        plt.savefig(f'{self._output_dir}/{self._prefix}_umap_batches.png')
+        if self._output_format:
+            embedding = umap_df[['UMAP1', 'UMAP2']].set_index(data.index)
+            embedding.index.name = 'id'
+            write_matrix(embedding,
+                         f'{self._output_dir}/{self._prefix}_umap_batches'
+                         f'{FORMATS[self._output_format]}')
+
+        with self._phase('plot', umap_df):
+            # Plot UMAP
+            plt.figure(figsize=(10, 8))
+            sns.scatterplot(
+                x='UMAP1',
+                y='UMAP2',
+                hue='Batch',
+                palette=colormap,
+                data=umap_df,
+                s=50
+            )
+            plt.title('UMAP of Gene Expression Data Showing Batch Effects')
+            plt.legend(title='Batch', bbox_to_anchor=(1.05, 1), loc='upper left')
+            plt.xlabel('UMAP1')
+            plt.ylabel('UMAP2')
+            plt.tight_layout()
+
+            plt.savefig(f'{self._output_dir}/{self._prefix}_umap_batches.png')
+
+    @contextmanager
+    def _phase(self, name, data):
+        # Every phase is timed, and profiled too when profiling is on
+        start = time.time()
+        with self._profiler.stage(name) as profiled:
+            profiled.shape(data)
+            yield
+        print(f'{name}: {time.time() - start:.2f}s')
+
+    def _fit_transform(self, data):
+        # Normalize and scale the data
+        with self._phase('scale', data):
+            scaler = StandardScaler()
+            scaled_data = scaler.fit_transform(data)
+
+        pca = None
+        if self._n_pcs:
+            # Randomized SVD, which only computes the leading components
+            n_pcs = min(self._n_pcs, *scaled_data.shape)
+            with self._phase('pca', scaled_data):
+                pca = PCA(n_components=n_pcs,
+                          svd_solver='randomized',
+                          random_state=self._random_state)
+                scaled_data = pca.fit_transform(scaled_data)
+            print(f'{n_pcs} PCs explain '
+                  f'{pca.explained_variance_ratio_.sum():.0%} of the variance')
+
+        # Apply UMAP for dimensionality reduction
+        with self._phase('umap', scaled_data):
+            reducer = umap.UMAP(
+                n_neighbors=15,
+                min_dist=0.1,
+                n_components=2,
+                random_state=self._random_state,
+                force_approximation_algorithm=self._approximate_neighbors)
+            umap_embedding = reducer.fit_transform(scaled_data)
+
+        if self._save_model:
+            path = os.path.join(self._output_dir,
+                                f'{self._prefix}_umap_model.pkl')
+            with self._phase('save_model', scaled_data):
+                with open(path, 'wb') as f:
+                    pickle.dump({'genes': data.columns.tolist(),
+                                 'scaler': scaler,
+                                 'pca': pca,
+                                 'umap': reducer},
+                                f, protocol=pickle.HIGHEST_PROTOCOL)
+            print(f'Saved UMAP model to {path}')
+
+        return umap_embedding
+
+    def _transform(self, data):
+        with self._phase('load_model', data):
+            with open(self._model_file, 'rb') as f:
+                model = pickle.load(f)
+
+        # Genes in the order the model was fitted on. Genes missing here are
+        # set to their mean in the fitted data, so they scale to zero
+        genes = pd.Index(model['genes'])
+        missing = ~genes.isin(data.columns)
+        if missing.all():
+            raise ValueError(f'None of the genes of {self._model_file} '
+                             f'are in {self._counts_file}')
+        if missing.any():
+            print(f'{missing.sum()} of {len(genes)} model genes are missing, '
+                  'they are set to their mean')
+        data = data.reindex(columns=genes)
+        data = data.fillna(pd.Series(model['scaler'].mean_, index=genes))
+
+        with self._phase('scale', data):
+            scaled_data = model['scaler'].transform(data)
+
+        if model['pca'] is not None:
+            with self._phase('pca', scaled_data):
+                scaled_data = model['pca'].transform(scaled_data)
+
+        # Projected onto the kept embedding, which is not refitted
+        with self._phase('umap', scaled_data):
+            return model['umap'].transform(scaled_data)
@@ -0,0 +1,312 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from scipy.optimize import minimize_scalar
+from scipy.special import gammaln
+from scipy.stats import nbinom
+
+# Constants shared with edgeR's C++ routines
+LOW_VALUE = 1e-10
+MIN_ROW_SUM = 5
+GLM_MAXIT = 50
+GLM_TOL = 1e-10
+PRIOR_COUNT = 1e-4
+DISP_INTERVAL = (0, 4)
+DISP_TOL = 1e-5
+GRID = np.linspace(-6, 6, 11)
+
+
+def _fit_one_group(y, offset, disp):
+    # Port of edgeR's mglmOneGroup: Newton-Raphson for a single mean
+    offset = np.broadcast_to(offset, y.shape)
+    disp = np.broadcast_to(disp, y.shape)
+
+    # Start from the exact solution for the gamma distribution
+    nonzero = (y > LOW_VALUE).any(axis=1)
+    with np.errstate(divide='ignore'):
+        start = np.where(y > LOW_VALUE, y / np.exp(offset), 0).sum(axis=1)
+        beta = np.log(start / y.shape[1])
+
+    # All-zero rows skip straight to -Inf
+    beta[~nonzero] = -np.inf
+    active = np.flatnonzero(nonzero)
+    for _ in range(GLM_MAXIT):
+        if len(active) == 0:
+            break
+        mu = np.exp(beta[active, None] + offset[active])
+        denominator = 1 + mu * disp[active]
+        dl = ((y[active] - mu) / denominator).sum(axis=1)
+        info = (mu / denominator).sum(axis=1)
+        step = dl / info
+        beta[active] += step
+        active = active[np.abs(step) >= GLM_TOL]
+    return beta
+
+
+def _adjusted_profile_lik(y, offset, disp):
+    # Cox-Reid adjusted profile log-likelihood for an intercept-only design
+    disp = np.broadcast_to(np.asarray(disp, dtype=np.float64), (len(y),))
+    beta = _fit_one_group(y, offset, disp[:, None])
+    mu = np.exp(beta[:, None] + offset)
+    d = disp[:, None]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = 1 / d
+        log_mur = np.log(mu + r)
+        nb = y * np.log(mu) - y * log_mur + r * np.log(r) - r * log_mur + \
+            gammaln(y + r) - gammaln(y + 1) - gammaln(r)
+        poisson = y * np.log(mu) - mu - gammaln(y + 1)
+    loglik = np.where(d > 0, nb, poisson)
+
+    # The likelihood of a zero mean is only reached by zero counts
+    loglik = np.where(mu == 0, 0, loglik).sum(axis=1)
+
+    # The adjustment is half the log determinant of X^T W X
+    w = (mu / (1 + d * mu)).sum(axis=1)
+    with np.errstate(divide='ignore'):
+        log_w = np.where(w < LOW_VALUE, np.log(LOW_VALUE), np.log(w))
+    return loglik - 0.5 * log_w
+
+
+def _common_dispersion(y, offset):
+    # Port of edgeR's dispCoxReid
+    y = y[y.sum(axis=1) >= MIN_ROW_SUM]
+    if len(y) == 0:
+        raise ValueError('no data rows with required number of counts')
+
+    def sum_apl(par):
+        return -_adjusted_profile_lik(y, offset, par ** 4).sum()
+
+    # Optimize on the fourth root to anchor the search
+    bounds = tuple(x ** 0.25 for x in DISP_INTERVAL)
+    out = minimize_scalar(sum_apl, bounds=bounds, method='bounded',
+                          options={'xatol': DISP_TOL})
+    return out.x ** 4
+
+
+def _fmm_spline(x, y):
+    # Port of R's fmm_spline, vectorized over the rows of y
+    n = len(x)
+    h = np.diff(x)
+    if n < 3:
+        b = np.repeat((y[:, 1:2] - y[:, :1]) / h[0], n, axis=1)
+        return b, np.zeros_like(y), np.zeros_like(y)
+
+    # Set up tridiagonal system
+    diag = np.zeros(n)
+    c = np.zeros_like(y)
+    c[:, 1] = (y[:, 1] - y[:, 0]) / h[0]
+    for i in range(1, n - 1):
+        diag[i] = 2 * (h[i - 1] + h[i])
+        c[:, i + 1] = (y[:, i + 1] - y[:, i]) / h[i]
+        c[:, i] = c[:, i + 1] - c[:, i]
+
+    # End conditions from third divided differences
+    diag[0] = -h[0]
+    diag[n - 1] = -h[n - 2]
+    c[:, 0] = 0
+    c[:, n - 1] = 0
+    if n > 3:
+        c0 = c[:, 2] / (x[3] - x[1]) - c[:, 1] / (x[2] - x[0])
+        cn = c[:, n - 2] / (x[n - 1] - x[n - 3]) - \
+            c[:, n - 3] / (x[n - 2] - x[n - 4])
+        c[:, 0] = c0 * h[0] * h[0] / (x[3] - x[0])
+        c[:, n - 1] = -cn * h[n - 2] * h[n - 2] / (x[n - 1] - x[n - 4])
+
+    # Gaussian elimination and backward substitution
+    for i in range(1, n):
+        t = h[i - 1] / diag[i - 1]
+        diag[i] = diag[i] - t * h[i - 1]
+        c[:, i] = c[:, i] - t * c[:, i - 1]
+    c[:, n - 1] = c[:, n - 1] / diag[n - 1]
+    for i in range(n - 2, -1, -1):
+        c[:, i] = (c[:, i] - h[i] * c[:, i + 1]) / diag[i]
+
+    # Compute polynomial coefficients
+    b = np.zeros_like(y)
+    d = np.zeros_like(y)
+    b[:, n - 1] = (y[:, n - 1] - y[:, n - 2]) / h[n - 2] + \
+        h[n - 2] * (c[:, n - 2] + 2 * c[:, n - 1])
+    for i in range(n - 1):
+        b[:, i] = (y[:, i + 1] - y[:, i]) / h[i] - \
+            h[i] * (c[:, i + 1] + 2 * c[:, i])
+        d[:, i] = (c[:, i + 1] - c[:, i]) / h[i]
+    d[:, n - 1] = d[:, n - 2]
+    return b, 3 * c, d
+
+
+def _maximize_interpolant(x, y):
+    # Port of edgeR's maximizeInterpolant
+    rows = np.arange(len(y))
+    maxed_at = np.argmax(y, axis=1)
+    maxed = y[rows, maxed_at]
+    x_max = x[maxed_at]
+    b, c, d = _fmm_spline(x, y)
+
+    # Look for a turning point on the left, then the right segment
+    for seg, has_seg in [(maxed_at - 1, maxed_at > 0),
+                         (maxed_at, maxed_at < len(x) - 1)]:
+        seg = np.clip(seg, 0, len(x) - 2)
+        sb, sc, sd = b[rows, seg], c[rows, seg], d[rows, seg]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            a = 3 * sd
+            disc = (2 * sc) ** 2 - 4 * a * sb
+            sol = -2 * sc / (2 * a) - np.sqrt(disc) / (2 * a)
+            temp = ((sd * sol + sc) * sol + sb) * sol + y[rows, seg]
+        better = has_seg & (disc >= 0) & (sol > 0) & \
+            (sol < x[seg + 1] - x[seg]) & (temp > maxed)
+        maxed = np.where(better, temp, maxed)
+        x_max = np.where(better, sol + x[seg], x_max)
+    return x_max
+
+
+def _tagwise_dispersion(y, offset, common):
+    # Port of edgeR's dispCoxReidInterpolateTagwise with prior.df=0
+    disp = np.full(len(y), common)
+    enough = y.sum(axis=1) >= MIN_ROW_SUM
+    if not enough.any():
+        return disp
+
+    y = y[enough]
+    l0 = np.column_stack([
+        _adjusted_profile_lik(y, offset, common * 2 ** p) for p in GRID])
+    disp[enough] = common * 2 ** _maximize_interpolant(GRID, l0)
+    return disp
+
+
+def _one_way_fit(y, batch_idx, n_batch, offset, disp):
+    beta = np.zeros((len(y), n_batch))
+    for k in range(n_batch):
+        cols = batch_idx == k
+        beta[:, k] = _fit_one_group(y[:, cols], offset[:, cols],
+                                    disp[:, cols])
+    return beta
+
+
+def _one_way_fit_shrunk(y, batch_idx, n_batch, offset, disp):
+    # Port of edgeR's predFC: library size-adjusted prior counts
+    lib_size = np.exp(offset)
+    prior = PRIOR_COUNT * lib_size / lib_size.mean(axis=1, keepdims=True)
+    return _one_way_fit(y + prior, batch_idx, n_batch,
+                        np.log(lib_size + 2 * prior), disp)
+
+
+def _match_quantiles(counts, old_mu, old_phi, new_mu, new_phi):
+    # Counts of 0 or 1 are kept, so only evaluate the others
+    adjusted = counts.copy()
+    rows, cols = np.nonzero(counts > 1)
+    y = counts[rows, cols]
+    old_mu = old_mu[rows, cols]
+    new_mu = new_mu[rows, cols]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        old_size = 1 / old_phi[rows]
+        new_size = 1 / new_phi[rows]
+        p = nbinom.cdf(y - 1, old_size, old_size / (old_size + old_mu))
+
+    # Extreme tail probabilities are kept as well
+    mapped = np.abs(p - 1) >= 1e-4
+    new_size = new_size[mapped]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Fuzz like R's qnbinom to ensure left continuity
+        q = nbinom.ppf(p[mapped] * (1 - 64 * np.finfo(float).eps),
+                       new_size,
+                       new_size / (new_size + new_mu[mapped]))
+    adjusted[rows[mapped], cols[mapped]] = 1 + q
+    return adjusted
+
+
+def _adjust_block(counts, batch_idx, n_batch, log_lib, disp_common):
+    n_batches = np.bincount(batch_idx, minlength=n_batch)
+    offset = np.broadcast_to(log_lib, counts.shape)
+
+    # Gene-wise dispersions within each batch
+    phi_hat = np.column_stack([
+        _tagwise_dispersion(counts[:, batch_idx == k],
+                            log_lib[batch_idx == k],
+                            disp_common[k])
+        for k in range(n_batch)])
+    phi_matrix = phi_hat[:, batch_idx]
+
+    # Fit the GLM and centre the batch effects around their weighted mean
+    coef = _one_way_fit_shrunk(counts, batch_idx, n_batch, offset,
+                               phi_matrix)
+    alpha_g = coef @ (n_batches / len(batch_idx))
+    new_offset = offset + alpha_g[:, None]
+
+    # Refit with the gene means in the offset to get the batch effects
+    gamma_hat = _one_way_fit_shrunk(counts, batch_idx, n_batch, new_offset,
+                                    phi_matrix)
+    beta = _one_way_fit(counts, batch_idx, n_batch, new_offset, phi_matrix)
+    mu_hat = np.exp(beta[:, batch_idx] + new_offset)
+
+    # Remove the batch effects from the means and pool the dispersions
+    with np.errstate(divide='ignore'):
+        mu_star = np.exp(np.log(mu_hat) - gamma_hat[:, batch_idx])
+    phi_star = phi_hat.mean(axis=1)
+
+    adjusted = np.empty_like(counts)
+    for k in range(n_batch):
+        cols = batch_idx == k
+        adjusted[:, cols] = _match_quantiles(counts[:, cols],
+                                             mu_hat[:, cols],
+                                             phi_hat[:, k],
+                                             mu_star[:, cols],
+                                             phi_star)
+    return adjusted
+
+
+class CombatSeq():
+    # Port of sva::ComBat_seq for a batch-only design without shrinkage
+    def __init__(self, n_jobs=None, block_size=1000):
+        self._n_jobs = n_jobs or os.cpu_count()
+        self._block_size = block_size
+
+    def run(self, counts, batch):
+        counts = np.asarray(counts, dtype=np.float64)
+        if any(b is None or b != b for b in batch):
+            raise ValueError('Every sample needs a batch')
+        levels, batch_idx = np.unique(np.asarray(batch).astype(str),
+                                      return_inverse=True)
+        n_batch = len(levels)
+
+        if n_batch < 2:
+            raise ValueError('ComBat-seq needs at least two batches')
+        if np.bincount(batch_idx).min() <= 1:
+            raise ValueError(
+                "ComBat-seq doesn't support 1 sample per batch yet")
+        print(f'Found {n_batch} batches')
+
+        # Genes with only zero counts in any batch are not adjusted
+        keep = np.all([(counts[:, batch_idx == k] != 0).any(axis=1)
+                       for k in range(n_batch)], axis=0)
+        if not keep.all():
+            print(f'Found {(~keep).sum()} genes with uniform zero counts '
+                  'in one or more batches; these genes are not adjusted')
+        y = counts[keep]
+
+        # Library sizes in extended precision like R's colSums
+        log_lib = np.log(y.sum(axis=0, dtype=np.longdouble)
+                         .astype(np.float64))
+
+        print('Estimating dispersions')
+        disp_common = [_common_dispersion(y[:, batch_idx == k],
+                                          log_lib[batch_idx == k])
+                       for k in range(n_batch)]
+
+        # Everything after the common dispersions is gene-wise
+        print('Fitting the GLM model and adjusting the data')
+        blocks = [y[i:i + self._block_size]
+                  for i in range(0, len(y), self._block_size)]
+        args = [[batch_idx] * len(blocks), [n_batch] * len(blocks),
+                [log_lib] * len(blocks), [disp_common] * len(blocks)]
+        if self._n_jobs == 1 or len(blocks) == 1:
+            adjusted = list(map(_adjust_block, blocks, *args))
+        else:
+            with ProcessPoolExecutor(max_workers=self._n_jobs) as executor:
+                adjusted = list(executor.map(_adjust_block, blocks, *args))
+
+        result = counts.copy()
+        if adjusted:
+            result[keep] = np.vstack(adjusted)
+        return result
@@ -0,0 +1,14 @@
+from contextlib import contextmanager
+
+
+@contextmanager
+def file_lock(path):
+    # Exclusive lock held by one process at a time, e.g. around reading,
+    # updating and replacing a JSON file that several processes share
+    import fcntl
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+class GeneMatcher():
+    def __init__(self, ref_ids, ref_symbols=None, symbol_to_id=None):
+        # Build hash indexes on the reference once
+        self._ref_ids = pd.Index(ref_ids, dtype=object).unique()
+        if symbol_to_id is None:
+            # Every candidate for a symbol is itself a ref id, so the
+            # tie-break always resolves to the first matching ref row
+            symbol_to_id = {}
+            for ref_id, symbol in zip(ref_ids, ref_symbols):
+                if not pd.isna(symbol) and symbol not in symbol_to_id:
+                    symbol_to_id[symbol] = ref_id
+        # Otherwise prebuilt, e.g. from a reference index
+        self._symbol_to_id = symbol_to_id
+        self._symbols = pd.Index(list(symbol_to_id.keys()), dtype=object)
+
+        # Keys as match returns them, stripped once here
+        self._stripped_ids = self._strip(self._ref_ids)
+        self._stripped_symbol_ids = self._strip(symbol_to_id.values())
+
+    @staticmethod
+    def _strip(values):
+        return np.array([value.strip() for value in values], dtype=object)
+
+    def find_ref_key(self, gene_id, symbol):
+        # Exact Ensembl id match takes priority
+        if gene_id in self._ref_ids:
+            return gene_id
+        # Then the standardized symbol
+        if pd.isna(symbol):
+            return None
+        return self._symbol_to_id.get(symbol)
+
+    def match(self, gene_ids, symbols):
+        # Resolve every input gene at once, the same as find_ref_key per
+        # gene: the exact id first, then the standardized symbol. Lookups
+        # are on object indexes, as pandas string arrays are slow to build
+        index = gene_ids
+        gene_ids = pd.Index(gene_ids, dtype=object)
+        symbols = np.asarray(symbols, dtype=object)
+        keys = np.full(len(gene_ids), None, dtype=object)
+
+        positions = self._ref_ids.get_indexer(gene_ids)
+        by_id = positions >= 0
+        keys[by_id] = self._stripped_ids[positions[by_id]]
+
+        rest = np.flatnonzero(~by_id & ~pd.isna(symbols))
+        positions = self._symbols.get_indexer(
+            pd.Index(symbols[rest], dtype=object))
+        found = positions >= 0
+        keys[rest[found]] = self._stripped_symbol_ids[positions[found]]
+        return pd.Series(keys, index=index, dtype=object)
+
+    @staticmethod
+    def aggregate(data, keys):
+        # Drop rows without a ref key and add duplicate keys together
+        matched = keys.notna().values
+        data = data[matched]
+        groups = keys.values[matched]
+        summed = data.groupby(groups, sort=False).sum(min_count=1)
+
+        # A missing count anywhere in a group makes the whole sum missing
+        nans = data.isna()
+        if nans.values.any():
+            summed = summed.mask(nans.groupby(groups, sort=False).any())
+
+        summed.index.name = None
+        return summed
+
+    @staticmethod
+    def aggregate_sparse(matrix, keys):
+        # Same as aggregate, as the product of a key x gene indicator matrix
+        # with the sparse counts, with keys in first appearance order
+        matched = np.flatnonzero(keys.notna().values)
+        codes, uniques = pd.factorize(keys.values[matched])
+        indicator = sparse.csr_matrix(
+            (np.ones(len(matched), dtype=np.int64), (codes, matched)),
+            shape=(len(uniques), matrix.shape[0]))
+
+        # Sum in 64 bits, so duplicates can't overflow int32 counts
+        summed = indicator @ matrix.astype(np.result_type(matrix.dtype,
+                                                          np.int64))
+        if np.issubdtype(matrix.dtype, np.integer) and \
+                (summed.nnz == 0 or
+                 summed.data.max() <= np.iinfo(matrix.dtype).max):
+            summed = summed.astype(matrix.dtype)
+        return sparse.csr_matrix(summed), pd.Index(uniques)
@@ -1,5 +1,32 @@
 import pandas as pd
+import numpy as np
 import os
+import io
+import json
+import time
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from .matrix_io import read_matrix, with_format, write_matrix
+from .profiling import StageProfiler
+from .stage_cache import hash_file
+
+INT32_MAX = np.iinfo(np.int32).max
+
+
+def _parse_count_file(path, separator, with_hash=False):
+    # Read the file once, so it can be hashed and parsed from memory
+    with open(path, 'rb') as f:
+        content = f.read()
+    digest = hashlib.sha256(content).hexdigest() if with_hash else None
+
+    # Convert space separated text file to df, use first col as index
+    sample_df = pd.read_csv(io.BytesIO(content),
+                            sep=separator,
+                            header=None,
+                            index_col=0)
+
+    # Keep the gene ids and the single count column
+    return sample_df.index.values, sample_df.iloc[:, 0].values, digest
 
 
 class GexConcatenator():
@@ -9,51 +36,219 @@ class GexConcatenator():
                  output_dir,
                  sample_name_extractor_func,
                  filename_filter_func=None,
-                 separator='\t'):
+                 separator='\t',
+                 output_format='csv',
+                 float32=False,
+                 n_jobs=None,
+                 executor='thread',
+                 progress_every=100,
+                 incremental=False,
+                 profile=False):
         self._raw_data_dir = raw_data_dir
         self._files = os.listdir(raw_data_dir)
-        self._output_file_path = f'{output_dir}/{prefix}.counts.raw.csv'
+        self._output_file_path = with_format(
+            f'{output_dir}/{prefix}.counts.raw.csv', output_format)
+
+        # Incremental runs keep track of every file already ingested
+        self._incremental = incremental
+        self._manifest_path = \
+            f'{output_dir}/{prefix}.counts.raw.manifest.json'
+        self._float32 = float32
         self._sample_name_extractor_func = sample_name_extractor_func
         self._filename_filter_func = filename_filter_func
         self._separator = separator
 
-    def concatenate(self):
-        print("Concatenating gene expression data...")
-        dfs = {}
+        # Throw exception if executor is not 'process' or 'thread'
+        if executor not in ['process', 'thread']:
+            raise ValueError('executor must be either "process" or "thread"')
+        self._executor = executor
+        self._n_jobs = n_jobs or os.cpu_count()
+        self._progress_every = progress_every
+
+        # Optional timing and resource use of every stage. Files parsed by
+        # a process pool count towards CPU time, but not towards I/O
+        self._profiler = StageProfiler(f'{prefix}.gex_concatenator',
+                                       output_dir,
+                                       profile)
 
+    def _sample_files(self):
+        # Map each sample to its file; later files win, like a dict would
+        samples = {}
         for filename in self._files:
             # Skip files that don't pass the filter
             if self._filename_filter_func and not self._filename_filter_func(filename):
                 continue
 
-            path = os.path.join(self._raw_data_dir, filename)
-
             # Extract sample name from filename
             sample = self._sample_name_extractor_func(filename)
+            samples[sample] = os.path.join(self._raw_data_dir, filename)
+        return samples
 
-            # Convert space separated text file to df, use first col as index
-            sample_df = pd.read_csv(path,
-                                    sep=self._separator,
-                                    header=None,
-                                    index_col=0)
+    def _parse_all(self, paths, with_hash=False):
+        # Yield parsed files in order, reporting progress as they arrive
+        n_bytes = 0
+        start = time.time()
 
-            # Remove index name
-            sample_df.index.name = None
+        def report(i):
+            elapsed = max(time.time() - start, 1e-9)
+            print(f'Parsed {i}/{len(paths)} files '
+                  f'({i / elapsed:.1f} files/s, '
+                  f'{n_bytes / elapsed / 1e6:.1f} MB/s)')
 
-            # Call the other column "count"
-            sample_df.columns = ['count']
+        pool = ProcessPoolExecutor if self._executor == 'process' \
+            else ThreadPoolExecutor
+        with pool(max_workers=self._n_jobs) as executor:
+            parsed = executor.map(_parse_count_file,
+                                  paths,
+                                  [self._separator] * len(paths),
+                                  [with_hash] * len(paths),
+                                  chunksize=max(1, len(paths) //
+                                                (self._n_jobs * 8)))
+            for i, (path, result) in enumerate(zip(paths, parsed), 1):
+                n_bytes += os.path.getsize(path)
+                if i % self._progress_every == 0 or i == len(paths):
+                    report(i)
+                yield result
 
-            # Create a new column with the sample name
-            dfs[sample] = sample_df['count']
+    def concatenate(self):
+        with self._profiler.stage('concatenate'):
+            self._concatenate()
 
-        # Concatenate all dataframes, using key as column name
-        data = pd.concat(dfs, axis=1)
+    def _concatenate(self):
+        print("Concatenating gene expression data...")
+        samples = self._sample_files()
+        if not samples:
+            raise ValueError(f'No count files found in {self._raw_data_dir}')
 
-        # Sort columns by name
-        data = data.sort_index(axis=1)
+        with self._profiler.stage('parse') as profiled:
+            if self._incremental and os.path.exists(self._manifest_path) \
+                    and os.path.exists(self._output_file_path):
+                data, manifest = self._update(samples)
+            else:
+                data, manifest = self._build(samples, self._incremental)
+            profiled.shape(data)
+
+        # Write to file
+        with self._profiler.stage('write'):
+            write_matrix(data, self._output_file_path, self._float32)
+
+        if self._incremental:
+            with open(self._manifest_path, 'w') as f:
+                json.dump({'files': manifest}, f, indent=1)
+
+    @staticmethod
+    def _manifest_entry(sample, path, digest):
+        stat = os.stat(path)
+        return {'sample': sample,
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'sha256': digest}
+
+    def _build(self, samples, with_hash=False):
+        names = list(samples.keys())
+        paths = list(samples.values())
+
+        # Columns are sorted by sample name, so place each file directly
+        column_of = {sample: i for i, sample in
+                     enumerate(sorted(names))}
+
+        genes = None
+        matrix = None
+        unaligned = {}
+        manifest = {}
+        parsed = self._parse_all(paths, with_hash)
+        for sample, path, (sample_genes, counts, digest) in zip(names,
+                                                                paths,
+                                                                parsed):
+            if with_hash:
+                manifest[os.path.basename(path)] = \
+                    self._manifest_entry(sample, path, digest)
+
+            if genes is None:
+                # Preallocate from the first file's gene order
+                genes = sample_genes
+                if np.issubdtype(counts.dtype, np.integer):
+                    dtype = np.int32
+                else:
+                    dtype = np.float64
+                matrix = np.zeros((len(genes), len(names)), dtype=dtype)
+
+            # Fast path: same genes in the same order as the first file
+            if np.array_equal(sample_genes, genes) and \
+                    np.can_cast(counts.dtype, matrix.dtype, 'same_kind'):
+                if matrix.dtype == np.int32 and \
+                        counts.max(initial=0) > INT32_MAX:
+                    matrix = matrix.astype(np.int64)
+                matrix[:, column_of[sample]] = counts
+            else:
+                unaligned[sample] = pd.Series(counts, index=sample_genes)
+
+        if unaligned:
+            data = self._align(names, genes, matrix, column_of, unaligned)
+        else:
+            data = pd.DataFrame(matrix,
+                                index=pd.Index(genes),
+                                columns=sorted(names))
 
         # Drop all rows whose index starts with "__"
         data = data[~data.index.str.startswith("__")]
+        return data, manifest
 
-        # Write to file
-        data.to_csv(self._output_file_path)
+    def _update(self, samples):
+        with open(self._manifest_path, 'r') as f:
+            old_manifest = json.load(f)['files']
+        data = read_matrix(self._output_file_path)
+
+        # Sort files into unchanged ones and ones that need parsing
+        manifest = {}
+        to_parse = {}
+        for sample, path in samples.items():
+            filename = os.path.basename(path)
+            entry = old_manifest.get(filename)
+            stat = os.stat(path)
+            unchanged = entry is not None and \
+                entry['sample'] == sample and \
+                entry['size'] == stat.st_size and \
+                sample in data.columns
+            # A touched file only counts as changed if its content did
+            if unchanged and entry['mtime'] != stat.st_mtime:
+                unchanged = hash_file(path) == entry['sha256']
+            if unchanged:
+                manifest[filename] = dict(entry, mtime=stat.st_mtime)
+            else:
+                to_parse[sample] = path
+
+        # Drop columns for removed files and for the ones being replaced
+        kept = [sample for sample in data.columns
+                if sample in samples and sample not in to_parse]
+        print(f'{len(to_parse)} new or changed files, '
+              f'{len(data.columns) - len(kept)} columns dropped or replaced')
+        data = data[kept]
+
+        if to_parse:
+            # Parse new files exactly like a full build, aligning on genes
+            new_data, new_manifest = self._build(to_parse, with_hash=True)
+            manifest.update(new_manifest)
+            data = pd.concat([data, new_data], axis=1)
+
+        # Sort columns by name
+        return data.sort_index(axis=1), manifest
+
+    @staticmethod
+    def _align(names, genes, matrix, column_of, unaligned):
+        # Fall back to index alignment when gene sets differ
+        print(f'{len(unaligned)} files have different genes, aligning...')
+        index = pd.Index(genes)
+        dfs = {}
+        for sample in names:
+            if sample in unaligned:
+                dfs[sample] = unaligned[sample]
+            else:
+                dfs[sample] = pd.Series(matrix[:, column_of[sample]],
+                                        index=index)
+
+        # Concatenate all dataframes, using key as column name
+        data = pd.concat(dfs, axis=1)
+
+        # Sort columns by name
+        return data.sort_index(axis=1)
@@ -1,8 +1,48 @@
 import pandas as pd
+import numpy as np
+import multiprocessing
 import os
 import re
-from gene_thesaurus import GeneThesaurus
-import rpy2.robjects as robjects
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from scipy import sparse
+from .gene_matcher import GeneMatcher
+from .tmm_normalizer import ChunkedTmmNormalizer, TmmNormalizer
+from .combat_seq import CombatSeq
+from .matrix_io import check_format, detect_format, read_matrix, \
+    with_format, write_matrix
+from .profiling import StageProfiler
+from .stage_cache import StageCache, hash_file, hash_parts
+from .translation_cache import TranslationCache, translations_path
+from .reference_index import ReferenceIndex
+from .reference_builder import resolve_reference
+from .reference_preprocessor import default_ref_dir
+from .signature_coverage import SignatureCoverage
+from .sparse_counts import SparseCounts
+
+# Stages of GexPreprocessor.run, in order
+STAGES = ['batch_correction', 'preprocess_genes', 'normalize', 'allium_format']
+
+# Matrices the batch diagnostics look at, by the stage that outputs them
+_DIAGNOSED = {'input': 'raw',
+              'batch_correction': 'batch_corrected',
+              'normalize': 'normalized'}
+
+# Batch correction variants run by forked workers, which inherit them
+_VARIANTS = {}
+
+# Bump a stage's version whenever its code changes the output, so cached
+# results of the old code are no longer used
+_STAGE_VERSIONS = {
+    'batch_correction': 2,
+    'preprocess_genes': 2,
+    'normalize': 2
+}
+
+
+def _run_variant(suffix):
+    # Runs in a forked worker, or in process without fork
+    _VARIANTS[suffix].run()
 
 
 class GexPreprocessor():
@@ -15,24 +55,93 @@ class GexPreprocessor():
                  batches_file=None,
                  ref_data_dir=None,
                  ref_genome='Homo_sapiens.GRCh38.103',
-                 tmp_dir='/tmp'):
+                 tmp_dir='/tmp',
+                 normalizer='numpy',
+                 keep_intermediates=False,
+                 batch_corrector='r',
+                 n_jobs=None,
+                 output_format='csv',
+                 float32=False,
+                 sparse=False,
+                 int32=False,
+                 memory_budget=None,
+                 cache_dir=None,
+                 cache_max_bytes=10 * 1024**3,
+                 force_stage=None,
+                 reference=None,
+                 diagnostics=False,
+                 signature_file=None,
+                 n_variant_workers=None,
+                 profile=False):
+
+        # Kept to set up one GexPreprocessor per batch correction variant
+        self._args = {'prefix': prefix,
+                      'input_file': input_file,
+                      'output_dir': output_dir,
+                      'gene_format': gene_format,
+                      'sample_col_regex': sample_col_regex,
+                      'batches_file': batches_file,
+                      'ref_data_dir': ref_data_dir,
+                      'ref_genome': ref_genome,
+                      'tmp_dir': tmp_dir,
+                      'normalizer': normalizer,
+                      'keep_intermediates': keep_intermediates,
+                      'batch_corrector': batch_corrector,
+                      'n_jobs': n_jobs,
+                      'output_format': output_format,
+                      'float32': float32,
+                      'sparse': sparse,
+                      'int32': int32,
+                      'memory_budget': memory_budget,
+                      'cache_dir': cache_dir,
+                      'cache_max_bytes': cache_max_bytes,
+                      'force_stage': force_stage,
+                      'reference': reference,
+                      'diagnostics': diagnostics,
+                      'signature_file': signature_file,
+                      'n_variant_workers': n_variant_workers,
+                      'profile': profile}
+
+        # Matrices are written in output_format, optionally as float32
+        check_format(output_format)
+        self._output_format = output_format
+        self._float32 = float32
+
+        # Optionally keep counts as sparse CSR and/or int32 in memory
+        self._sparse = sparse
+        self._int32 = int32
 
         self._input_file = input_file
-        self._filtered_file_path = \
-            f'{output_dir}/{prefix}.tmp.counts.filtered.csv'
-        self._normalized_file_path = \
-            f'{output_dir}/{prefix}.tmp.counts.norm.csv'
-        self._normalized_file_path_no_log_transform = \
-            f'{output_dir}/{prefix}.tmp.counts.norm.nolog.csv'
-        self._output_file_path = f'{output_dir}/{prefix}.counts.allium.csv'
+        self._filtered_file_path = self._matrix_path(
+            f'{output_dir}/{prefix}.tmp.counts.filtered.csv')
+        self._normalized_file_path = self._matrix_path(
+            f'{output_dir}/{prefix}.tmp.counts.norm.csv')
+        self._normalized_file_path_no_log_transform = self._matrix_path(
+            f'{output_dir}/{prefix}.tmp.counts.norm.nolog.csv')
+        self._output_file_path = self._matrix_path(
+            f'{output_dir}/{prefix}.counts.allium.csv')
         self._missing_genes_path = f'{output_dir}/{prefix}.missing_genes.csv'
 
+        # Optional report of the ALLIUM signature genes the data is missing
+        self._signature_file = signature_file
+        self._signature_report_path = \
+            f'{output_dir}/{prefix}.signature_coverage.csv'
+
+        # Several batch definitions are each a variant, by output suffix.
+        # A variant's batches are a file, or a list of files whose batches
+        # are combined
+        self._variants = None
+        self._n_variant_workers = n_variant_workers
+        if isinstance(batches_file, dict):
+            self._variants = batches_file
+            batches_file = None
+
         # Optional batch correction
         self._batch_corrected_file_path = None
         self._batches_file_path = batches_file
         if self._batches_file_path:
-            self._batch_corrected_file_path = \
-                f'{output_dir}/{prefix}.tmp.counts.batch_corrected.csv'
+            self._batch_corrected_file_path = self._matrix_path(
+                f'{output_dir}/{prefix}.tmp.counts.batch_corrected.csv')
 
         # Throw exception if gene_format is not 'symbol' or 'ensembl'
         if gene_format not in ['symbol', 'ensembl']:
@@ -41,60 +150,538 @@ class GexPreprocessor():
         self._gene_format = gene_format
         self._sample_col_regex = sample_col_regex
 
+        # Throw exception if normalizer is not 'numpy' or 'edger'
+        if normalizer not in ['numpy', 'edger']:
+            raise ValueError(
+                'normalizer must be either "numpy" or "edger"')
+        self._normalizer = normalizer
+
+        # Throw exception if batch_corrector is not 'r' or 'python'
+        if batch_corrector not in ['r', 'python']:
+            raise ValueError(
+                'batch_corrector must be either "r" or "python"')
+        self._batch_corrector = batch_corrector
+        self._n_jobs = n_jobs
+
+        # Intermediate matrices are only written to file on request
+        self._keep_intermediates = keep_intermediates
+
+        # Optional cache of stage outputs, keyed on everything they depend on
+        self._cache = None
+        if cache_dir:
+            self._cache = StageCache(cache_dir, cache_max_bytes)
+
+        # Throw exception if force_stage is not a known stage
+        if force_stage and force_stage not in STAGES:
+            raise ValueError(
+                f'force_stage must be one of {", ".join(STAGES)}')
+        self._force_stage = force_stage
+
+        # With a memory budget, the cohort is streamed through in chunks
+        self._memory_budget = memory_budget
+        if memory_budget:
+            if self._batches_file_path or self._variants:
+                raise ValueError(
+                    'Batch correction needs the full matrix in memory')
+            if normalizer != 'numpy' or keep_intermediates:
+                raise ValueError('memory_budget only supports the numpy '
+                                 'normalizer without intermediates')
+            if output_format != 'csv' or detect_format(input_file) != 'csv':
+                raise ValueError('memory_budget needs CSV input and output')
+
+        # Optional before and after batch correction diagnostics, computed
+        # from the matrices while they are in memory
+        self._diagnostics = diagnostics
+        self._prefix = prefix
+        self._output_dir = output_dir
+        if diagnostics and not (self._batches_file_path or self._variants):
+            raise ValueError('Batch diagnostics need a batches file')
+
         # If not ref data dir, use the local one
         if not ref_data_dir:
-            script_dir = os.path.dirname(os.path.abspath(__file__))
-            ref_data_dir = os.path.join(script_dir, '../../data/reference')
-        self._annot_file_path = os.path.join(
-            ref_data_dir, (f'{ref_genome}.allium.annotations.filtered.csv'))
+            ref_data_dir = default_ref_dir()
 
-        self._gt = GeneThesaurus(data_dir=tmp_dir)
+        # Look the genome up in the directory's registry of built references
+        self._annot_file_path = resolve_reference(ref_data_dir, ref_genome)
 
-    def run(self):
-        if self._batches_file_path:
-            self._batch_correction()
-        self._preprocess_genes()
-        self._normalize()
-        self._allium_format()
-        # self._cleanup()
+        # Gene translations are cached on disk, across datasets, and start
+        # from those precomputed for the reference when there are some
+        self._tmp_dir = tmp_dir
+        self._gt = TranslationCache(
+            data_dir=tmp_dir,
+            precomputed=translations_path(self._annot_file_path))
 
-    def _batch_correction(self):
-        print('Correcting batch effects...')
+        # Loaded on first use, from the binary index when there is one,
+        # unless the caller shares an already open ReferenceIndex
+        self._ref = reference
+        self._matcher = None
 
-        robjects.r('''
-        library(edgeR)
-        library(sva)
-
-        batch_correct <- function(gex_path, batches_path, output_path) {
-            x <- read.csv(gex_path, row.names = 1, header= TRUE, check.names = FALSE)
-            batches <- read.csv(batches_path, row.names = 1, header= TRUE, check.names = FALSE)
-            # Ensure 'batches' is ordered to match 'x'
-            batches <- batches[colnames(x), , drop = FALSE]
-            batch = batches$batch
-            correcteddata <- ComBat_seq(as.matrix(x), batch=batch)
-            write.csv(correcteddata, output_path)
-        }
-        ''')
+        # Set on the variants, which share the input and its gene keys
+        self._input_data = None
+        self._gene_keys = None
 
-        r_batch_correct = robjects.r['batch_correct']
-        r_batch_correct(self._input_file,
-                        self._batches_file_path,
-                        self._batch_corrected_file_path)
+        # Reference genes the data lacks, cached with the stage outputs
+        self._missing_genes = None
 
-    def _preprocess_genes(self):
-        print('Preprocessing genes...')
+        # Optional timing and resource use of every stage
+        self._profiler = StageProfiler(f'{prefix}.gex_preprocessor',
+                                       output_dir,
+                                       profile)
+
+    def run(self):
+        with self._profiler.stage('run'):
+            if self._memory_budget:
+                self._run_chunked()
+            elif self._variants:
+                self._run_variants()
+            else:
+                self._run_in_memory()
+
+    def _run_variants(self):
+        # Input and gene mapping are shared, batch correction onwards runs
+        # once per variant, the variants in parallel
+        with self._profiler.stage('read_input') as profiled:
+            data = self._read_input()
+            profiled.shape(data)
+        keys = self._gene_keys
+        if keys is None:
+            with self._profiler.stage('match_genes'):
+                keys = self._match_genes(data.index)
+
+        _VARIANTS.clear()
+        for suffix, batches in self._variants.items():
+            # Checked up front, so no variant runs with a sample missing
+            batches_file = self._variant_batches(suffix, batches)
+            self._read_batch(batches_file, data.columns)
+            variant = self._clone(
+                prefix=f'{self._prefix}.{suffix}',
+                batches_file=batches_file,
+                reference=self._ref)
+            variant._input_data = data
+            variant._gene_keys = keys
+            variant._matcher = self._matcher
+            _VARIANTS[suffix] = variant
+
+        # batch_runner imports this module, so its helpers are imported here
+        from .batch_runner import job_result, run_job, summarize_jobs
+
+        n_workers = min(self._n_variant_workers or os.cpu_count(),
+                        len(_VARIANTS))
+        print(f'Running {len(_VARIANTS)} batch correction variants on '
+              f'{n_workers} workers...')
+        results = {}
+        with self._profiler.stage('variants'):
+            if 'fork' in multiprocessing.get_all_start_methods() and \
+                    n_workers > 1:
+                with ProcessPoolExecutor(
+                        max_workers=n_workers,
+                        mp_context=multiprocessing.get_context('fork')) \
+                        as executor:
+                    futures = {executor.submit(run_job, _run_variant,
+                                               suffix): suffix
+                               for suffix in _VARIANTS}
+                    for future in as_completed(futures):
+                        suffix = futures[future]
+                        results[suffix] = job_result(future)
+                        print(f'Finished {suffix}: {results[suffix][0]}')
+            else:
+                # Without fork, the variants would each copy the input
+                for suffix in _VARIANTS:
+                    results[suffix] = run_job(_run_variant, suffix)
+        _VARIANTS.clear()
+
+        summarize_jobs(list(self._variants), results,
+                       column='Variant',
+                       jobs='batch correction variants')
+
+    def _clone(self, **overrides):
+        # A GexPreprocessor with the same arguments, except for overrides
+        return GexPreprocessor(**dict(self._args, **overrides))
+
+    def _variant_batches(self, suffix, batches):
+        if isinstance(batches, str):
+            return batches
+
+        # Combined covariates: a batch per combination of their batches.
+        # Samples missing from any file have no batch, which batch
+        # correction refuses
+        combined = pd.concat([pd.read_csv(path, index_col=0)['batch']
+                              .astype(str) for path in batches],
+                             axis=1, join='inner')
+        combined = combined.agg('+'.join, axis=1).rename('batch')
+        combined.index.name = 'id'
+        path = f'{self._output_dir}/{self._prefix}.{suffix}.batches.csv'
+        combined.to_csv(path)
+        return path
+
+    def _run_in_memory(self):
+        # Each stage takes and returns an in-memory matrix
+        stages = [('batch_correction', self._batch_correction),
+                  ('preprocess_genes', self._preprocess_genes),
+                  ('normalize', self._normalize)]
+        if not self._batches_file_path:
+            stages = stages[1:]
+        keys = self._stage_keys([name for name, _ in stages])
+
+        # Resume after the last stage with a cached output
+        data = None
+        cached = None
+        start = 0
+        for i in reversed(range(len(stages))):
+            cached = self._read_cache(keys[:i + 1])
+            if cached is not None:
+                print(f'Using cached {stages[i][0]} output...')
+                data, self._missing_genes = cached[-1]
+                start = i + 1
+                break
+        # With diagnostics, the input is read even when every stage is
+        # cached, so they always start from the raw matrix
+        diagnostics = self._batch_diagnostics()
+        if start == 0 or diagnostics:
+            with self._profiler.stage('read_input') as profiled:
+                raw = self._read_input()
+                profiled.shape(raw)
+            self._diagnose(diagnostics, 'input', raw)
+            if start == 0:
+                data = raw
+            del raw
+        if start > 0:
+            self._write_cached_outputs(
+                [name for name, _ in stages[:start]], cached, diagnostics)
+            del cached
+
+        for (name, stage), key in zip(stages[start:], keys[start:]):
+            with self._profiler.stage(name) as profiled:
+                profiled.shape(data)
+                data = stage(data)
+            self._dump_stage(name, data)
+            if key:
+                with self._profiler.stage('write_cache'):
+                    self._cache.put(key, (data, self._missing_genes))
+            self._diagnose(diagnostics, name, data)
+
+        normalized, _ = data
+        with self._profiler.stage('allium_format') as profiled:
+            profiled.shape(normalized)
+            self._allium_format(normalized)
+
+        if diagnostics:
+            with self._profiler.stage('write_diagnostics'):
+                diagnostics.write()
+
+    def _read_cache(self, keys):
+        # The intermediates of skipped stages are written from their cached
+        # outputs, so with intermediates every one of them has to be cached.
+        # Each output is read once, last first, and any miss is a miss for
+        # the stage, also when another process evicted it meanwhile
+        if not keys[-1]:
+            return None
+        if not self._keep_intermediates:
+            keys = keys[-1:]
+        outputs = []
+        for key in reversed(keys):
+            with self._profiler.stage('read_cache') as profiled:
+                output = self._cache.get(key)
+                if output is None:
+                    return None
+                profiled.shape(output[0])
+            outputs.insert(0, output)
+        return outputs
+
+    def _write_cached_outputs(self, names, outputs, diagnostics):
+        # The cache is shared across prefixes and output directories, so
+        # skipped stages still write the files and diagnostics computed ones
+        # would, from the outputs read from the cache
+        if self._missing_genes is not None:
+            self._write_missing_genes(self._missing_genes)
+        names = names[-len(outputs):]
+        for name, (output, _) in zip(names, outputs):
+            self._dump_stage(name, output)
+            self._diagnose(diagnostics, name, output, cached=True)
+
+    def _batch_diagnostics(self):
+        if not self._diagnostics:
+            return None
+
+        # Imported on use, as it brings in matplotlib and umap
+        from .batch_diagnostics import BatchDiagnostics
+        batches = pd.read_csv(self._batches_file_path, index_col=0)['batch']
+        return BatchDiagnostics(self._prefix,
+                                self._output_dir,
+                                batches)
+
+    def _diagnose(self, diagnostics, stage, data, cached=False):
+        if not diagnostics or stage not in _DIAGNOSED:
+            return
+        if isinstance(data, tuple):
+            # The log normalized matrix, which is what ALLIUM sees
+            data = data[0]
+        with self._profiler.stage('diagnostics') as profiled:
+            profiled.shape(data)
+            diagnostics.add(_DIAGNOSED[stage], data, cached=cached)
+
+    def _run_chunked(self):
+        # Counts are accumulated on disk, so only one chunk is in memory
+        with tempfile.TemporaryDirectory(dir=self._tmp_dir) as buffer_dir:
+            with self._profiler.stage('preprocess_genes') as profiled:
+                counts, case_columns = \
+                    self._preprocess_genes_chunked(buffer_dir)
+                profiled.shape(counts)
+            with self._profiler.stage('normalize') as profiled:
+                profiled.shape(counts)
+                self._normalize_chunked(counts, case_columns)
+
+    def _block_size(self, n):
+        # Rows or columns of n float64s that fit the budget, with headroom
+        # for the copies pandas and numpy make along the way
+        return max(1, self._memory_budget // (n * 8 * 4))
+
+    def _preprocess_genes_chunked(self, buffer_dir):
+        print('Preprocessing genes in chunks...')
+        ref = self._reference()
+        header = pd.read_csv(self._input_file, index_col=0, nrows=0).columns
+        case_columns = [col for col in header if
+                        re.match(self._sample_col_regex, col)]
 
-        input_file = self._input_file
-        if self._batch_corrected_file_path:
-            input_file = self._batch_corrected_file_path
+        # One row per reference gene, in the sorted order of the output
+        counts = None
+        matched = np.zeros(len(ref.ids), dtype=bool)
+        for chunk in pd.read_csv(self._input_file,
+                                 index_col=0,
+                                 chunksize=self._block_size(len(header))):
+            keys = self._match_genes(chunk.index)
+
+            # Just keep case cols and add duplicate keys together
+            summed = GeneMatcher.aggregate(chunk[case_columns], keys)
+            if summed.empty:
+                continue
+            values = summed.values
+            if counts is None or (
+                    np.issubdtype(counts.dtype, np.integer) and
+                    not np.issubdtype(values.dtype, np.integer)):
+                counts = self._counts_buffer(buffer_dir, counts,
+                                             (len(ref.ids), len(case_columns)),
+                                             values.dtype)
+
+            # Genes split across chunks add up like in a single pass
+            rows = np.searchsorted(ref.ids,
+                                   np.asarray(summed.index.values, dtype=str))
+            counts[rows] += values
+            matched[rows] = True
+
+        if counts is None:
+            counts = self._counts_buffer(buffer_dir, None,
+                                         (len(ref.ids), len(case_columns)),
+                                         np.int64)
+
+        self._write_missing_genes(ref.ids[~matched])
+        return counts, case_columns
+
+    def _write_missing_genes(self, missing):
+        # The reference genes the data lacks, which are zero filled
+        self._missing_genes = missing
+        pd.Series(missing, name='id').to_csv(self._missing_genes_path,
+                                             index=False)
+        if self._signature_file:
+            SignatureCoverage(self._signature_file).write_report(
+                missing, self._signature_report_path)
+
+    def _counts_buffer(self, buffer_dir, counts, shape, dtype):
+        # Integer counts stay integer, until a chunk brings in floats
+        dtype = np.int64 if np.issubdtype(dtype, np.integer) else np.float64
+        path = os.path.join(buffer_dir, f'counts.{np.dtype(dtype).name}')
+        buffer = np.memmap(path, dtype=dtype, mode='w+', shape=shape)
+        if counts is not None:
+            step = self._block_size(shape[1])
+            for start in range(0, shape[0], step):
+                buffer[start:start + step] = counts[start:start + step]
+        return buffer
+
+    def _normalize_chunked(self, counts, case_columns):
+        print('Normalizing data in chunks...')
+        ref = self._reference()
+        lengths = ref.lengths_for(ref.ids)
+
+        def read_block(block):
+            # Length normalization, one block of samples at a time
+            return counts[:, block].astype(np.float64) * 10**3 / \
+                lengths[:, None]
+
+        tmm = ChunkedTmmNormalizer(read_block, counts.shape,
+                                   self._block_size(counts.shape[0]))
+
+        # Each block of samples is a block of rows of the ALLIUM output
+        print('Formatting data for ALLIUM...')
+        ids = pd.Index(ref.ids.tolist())
+        with open(self._output_file_path, 'w') as f:
+            for block, normalized in tmm.cpm_blocks(log=True):
+                data = pd.DataFrame(normalized.T,
+                                    index=pd.Index(case_columns[block],
+                                                   name='id'),
+                                    columns=ids)
+                if self._float32:
+                    data = data.astype(np.float32)
+                data.to_csv(f, header=block.start == 0)
+
+    def _read_input(self):
+        if self._input_data is not None:
+            return self._input_data
+        if self._sparse:
+            return SparseCounts.read(self._input_file,
+                                     self._sample_col_regex,
+                                     self._int32)
+
+        data = read_matrix(self._input_file)
+        if self._int32:
+            # Narrow integer columns whose counts fit
+            int_cols = [col for col in data.select_dtypes('integer').columns
+                        if data[col].max() <= np.iinfo(np.int32).max]
+            data = data.astype({col: np.int32 for col in int_cols})
+        return data
+
+    def _stage_keys(self, names):
+        if not self._cache:
+            return [None] * len(names)
+
+        # Chain the keys, so each stage depends on everything before it
+        key = hash_parts('input', hash_file(self._input_file),
+                         self._sparse, self._int32)
+        annot_hash = hash_file(self._annot_file_path)
+        settings = {
+            'batch_correction': [hash_file(self._batches_file_path)
+                                 if self._batches_file_path else None,
+                                 self._batch_corrector],
+            'preprocess_genes': [annot_hash,
+                                 self._gene_format,
+                                 self._sample_col_regex,
+                                 self._gt.data_version()],
+            'normalize': [annot_hash, self._normalizer, self._float32]
+        }
+
+        keys = []
+        for name in names:
+            key = hash_parts(key, name, _STAGE_VERSIONS[name],
+                             *settings[name])
+
+            # Forcing a stage drops its output and the ones after it
+            if self._force_stage and \
+                    STAGES.index(name) >= STAGES.index(self._force_stage):
+                self._cache.invalidate(key)
+            keys.append(key)
+        return keys
+
+    def _matrix_path(self, path):
+        return with_format(path, self._output_format)
+
+    def _reference(self):
+        if self._ref is None:
+            with self._profiler.stage('load_reference'):
+                self._ref = ReferenceIndex.open(self._annot_file_path,
+                                                self._gt)
+        return self._ref
+
+    def _dump_stage(self, name, data):
+        # Intermediate matrices of a stage, computed or read from the cache
+        if name == 'batch_correction':
+            self._dump_intermediate(data, self._batch_corrected_file_path)
+        elif name == 'preprocess_genes':
+            self._dump_intermediate(data, self._filtered_file_path)
+        elif name == 'normalize':
+            normalized, normalized_no_log = data
+            self._dump_intermediate(normalized, self._normalized_file_path)
+            self._dump_intermediate(
+                normalized_no_log,
+                self._normalized_file_path_no_log_transform)
+
+    def _dump_intermediate(self, data, path):
+        if self._keep_intermediates:
+            with self._profiler.stage('write_intermediate') as profiled:
+                if isinstance(data, SparseCounts):
+                    data = data.to_frame()
+                profiled.shape(data)
+                write_matrix(data, path, self._float32)
+
+    @staticmethod
+    def _call_r(func_name, *args):
+        import rpy2.robjects as robjects
+        from rpy2.robjects import numpy2ri
+        from rpy2.robjects.conversion import localconverter
+
+        # Matrices and vectors cross into R through numpy conversion
+        with localconverter(robjects.default_converter + numpy2ri.converter):
+            return robjects.r[func_name](*args)
+
+    @staticmethod
+    def _r_vector(values):
+        values = np.asarray(values)
+        if values.dtype == object:
+            values = values.astype(str)
+        return values
+
+    @staticmethod
+    def _read_batch(path, samples):
+        # The batch of every sample, in order. A missing one would be
+        # corrected as a batch of its own
+        batch = pd.read_csv(path, index_col=0)['batch'].reindex(samples)
+        missing = batch.index[batch.isna()]
+        if len(missing):
+            raise ValueError(f'{len(missing)} samples have no batch in '
+                             f'{path}: {", ".join(map(str, missing))}')
+        return batch
+
+    def _batch_correction(self, data):
+        print('Correcting batch effects...')
 
-        # Load the data
-        data = pd.read_csv(input_file, index_col=0)
-        ref = pd.read_csv(self._annot_file_path)
+        # Ensure batches are ordered to match the data
+        batch = self._read_batch(self._batches_file_path, data.columns)
 
+        # ComBat-seq needs dense counts
+        values = data.matrix.toarray() if isinstance(data, SparseCounts) \
+            else data.values
+        if self._batch_corrector == 'python':
+            with self._profiler.stage('combat_seq'):
+                corrected = CombatSeq(n_jobs=self._n_jobs).run(values,
+                                                               batch.values)
+        else:
+            corrected = self._batch_correction_r(values, batch)
+
+        # ComBat-seq returns whole counts as doubles
+        corrected = np.asarray(corrected)
+        if np.all(np.mod(corrected, 1) == 0):
+            corrected = corrected.astype(np.int64)
+
+        sparse_input = isinstance(data, SparseCounts)
+        data = pd.DataFrame(corrected,
+                            index=data.index,
+                            columns=data.columns)
+        if sparse_input:
+            data = SparseCounts.from_frame(data, self._int32)
+        return data
+
+    def _batch_correction_r(self, values, batch):
+        # Only start an R interpreter for the stages that need one
+        with self._profiler.stage('r_setup'):
+            import rpy2.robjects as robjects
+
+            robjects.r('''
+            library(edgeR)
+            library(sva)
+
+            batch_correct <- function(x, batch) {
+                ComBat_seq(x, batch=batch)
+            }
+            ''')
+
+        with self._profiler.stage('combat_seq_r'):
+            return self._call_r('batch_correct',
+                                values,
+                                self._r_vector(batch.values))
+
+    def _match_genes(self, index):
+        # Reference key of every gene in index, None where there is none
         if self._gene_format == 'ensembl':
             # Get gene names from ensembl ids
-            translated_genes = self._gt.translate_genes(data.index.values,
+            translated_genes = self._gt.translate_genes(index.values,
                                                         source='ensembl_id',
                                                         target='symbol')
 
@@ -103,143 +690,175 @@ class GexPreprocessor():
                     return translated_genes[ensembl_name]
                 return ensembl_name
 
-            data['gene_name_std'] = data.index.map(_standardize_ensembl_name)
+            gene_name_std = index.map(_standardize_ensembl_name)
         else:
             # Code to use if index is in symbol format
             # Get all gene name values to update to the latest standard
-            updated_genes = self._gt.update_gene_symbols(data.index.values)
+            updated_genes = self._gt.update_gene_symbols(index.values)
 
-            # Copy data.index to gene_name_std
-            data['gene_name_std'] = data.index
+            # Copy index to gene_name_std
+            gene_name_std = pd.Series(index, index=index)
 
             # Update gene_name_std from updated_genes
-            data['gene_name_std'] = data['gene_name_std'].map(
-                updated_genes).fillna(data['gene_name_std'])
-
-        # Do the same for ref
-        updated_genes = self._gt.update_gene_symbols(ref['name'].values)
+            gene_name_std = gene_name_std.map(
+                updated_genes).fillna(gene_name_std)
 
-        # Set new column with the latest gene name
-        ref['gene_name_std'] = ref['name'].map(
-            updated_genes).fillna(ref['name'])
+        # Resolve every gene against hash indexes built on the reference
+        if self._matcher is None:
+            ref = self._reference()
+            self._matcher = GeneMatcher(ref.ids.tolist(),
+                                        symbol_to_id=ref.symbol_to_id())
+        return self._matcher.match(index.values, np.asarray(gene_name_std))
 
-        filtered_rows = {}
-        case_columns = [col for col in data.columns if
-                        re.match(self._sample_col_regex, col)]
-
-        def _find_ref_key(row):
-            if row.name in ref['id'].values:
-                return ref[ref['id'] == row.name]['id'].values[0]
-            if row['gene_name_std'] in ref['gene_name_std'].values:
-                ref_rows = ref[ref['gene_name_std'] == row['gene_name_std']]
-
-                if len(ref_rows) == 1:
-                    return ref_rows['id'].values[0]
-
-                # See if one of the rows also matches a ref id
-                for i, r in ref_rows.iterrows():
-                    if r['id'] in ref['id'].values:
-                        return r['id']
-
-                # Return the first row
-                return ref_rows['id'].values[0]
-
-        for i, row in data.iterrows():
-            # Strip whitespace
-            key = _find_ref_key(row)
-
-            # Print ref row length
-            if key is not None:
-                try:
-                    key = key.strip()
-                except Exception:
-                    print(f'Error: {key}')
-                    exit()
-
-                # Just keep case cols in row
-                row = row[case_columns]
-
-                # Is there already a row in filtered_rows?
-                if key in filtered_rows:
-                    filtered_rows[key] += row
-                else:
-                    filtered_rows[key] = row
-                # Keep the previous index name for the row
-                filtered_rows[key].name = key
+    def _preprocess_genes(self, data):
+        print('Preprocessing genes...')
 
-        data = pd.DataFrame(filtered_rows.values())
+        # Load the reference, its symbols already standardized
+        ref = self._reference()
+        keys = self._gene_keys
+        if keys is None:
+            with self._profiler.stage('match_genes'):
+                keys = self._match_genes(data.index)
+
+        case_positions = [i for i, col in enumerate(data.columns) if
+                          re.match(self._sample_col_regex, col)]
+        case_columns = data.columns[case_positions].tolist()
+
+        # Just keep case cols and add duplicate keys together
+        sparse_input = isinstance(data, SparseCounts)
+        if sparse_input:
+            matrix, index = GeneMatcher.aggregate_sparse(
+                data.matrix[:, case_positions], keys)
+        else:
+            data = GeneMatcher.aggregate(data.iloc[:, case_positions], keys)
+            index = data.index
 
         # Print records in ref.id that are not in data.id
-        missing = ref[~ref['id'].isin(data.index)]
+        # As numpy strings, as pandas string arrays make isin quadratic
+        matched = np.asarray(index.values, dtype=str)
+        missing = ref.ids[~np.isin(ref.ids, matched)]
+
+        self._write_missing_genes(missing)
 
         # Create records for all missing genes in data, filled with 0s
         # The missing$id is the index value, and all the case columns are 0
-        missing_data = pd.DataFrame(index=missing['id'],
+        missing_data = pd.DataFrame(index=pd.Index(missing.tolist()),
                                     columns=case_columns,
                                     data=0)
 
-        # Dump missing data to file
-        missing_data.to_csv(self._missing_genes_path)
-
-        # Remove index name
-        missing_data.index.name = None
-
-        # Append the missing data to the data
-        data = pd.concat([data, missing_data])
-
-        # Sort data by index
-        data = data.sort_index()
+        if sparse_input:
+            # Missing genes are empty rows, then sort by index
+            matrix = sparse.vstack([
+                matrix,
+                sparse.csr_matrix((len(missing), len(case_columns)),
+                                  dtype=matrix.dtype)], format='csr')
+            index = index.append(missing_data.index)
+            order = np.argsort(np.asarray(index.values, dtype=str),
+                               kind='stable')
+            data = SparseCounts(matrix[order], index[order], case_columns)
+        else:
+            # Append the missing data to the data
+            data = pd.concat([data, missing_data])
 
-        # Dump data to file
-        data.to_csv(self._filtered_file_path)
+            # Sort data by index
+            data = data.sort_index()
+        return data
 
-    def _normalize(self):
+    def _normalize(self, data):
         print('Normalizing data...')
 
-        robjects.r('''
-        library(edgeR)
-        library(sva)
-
-        # create a function `get_cpm`
-        normalize <- function(gex_path, ref_path, output_path, do_log=TRUE) {
-            x <- read.csv(gex_path, row.names = 1, header= TRUE, check.names = FALSE)
-            annot <- read.csv(ref_path, row.names = 1, header= TRUE, check.names = FALSE)
+        # Length normalization
+        lengths = self._reference().lengths_for(data.index.values)
 
-            x_length_norm <- ( (x*10^3 )/annot$length)
-            d <- DGEList(counts=x_length_norm)
-            TMM <- calcNormFactors(d, method="TMM")
-            CPM <- cpm(TMM, log = do_log)
-            write.csv(CPM, output_path)
-        }
-        ''')
+        if isinstance(data, SparseCounts):
+            return self._normalize_sparse(data, lengths)
 
-        r_normalize = robjects.r['normalize']
-        r_normalize(self._filtered_file_path,
-                    self._annot_file_path,
-                    self._normalized_file_path)
+        if self._normalizer == 'edger':
+            normalized, normalized_no_log = \
+                self._normalize_edger(data, lengths)
+        else:
+            # In floats, so int32 counts can't overflow
+            x_length_norm = data.values.astype(np.float64) * 10**3 / \
+                lengths[:, None]
+
+            # TMM factors are shared by the log and non-log outputs
+            tmm = TmmNormalizer(x_length_norm)
+            normalized = tmm.cpm(log=True)
+            normalized_no_log = tmm.cpm(log=False)
+
+        normalized = pd.DataFrame(normalized,
+                                  index=data.index,
+                                  columns=data.columns)
         # Get a non-log-transformed version for scree plots
-        r_normalize(self._filtered_file_path,
-                    self._annot_file_path,
-                    self._normalized_file_path_no_log_transform,
-                    False)
-
-    def _allium_format(self):
+        normalized_no_log = pd.DataFrame(normalized_no_log,
+                                         index=data.index,
+                                         columns=data.columns)
+        return normalized, normalized_no_log
+
+    def _normalize_sparse(self, data, lengths):
+        if self._normalizer == 'edger':
+            # edgeR gets dense counts, like any other input
+            normalized, normalized_no_log = \
+                self._normalize_edger(data.to_frame(), lengths)
+            normalized_no_log = sparse.csr_matrix(normalized_no_log)
+        else:
+            # Every entry of a gene without a length would be NA
+            if np.isnan(lengths).any():
+                raise ValueError('NA counts not permitted')
+
+            # Length normalize the stored values only, zeros stay zero
+            x = data.matrix
+            rows = np.repeat(np.arange(x.shape[0]), np.diff(x.indptr))
+            x_length_norm = sparse.csr_matrix(
+                (x.data.astype(np.float64) * 10**3 / lengths[rows],
+                 x.indices, x.indptr), shape=x.shape)
+
+            # Log CPM is dense by nature, so compute it in the output dtype
+            dtype = np.float32 if self._float32 else np.float64
+            tmm = TmmNormalizer(x_length_norm)
+            normalized = tmm.cpm(log=True, dtype=dtype)
+            normalized_no_log = tmm.cpm(log=False, dtype=dtype)
+
+        normalized = pd.DataFrame(normalized,
+                                  index=data.index,
+                                  columns=data.columns)
+        # Get a non-log-transformed version for scree plots
+        normalized_no_log = SparseCounts(normalized_no_log,
+                                         data.index,
+                                         data.columns)
+        return normalized, normalized_no_log
+
+    def _normalize_edger(self, data, lengths):
+        with self._profiler.stage('r_setup'):
+            import rpy2.robjects as robjects
+
+            robjects.r('''
+            library(edgeR)
+            library(sva)
+
+            # create a function `get_cpm`
+            normalize <- function(x, lengths, do_log=TRUE) {
+                x_length_norm <- ( (x*10^3 )/lengths)
+                d <- DGEList(counts=x_length_norm)
+                TMM <- calcNormFactors(d, method="TMM")
+                CPM <- cpm(TMM, log = do_log)
+                CPM
+            }
+            ''')
+
+        with self._profiler.stage('edger'):
+            x = data.values.astype(np.float64)
+            normalized = self._call_r('normalize', x, lengths)
+            normalized_no_log = self._call_r('normalize', x, lengths, False)
+        return np.asarray(normalized), np.asarray(normalized_no_log)
+
+    def _allium_format(self, data):
         print('Formatting data for ALLIUM...')
 
-        # Load the data
-        data = pd.read_csv(self._normalized_file_path, index_col=0)
-
         # Format
         data = data.T
         data.index.name = 'id'
         data.columns.name = None
 
         # Dump to file
-        data.to_csv(self._output_file_path)
-
-    def _cleanup(self):
-        os.remove(self._filtered_file_path)
-        os.remove(self._normalized_file_path)
-        if self._batch_corrected_file_path:
-            os.remove(self._batch_corrected_file_path)
-        print('Done!')
+        write_matrix(data, self._output_file_path, self._float32)
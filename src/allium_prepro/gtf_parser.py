@@ -0,0 +1,134 @@
+import gzip
+
+# Columns of the full annotations file
+ANNOTATION_COLUMNS = ['id', 'chr', 'name', 'biotype', 'length']
+
+
+def _r_split(text, separator):
+    # Like R's strsplit(fixed=TRUE): no pieces for an empty string, and a
+    # separator at the very end doesn't produce an empty last piece
+    if text == '':
+        return []
+    if text.endswith(separator):
+        text = text[:-len(separator)]
+    return text.split(separator)
+
+
+def _attribute_field(attributes, field):
+    # Like ballgown's getAttributeField: the second space separated token
+    # of the first "; " separated attribute named field
+    for attribute in _r_split(attributes, '; '):
+        tokens = _r_split(attribute, ' ')
+        if tokens and tokens[0] == field:
+            return tokens[1] if len(tokens) > 1 else None
+    return None
+
+
+def _strip_quotes(value):
+    return None if value is None else value.replace('"', '')
+
+
+def _merge_intervals(intervals):
+    # Union of closed intervals, as sorted non-overlapping intervals
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return merged
+
+
+class GtfParser():
+    # Streams a (gzipped) GTF once, collecting gene records and the length
+    # of the union of each gene's exons
+    def __init__(self, gtf_file_path):
+        self._gtf_file_path = gtf_file_path
+
+    def _open(self):
+        if self._gtf_file_path.endswith('.gz'):
+            return gzip.open(self._gtf_file_path, 'rt')
+        return open(self._gtf_file_path, 'r')
+
+    def parse(self):
+        genes = []
+        exons = {}
+
+        # Exons of a gene are usually contiguous, so merge each run of them
+        # as soon as the next gene starts to keep the interval lists short
+        pending_key = None
+        pending = []
+
+        def flush():
+            if pending:
+                exons[pending_key] = _merge_intervals(
+                    exons.get(pending_key, []) + pending)
+
+        with self._open() as f:
+            for line in f:
+                # Comments run to the end of the line
+                line = line.rstrip('\n').split('#', 1)[0]
+                if not line:
+                    continue
+                fields = line.split('\t')
+                seqname, feature = fields[0], fields[2]
+                attributes = fields[8]
+
+                if feature == 'gene':
+                    gene_id = _attribute_field(attributes, 'gene_id')
+                    name = _attribute_field(attributes, 'gene_name')
+                    biotype = _attribute_field(attributes, 'gene_biotype')
+                    if biotype is not None:
+                        # Strip trailing semicolons from the biotype
+                        biotype = _strip_quotes(biotype)
+                        if biotype.endswith(';'):
+                            biotype = biotype[:-1]
+                    genes.append([_strip_quotes(gene_id),
+                                  seqname.replace('"', ''),
+                                  _strip_quotes(name),
+                                  biotype])
+                elif feature == 'exon':
+                    gene_id = _strip_quotes(
+                        _attribute_field(attributes, 'gene_id'))
+                    key = (gene_id, seqname)
+                    if key != pending_key:
+                        flush()
+                        pending_key = key
+                        pending = []
+                    # As lists, like the merged intervals they join
+                    pending.append([int(fields[3]), int(fields[4])])
+            flush()
+
+        # Genes spanning several chromosomes add up their lengths
+        lengths = {}
+        for (gene_id, _), intervals in exons.items():
+            length = sum(end - start + 1 for start, end in intervals)
+            lengths[gene_id] = lengths.get(gene_id, 0) + length
+
+        return self._merge(genes, lengths)
+
+    @staticmethod
+    def _merge(genes, lengths):
+        # Outer join of gene records and lengths on the gene id
+        rows = []
+        seen = set()
+        for gene_id, chr, name, biotype in genes:
+            seen.add(gene_id)
+            rows.append([gene_id, chr, name, biotype, lengths.get(gene_id)])
+        for gene_id in lengths.keys() - seen:
+            rows.append([gene_id, None, None, None, lengths[gene_id]])
+
+        # Sort by id, genes without one go last
+        rows.sort(key=lambda row: (row[0] is None, row[0] or ''))
+        return rows
+
+    def write_annotations(self, output_file_path):
+        rows = self.parse()
+
+        # Written like R's write.table(quote=FALSE), with NA for missing
+        with open(output_file_path, 'w') as f:
+            f.write(','.join(ANNOTATION_COLUMNS) + '\n')
+            for row in rows:
+                f.write(','.join('NA' if value is None else str(value)
+                                 for value in row) + '\n')
@@ -1,5 +1,7 @@
+import numpy as np
 import pandas as pd
 import re
+from .profiling import StageProfiler
 from .subtype_thesaurus import SubtypeThesaurus
 
 
@@ -8,16 +10,19 @@ class JudePhenotypeParser:
     SUBTYPE_PRIMARY = 1
     SUBTYPE_SECONDARY = 2
     SUBTYPE_LEVEL_DELIMITER = ','
+    DIAGNOSIS_PATTERN = \
+        r'^Lineage:(.*?),Primary_subtype:(.*?)(?:,Secondary_subtype:(.*))?$'
 
     def __init__(self,
                  prefix,
                  pheno_tsv,
-                 output_dir):
+                 output_dir,
+                 profile=False):
         self._prefix = prefix
         self._pheno_tsv = pheno_tsv
         self._output_dir = output_dir
         self._output_file_path_pheno = f'{output_dir}/{prefix}.pheno.allium.csv'
-        self._subtype_thesaurus = SubtypeThesaurus()
+        self._subtype_thesaurus = SubtypeThesaurus.shared()
 
         # Track unknown subtypes
         self.unknown_primary_subtypes = {}
@@ -26,13 +31,15 @@ class JudePhenotypeParser:
         # Keep the underlying dataframe
         self.df = None
 
+        # Optional timing and resource use of every stage
+        self._profiler = StageProfiler(f'{prefix}.jude_phenotype_parser',
+                                       output_dir,
+                                       profile)
+
     @staticmethod
     def split_attr_diagnosis(s):
-        # Define the regular expression pattern
-        pattern = r'Lineage:(.*?),Primary_subtype:(.*?)(?:,Secondary_subtype:(.*))?$'
-
         # Use re.match() to apply the pattern
-        match = re.match(pattern, s)
+        match = re.match(JudePhenotypeParser.DIAGNOSIS_PATTERN, s)
 
         # Extract the groups from the match object
         lineage = match.group(1)
@@ -43,38 +50,56 @@ class JudePhenotypeParser:
         return lineage, primary_subtype, secondary_subtype
 
     def alliumify_subtype(self, s, level=SUBTYPE_PRIMARY):
+        translation, unknown = self._resolve_subtype(s, level)
+        self._count_unknown(unknown, level)
+        return translation
+
+    def _resolve_subtype(self, s, level):
+        # Like alliumify_subtype, but returns the unknown subtype to count
+        # instead of counting it
+
         # If level is SUBTYPE_PRIMARY and s is empty string, return "B-other"
         if level == JudePhenotypeParser.SUBTYPE_PRIMARY and s == '':
-            return 'B-other'
+            return 'B-other', None
 
         # Strip trailing ?s
         s = s.rstrip('?')
 
         # If subtype is recognized, return it
         if self._subtype_thesaurus.is_allium_subtype(s):
-            return s
+            return s, None
 
         # For secondary subtypes, return empty string if s is empty
         if s == '':
-            return ''
+            return '', None
 
         # Get translation
         translation = self._subtype_thesaurus.translate(s)
 
         if translation.startswith('UNRECOGNIZED_SUBTYPE'):
-            if level == JudePhenotypeParser.SUBTYPE_PRIMARY:
-                self.unknown_primary_subtypes[s] = \
-                    self.unknown_primary_subtypes.get(s, 0) + 1
-            elif level == JudePhenotypeParser.SUBTYPE_SECONDARY and s != '':
-                self.unknown_secondary_subtypes[s] = \
-                    self.unknown_secondary_subtypes.get(s, 0) + 1
-
-        return translation
+            return translation, s
+        return translation, None
+
+    def _count_unknown(self, s, level, n=1):
+        if s is None:
+            return
+        if level == JudePhenotypeParser.SUBTYPE_PRIMARY:
+            self.unknown_primary_subtypes[s] = \
+                self.unknown_primary_subtypes.get(s, 0) + n
+        elif level == JudePhenotypeParser.SUBTYPE_SECONDARY:
+            self.unknown_secondary_subtypes[s] = \
+                self.unknown_secondary_subtypes.get(s, 0) + n
 
     def parse(self):
+        with self._profiler.stage('parse'):
+            self._parse()
+
+    def _parse(self):
         print("Parsing St. Jude phenotype data...")
 
-        df = pd.read_csv(self._pheno_tsv, delimiter='\t')
+        with self._profiler.stage('read') as profiled:
+            df = pd.read_csv(self._pheno_tsv, delimiter='\t')
+            profiled.shape(df)
 
         # Drop AML cases
         df = df[df['attr_diagnosis'] != 'AML']
@@ -90,26 +115,9 @@ class JudePhenotypeParser:
         # Rename sample_name to id
         df = df.rename(columns={'sample_name': 'id'})
 
-        for index, row in df.iterrows():
-            lineage, primary_subtype, secondary_subtype = \
-                JudePhenotypeParser.split_attr_diagnosis(row['attr_diagnosis'])
-
-            # ALLIUM only has one T-ALL subtype
-            if lineage == 'T':
-                primary_subtype = 'T-ALL'
-
-            # Standardize to ALLIUM conventions
-            primary_subtype = self.alliumify_subtype(
-                primary_subtype, level=self.SUBTYPE_PRIMARY)
-            secondary_subtype = self.alliumify_subtype(
-                secondary_subtype, level=self.SUBTYPE_SECONDARY)
-
-            # Remove empty strings, sort and join
-            final_subtype = self.SUBTYPE_LEVEL_DELIMITER.join(sorted([
-                x for x in [primary_subtype, secondary_subtype] if x != '']))
-
-            # Write final_subtype to 'subtype' column
-            df.at[index, 'subtype'] = final_subtype
+        with self._profiler.stage('subtypes') as profiled:
+            profiled.shape(df)
+            df['subtype'] = self._subtypes(df['attr_diagnosis'])
 
         # Keep batches df
         self.batches_df = df[['id'] + batch_cols]
@@ -124,16 +132,52 @@ class JudePhenotypeParser:
         self.save_summary()
         self.print_summary()
 
-        self.df.to_csv(self._output_file_path_pheno, sep=';', index=False)
+        with self._profiler.stage('write'):
+            self.df.to_csv(self._output_file_path_pheno, sep=';', index=False)
+
+            for col in batch_cols:
+                filename = f'{self._output_dir}/{self._prefix}.batches.{col}.allium.csv'
+                batch_df = self.batches_df[['id', col]]
+                # Rename col to batch
+                batch_df = batch_df.rename(columns={col: 'batch'})
+                batch_df.to_csv(filename,
+                                sep=',',
+                                index=False)
+
+    def _subtypes(self, diagnoses):
+        # Split every diagnosis at once
+        parts = diagnoses.str.extract(self.DIAGNOSIS_PATTERN)
+        parts.columns = ['lineage', 'primary', 'secondary']
+        unparsed = parts['lineage'].isna()
+        if unparsed.any():
+            raise ValueError(
+                f'Unrecognized attr_diagnosis: '
+                f'{", ".join(diagnoses[unparsed].astype(str).unique())}')
+        parts = parts.fillna('')
+
+        # ALLIUM only has one T-ALL subtype
+        parts.loc[parts['lineage'] == 'T', 'primary'] = 'T-ALL'
+
+        # The distinct subtype pairs are few, so standardize each one once,
+        # in order of appearance, and count unknowns once per case
+        groups = parts.groupby(['primary', 'secondary'], sort=False)
+        final_subtypes = []
+        for (primary_subtype, secondary_subtype), n in groups.size().items():
+            # Standardize to ALLIUM conventions
+            primary_subtype, unknown_primary = self._resolve_subtype(
+                primary_subtype, self.SUBTYPE_PRIMARY)
+            secondary_subtype, unknown_secondary = self._resolve_subtype(
+                secondary_subtype, self.SUBTYPE_SECONDARY)
+            self._count_unknown(unknown_primary, self.SUBTYPE_PRIMARY, n)
+            self._count_unknown(unknown_secondary, self.SUBTYPE_SECONDARY, n)
+
+            # Remove empty strings, sort and join
+            final_subtypes.append(self.SUBTYPE_LEVEL_DELIMITER.join(sorted([
+                x for x in [primary_subtype, secondary_subtype] if x != ''])))
 
-        for col in batch_cols:
-            filename = f'{self._output_dir}/{self._prefix}.batches.{col}.allium.csv'
-            batch_df = self.batches_df[['id', col]]
-            # Rename col to batch
-            batch_df = batch_df.rename(columns={col: 'batch'})
-            batch_df.to_csv(filename,
-                            sep=',',
-                            index=False)
+        # Map each case back to its pair's subtype
+        return pd.Series(np.array(final_subtypes, dtype=object)[
+            groups.ngroup().values], index=diagnoses.index)
 
     def save_summary(self):
         with open(f'{self._output_dir}/{self._prefix}.pheno_summary.txt', 'w') as f:
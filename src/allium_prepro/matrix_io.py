@@ -0,0 +1,78 @@
+import os
+import numpy as np
+import pandas as pd
+
+# Supported matrix formats and their file extensions
+FORMATS = {
+    'csv': '.csv',
+    'parquet': '.parquet',
+    'feather': '.feather',
+    'npz': '.npz'
+}
+
+# Feather files can't store an index, so it's kept as a named column
+_FEATHER_INDEX = '__index__'
+
+
+def check_format(output_format):
+    # Throw exception if output_format is not supported
+    if output_format not in FORMATS:
+        raise ValueError(
+            f'output_format must be one of {", ".join(FORMATS)}')
+
+
+def with_format(path, output_format):
+    # Swap the extension of a matrix path for the one of output_format
+    check_format(output_format)
+    root, _ = os.path.splitext(path)
+    return root + FORMATS[output_format]
+
+
+def detect_format(path):
+    _, ext = os.path.splitext(path)
+    for output_format, format_ext in FORMATS.items():
+        if ext == format_ext:
+            return output_format
+    # Anything else is treated as text, like the original CSV files
+    return 'csv'
+
+
+def write_matrix(data, path, float32=False):
+    if float32:
+        float_cols = data.select_dtypes(include='float').columns
+        data = data.astype({col: np.float32 for col in float_cols})
+
+    output_format = detect_format(path)
+    if output_format == 'parquet':
+        data.to_parquet(path)
+    elif output_format == 'feather':
+        index_name = data.index.name or _FEATHER_INDEX
+        data.rename_axis(index_name).reset_index().to_feather(path)
+    elif output_format == 'npz':
+        np.savez(path,
+                 values=data.values,
+                 index=np.asarray(data.index, dtype=str),
+                 columns=np.asarray(data.columns, dtype=str),
+                 index_name=np.array(data.index.name or ''))
+    else:
+        data.to_csv(path)
+
+
+def read_matrix(path, **kwargs):
+    input_format = detect_format(path)
+    if input_format == 'parquet':
+        return pd.read_parquet(path)
+    if input_format == 'feather':
+        data = pd.read_feather(path)
+        data = data.set_index(data.columns[0])
+        if data.index.name == _FEATHER_INDEX:
+            data.index.name = None
+        return data
+    if input_format == 'npz':
+        with np.load(path) as npz:
+            data = pd.DataFrame(npz['values'],
+                                index=npz['index'],
+                                columns=npz['columns'])
+            data.index.name = str(npz['index_name']) or None
+        return data
+    return pd.read_csv(path, index_col=0, **kwargs)
@@ -0,0 +1,129 @@
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+# Set to 1 to profile every run, or to "trace" to also write a trace
+PROFILE_ENV = 'ALLIUM_PROFILE'
+
+
+def _cpu_time():
+    # Worker processes are included once they have exited
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def _peak_rss():
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _io_bytes():
+    # Bytes through read and write calls of this process, including cached
+    # reads, where the OS reports them
+    try:
+        with open('/proc/self/io', 'r') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+        return int(fields['rchar']), int(fields['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+class _Stage():
+    def __init__(self, record=None):
+        self._record = record
+
+    def shape(self, data):
+        # Rows and columns of the matrix the stage works on. Stages that
+        # return several matrices report the first
+        if self._record is None:
+            return
+        if isinstance(data, tuple):
+            data = data[0]
+        if hasattr(data, 'shape') and len(data.shape) == 2:
+            self._record['rows'], self._record['cols'] = \
+                (int(n) for n in data.shape)
+
+
+class StageProfiler():
+    # Wall time, CPU time, peak RSS, matrix shape and I/O of nested stages.
+    # Written to {output_dir}/{name}.profile.json when the outermost stage
+    # ends, and with profile='trace' also as a Chrome trace, which
+    # chrome://tracing, Perfetto and speedscope show as a flame chart
+    def __init__(self, name, output_dir, profile=False):
+        if not profile:
+            profile = os.environ.get(PROFILE_ENV, '').lower()
+            if profile in ['', '0', 'false']:
+                profile = False
+        self.enabled = bool(profile)
+        self._trace = profile == 'trace'
+        self._name = name
+        self._output_dir = output_dir
+        self._records = []
+        self._depth = 0
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield _Stage()
+            return
+
+        record = {'name': name, 'depth': self._depth}
+        read_start, write_start = _io_bytes()
+        peak_start = _peak_rss()
+        cpu_start = _cpu_time()
+        start = time.time()
+        self._depth += 1
+        try:
+            yield _Stage(record)
+        finally:
+            self._depth -= 1
+            record['start'] = start
+            record['wall_s'] = time.time() - start
+            record['cpu_s'] = _cpu_time() - cpu_start
+
+            # The process peak so far, and how far this stage raised it
+            record['peak_rss_bytes'] = _peak_rss()
+            record['peak_rss_increase_bytes'] = \
+                record['peak_rss_bytes'] - peak_start
+            read_end, write_end = _io_bytes()
+            if read_start is not None:
+                record['read_bytes'] = read_end - read_start
+                record['write_bytes'] = write_end - write_start
+            self._records.append(record)
+            if self._depth == 0:
+                self._write()
+
+    def _write(self):
+        # Stages end inner first, so sort them back into start order
+        records = sorted(self._records,
+                         key=lambda r: (r['start'], r['depth']))
+        self._records = []
+
+        path = os.path.join(self._output_dir, f'{self._name}.profile.json')
+        with open(path, 'w') as f:
+            json.dump({'name': self._name,
+                       'pid': os.getpid(),
+                       'stages': records}, f, indent=1)
+        print(f'Wrote profile to {path}')
+
+        if self._trace:
+            # Complete events, in microseconds
+            events = [{'name': r['name'],
+                       'ph': 'X',
+                       'ts': int(r['start'] * 1e6),
+                       'dur': int(r['wall_s'] * 1e6),
+                       'pid': os.getpid(),
+                       'tid': 0,
+                       'args': {key: value for key, value in r.items()
+                                if key not in ['name', 'start', 'wall_s']}}
+                      for r in records]
+            path = os.path.join(self._output_dir,
+                                f'{self._name}.profile.trace.json')
+            with open(path, 'w') as f:
+                json.dump({'traceEvents': events,
+                           'displayTimeUnit': 'ms'}, f)
+            print(f'Wrote trace to {path}')
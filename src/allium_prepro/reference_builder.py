@@ -0,0 +1,102 @@
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from .reference_preprocessor import ReferencePreprocessor, default_ref_dir
+from .file_lock import file_lock
+
+# Lists every reference built into a reference directory
+REGISTRY_FILENAME = 'references.json'
+
+
+def load_registry(ref_dir):
+    path = os.path.join(ref_dir, REGISTRY_FILENAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def resolve_reference(ref_dir, ref_genome):
+    # Path of the filtered annotations for ref_genome, from the registry if
+    # it lists the genome, else by the usual file naming
+    entry = load_registry(ref_dir).get(ref_genome)
+    if entry:
+        return os.path.join(ref_dir, entry['filtered'])
+    return os.path.join(
+        ref_dir, f'{ref_genome}.allium.annotations.filtered.csv')
+
+
+def _build(genome_version, gtf_file, kwargs):
+    # Runs in a worker process
+    preprocessor = ReferencePreprocessor(genome_version=genome_version,
+                                         gtf_file=gtf_file,
+                                         **kwargs)
+    preprocessor.run()
+    return preprocessor.genome_version(), preprocessor.outputs()
+
+
+class ReferenceBuilder():
+    # Builds several references concurrently, from Ensembl releases and/or
+    # local GTF files, and registers them in the reference directory
+    def __init__(self,
+                 genomes,
+                 ref_dir=None,
+                 species='Homo_sapiens',
+                 assembly='GRCh38',
+                 n_jobs=None,
+                 **kwargs):
+        self._ref_dir = ref_dir or default_ref_dir()
+        self._n_jobs = n_jobs or os.cpu_count()
+        self._kwargs = dict(kwargs, ref_dir=self._ref_dir)
+
+        # Bare release numbers are expanded with species and assembly
+        self._jobs = []
+        for genome in genomes:
+            genome = str(genome)
+            if genome.isdigit():
+                self._jobs.append((f'{species}.{assembly}.{genome}', None))
+            elif genome.endswith(('.gtf', '.gtf.gz')):
+                self._jobs.append((None, genome))
+            else:
+                self._jobs.append((genome, None))
+
+    def run(self):
+        print(f'Building {len(self._jobs)} references...')
+        start = time.time()
+        built = {}
+        failed = {}
+        with ProcessPoolExecutor(max_workers=self._n_jobs) as executor:
+            futures = {executor.submit(_build, genome_version, gtf_file,
+                                       self._kwargs):
+                       genome_version or gtf_file
+                       for genome_version, gtf_file in self._jobs}
+            for future, name in futures.items():
+                try:
+                    genome_version, outputs = future.result()
+                    built[genome_version] = outputs
+                except Exception as e:
+                    failed[name] = e
+
+        self._register(built)
+        print(f'Built {len(built)} references in '
+              f'{time.time() - start:.1f}s')
+        if failed:
+            for name, e in failed.items():
+                print(f'Failed to build {name}: {e}')
+            raise RuntimeError(
+                f'Failed to build {len(failed)} of {len(self._jobs)} '
+                f'references')
+        return built
+
+    def _register(self, built):
+        # Merge into the registry, keeping references built earlier or by
+        # builders running at the same time
+        path = os.path.join(self._ref_dir, REGISTRY_FILENAME)
+        with file_lock(f'{path}.lock'):
+            registry = load_registry(self._ref_dir)
+            registry.update(built)
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(registry, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, path)
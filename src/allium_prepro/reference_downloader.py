@@ -0,0 +1,222 @@
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from .file_lock import file_lock
+from .stage_cache import hash_file
+
+# Bytes checked for carries at a time, about twice the typical gap between
+# carries in compressed data
+_SUM_WINDOW = 1024
+
+
+def _bsd_sum_step(checksum, byte):
+    # Rotate the 16 bit checksum right by one, then add the byte
+    return ((checksum >> 1) + ((checksum & 1) << 15) + byte) & 0xffff
+
+
+def _bsd_sum_chunk(chunk, checksum):
+    # Rotating 16 bits right by one is halving modulo 65535, so without
+    # carries out of 16 bits the checksum after byte j is 2^-j times the
+    # cumulative sum of every byte i times 2^i. Windows of those are checked
+    # for the first step that carries, or that ends on 65535 rather than 0,
+    # which is redone exactly before moving on
+    b = np.frombuffer(chunk, dtype=np.uint8).astype(np.int64)
+    n = len(b)
+    exponents = np.arange(n + 1) % 16
+    rotations = np.left_shift(1, 16 - exponents)
+    sums = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(b << exponents[1:], out=sums[1:])
+    sums %= 65535
+
+    pos = 0
+    while pos < n:
+        if checksum == 0xffff:
+            # Same as 0 modulo 65535, but rotates differently
+            checksum = _bsd_sum_step(checksum, int(b[pos]))
+            pos += 1
+            continue
+        end = min(pos + _SUM_WINDOW, n)
+        base = (checksum << int(exponents[pos])) % 65535 - int(sums[pos])
+
+        # Each step's rotated checksum plus its byte
+        steps = (base + sums[pos:end]) % 65535 * \
+            rotations[pos + 1:end + 1] % 65535 + b[pos:end]
+        k = int(np.argmax(steps >= 0xffff))
+        if steps[k] < 0xffff:
+            checksum = int((base + sums[end]) % 65535 * rotations[end] %
+                           65535)
+            pos = end
+        else:
+            checksum = int(steps[k]) & 0xffff
+            pos += k + 1
+    return checksum
+
+
+def bsd_sum(path):
+    # The checksum of BSD `sum`, which Ensembl lists in its CHECKSUMS files
+    checksum = 0
+    size = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            size += len(chunk)
+            checksum = _bsd_sum_chunk(chunk, checksum)
+    # Second field is the size in 1 KiB blocks, rounded up
+    return checksum, (size + 1023) // 1024
+
+
+class ReferenceDownloader():
+    # Resumable downloads, in parallel byte ranges where the server allows,
+    # kept in a content addressed store so a URL is only fetched once
+    def __init__(self,
+                 store_dir,
+                 n_connections=4,
+                 min_range_size=8 * 1024**2,
+                 retries=3,
+                 timeout=(10, 60)):
+        self._store_dir = store_dir
+        self._index_path = os.path.join(store_dir, 'index.json')
+        self._n_connections = n_connections
+        self._min_range_size = min_range_size
+        self._retries = retries
+        self._timeout = timeout
+        os.makedirs(os.path.join(store_dir, 'objects'), exist_ok=True)
+        os.makedirs(os.path.join(store_dir, 'partial'), exist_ok=True)
+
+    def _load_index(self):
+        if not os.path.exists(self._index_path):
+            return {}
+        with open(self._index_path, 'r') as f:
+            return json.load(f)
+
+    def _save_index(self, index):
+        tmp_path = f'{self._index_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f, indent=1)
+        os.replace(tmp_path, self._index_path)
+
+    def _object_path(self, digest, filename):
+        return os.path.join(self._store_dir, 'objects', digest, filename)
+
+    def fetch(self, url, checksums_url=None):
+        filename = url.rsplit('/', 1)[-1]
+
+        # Stored files are never downloaded again
+        entry = self._load_index().get(url)
+        if entry:
+            path = self._object_path(entry['sha256'], filename)
+            if os.path.exists(path):
+                print(f'{filename} already downloaded to {path}.')
+                return path
+
+        print(f'Downloading {url}...')
+        part_path = self._download(url)
+        if checksums_url:
+            self._verify(part_path, filename, checksums_url)
+
+        # Move into the store under its content hash
+        digest = hash_file(part_path)
+        path = self._object_path(digest, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(part_path, path)
+
+        # Under a lock, so concurrent builds sharing the store keep each
+        # other's entries
+        with file_lock(f'{self._index_path}.lock'):
+            index = self._load_index()
+            index[url] = {'sha256': digest, 'size': os.path.getsize(path)}
+            self._save_index(index)
+        print(f'Downloaded {filename} to {path}')
+        return path
+
+    def _download(self, url):
+        # Partial downloads are kept per URL, so they can be resumed
+        part_dir = os.path.join(self._store_dir, 'partial',
+                                hashlib.sha256(url.encode()).hexdigest())
+        part_path = f'{part_dir}.part'
+
+        head = requests.head(url, allow_redirects=True,
+                             timeout=self._timeout)
+        head.raise_for_status()
+        size = int(head.headers.get('Content-Length', 0))
+        if head.headers.get('Accept-Ranges') != 'bytes' or not size:
+            # No ranges, so no resuming either
+            self._fetch_whole(url, part_path)
+            return part_path
+
+        # Pieces of a different remote file can't be resumed
+        size_path = os.path.join(part_dir, 'size')
+        if os.path.exists(size_path):
+            with open(size_path, 'r') as f:
+                if int(f.read()) != size:
+                    shutil.rmtree(part_dir)
+        os.makedirs(part_dir, exist_ok=True)
+        with open(size_path, 'w') as f:
+            f.write(str(size))
+
+        # Split into ranges, each fetched into its own piece
+        n_ranges = max(1, min(self._n_connections,
+                              size // self._min_range_size))
+        ranges = [(os.path.join(part_dir, f'{i}'),
+                   i * size // n_ranges,
+                   (i + 1) * size // n_ranges - 1)
+                  for i in range(n_ranges)]
+        with ThreadPoolExecutor(max_workers=n_ranges) as executor:
+            list(executor.map(lambda r: self._fetch_range(url, *r), ranges))
+
+        # Join the pieces
+        with open(part_path, 'wb') as out:
+            for piece_path, _, _ in ranges:
+                with open(piece_path, 'rb') as piece:
+                    shutil.copyfileobj(piece, out)
+        shutil.rmtree(part_dir)
+        return part_path
+
+    def _fetch_whole(self, url, path):
+        response = requests.get(url, stream=True, timeout=self._timeout)
+        response.raise_for_status()
+        with open(path, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=1 << 16):
+                f.write(chunk)
+
+    def _fetch_range(self, url, path, start, end):
+        for attempt in range(self._retries + 1):
+            # Continue from whatever an earlier attempt or run left behind
+            have = os.path.getsize(path) if os.path.exists(path) else 0
+            if have == end - start + 1:
+                return
+            headers = {'Range': f'bytes={start + have}-{end}'}
+            try:
+                response = requests.get(url, headers=headers, stream=True,
+                                        timeout=self._timeout)
+                response.raise_for_status()
+                if response.status_code != 206:
+                    raise ValueError(f'{url} ignored the requested range')
+                with open(path, 'ab') as f:
+                    for chunk in response.iter_content(chunk_size=1 << 16):
+                        f.write(chunk)
+            except requests.RequestException:
+                if attempt == self._retries:
+                    raise
+        if os.path.getsize(path) != end - start + 1:
+            raise ValueError(f'Incomplete download of {url}')
+
+    def _verify(self, path, filename, checksums_url):
+        response = requests.get(checksums_url, timeout=self._timeout)
+        response.raise_for_status()
+
+        # Lines look like "62305 51744 Homo_sapiens.GRCh38.103.gtf.gz"
+        expected = None
+        for line in response.text.splitlines():
+            fields = line.split()
+            if len(fields) == 3 and fields[2] == filename:
+                expected = (int(fields[0]), int(fields[1]))
+        if expected is None:
+            raise ValueError(f'{filename} is not listed in {checksums_url}')
+
+        if bsd_sum(path) != expected:
+            os.remove(path)
+            raise ValueError(f'Checksum mismatch for {filename}')
@@ -0,0 +1,135 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+from .stage_cache import hash_file
+
+# Bump when the layout of the index directory changes
+INDEX_VERSION = 2
+
+_ARRAYS = ['ids', 'names', 'symbols', 'lengths', 'positions',
+           'symbol_keys', 'symbol_offsets', 'symbol_rows']
+
+
+def index_path(annot_file_path):
+    # X.allium.annotations.filtered.csv -> X.allium.annotations.filtered.index
+    root, _ = os.path.splitext(annot_file_path)
+    return f'{root}.index'
+
+
+def _to_strings(values):
+    # Fixed width strings can be memory mapped, so missing values become ''
+    values = pd.Series(values, dtype=object)
+    return np.asarray(values.fillna('').astype(str).values, dtype=str)
+
+
+def _to_objects(values):
+    values = np.asarray(values, dtype=object)
+    values[values == ''] = np.nan
+    return values
+
+
+class ReferenceIndex():
+    # Reference ids, raw and standardized symbols, gene lengths, CSV row
+    # positions and a symbol -> ids multimap, as flat arrays sorted by id
+    def __init__(self, arrays, meta):
+        self._arrays = arrays
+        self.meta = meta
+        self.ids = arrays['ids']
+        self.lengths = arrays['lengths']
+
+    @classmethod
+    def from_csv(cls, annot_file_path, gt):
+        annot = pd.read_csv(annot_file_path)
+        meta = {'version': INDEX_VERSION,
+                'checksum': hash_file(annot_file_path),
+                'hgnc_version': gt.data_version()}
+
+        # Keep the original row order for ties within the same id
+        positions = np.argsort(annot['id'].values, kind='stable')
+        annot = annot.iloc[positions]
+        names = annot['name'].values
+        arrays = {'ids': _to_strings(annot['id'].values),
+                  'names': _to_strings(names),
+                  'lengths': annot['length'].values.astype(np.float64),
+                  'positions': positions.astype(np.int64)}
+        arrays.update(cls._symbol_arrays(names, positions, gt))
+        return cls(arrays, meta)
+
+    @staticmethod
+    def _symbol_arrays(names, positions, gt):
+        # Update reference symbols to the latest standard
+        updated_genes = gt.update_gene_symbols(names)
+        symbols = pd.Series(names, dtype=object)
+        symbols = symbols.map(updated_genes).fillna(symbols).values
+        symbols = _to_strings(symbols)
+
+        # Group rows by symbol, keeping CSV order within a symbol
+        rows = np.flatnonzero(symbols != '')
+        rows = rows[np.lexsort((positions[rows], symbols[rows]))]
+        keys, starts = np.unique(symbols[rows], return_index=True)
+        offsets = np.append(starts, len(rows)).astype(np.int64)
+        return {'symbols': symbols,
+                'symbol_keys': keys,
+                'symbol_offsets': offsets,
+                'symbol_rows': rows.astype(np.int32)}
+
+    @classmethod
+    def open(cls, annot_file_path, gt):
+        # Use the index when it matches the CSV, else fall back to the CSV
+        path = index_path(annot_file_path)
+        meta_path = os.path.join(path, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            if meta.get('version') == INDEX_VERSION and \
+                    meta.get('checksum') == hash_file(annot_file_path):
+                return cls.load(path, gt)
+            print(f'Ignoring outdated reference index {path}')
+        return cls.from_csv(annot_file_path, gt)
+
+    @classmethod
+    def load(cls, path, gt=None):
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+
+        # Memory map, so jobs on the same node share the pages
+        arrays = {name: np.load(os.path.join(path, f'{name}.npy'),
+                                mmap_mode='r')
+                  for name in _ARRAYS}
+
+        # Symbols standardized against other HGNC data are redone
+        if gt is not None and meta['hgnc_version'] != gt.data_version():
+            names = _to_objects(arrays['names'])
+            arrays.update(cls._symbol_arrays(names, arrays['positions'],
+                                             gt))
+            meta = dict(meta, hgnc_version=gt.data_version())
+        return cls(arrays, meta)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for name in _ARRAYS:
+            np.save(os.path.join(path, f'{name}.npy'), self._arrays[name])
+
+        # Written last, so a half written index is never picked up
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f, indent=1)
+
+    def symbols(self):
+        return _to_objects(self._arrays['symbols'])
+
+    def symbol_to_id(self):
+        # The reference id first in the CSV for each standardized symbol
+        first_rows = self._arrays['symbol_rows'][
+            self._arrays['symbol_offsets'][:-1]]
+        return dict(zip(self._arrays['symbol_keys'].tolist(),
+                        self.ids[first_rows].tolist()))
+
+    def lengths_for(self, ids):
+        # Binary search the sorted ids, missing ones get NaN
+        ids = np.asarray(ids, dtype=str)
+        if len(self.ids) == 0:
+            return np.full(len(ids), np.nan)
+        pos = np.minimum(np.searchsorted(self.ids, ids), len(self.ids) - 1)
+        found = self.ids[pos] == ids
+        return np.where(found, self.lengths[pos], np.nan)
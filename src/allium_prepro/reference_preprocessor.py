@@ -1,19 +1,56 @@
 import os
-import requests
 import pandas as pd
-import rpy2.robjects as robjects
+from .gtf_parser import GtfParser
+from .profiling import StageProfiler
+from .reference_downloader import ReferenceDownloader
+from .reference_index import ReferenceIndex, index_path
+from .translation_cache import TranslationCache, translations_path
+
+
+def default_ref_dir():
+    # The reference data bundled with the repository
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(script_dir, '../../data/reference')
+
+
+def parse_genome_version(genome_version):
+    # Homo_sapiens.GRCh38.103 -> ('homo_sapiens', 'GRCh38', '103')
+    parts = genome_version.split('.')
+    if len(parts) < 3 or not parts[-1].isdigit():
+        raise ValueError(
+            f'genome_version must look like Species.Assembly.Release, '
+            f'got "{genome_version}"')
+    return parts[0].lower(), '.'.join(parts[1:-1]), parts[-1]
 
 
 class ReferencePreprocessor():
     def __init__(self,
-                 genome_version='Homo_sapiens.GRCh38.103'):
+                 genome_version='Homo_sapiens.GRCh38.103',
+                 tmp_dir='/tmp',
+                 base_url='http://ftp.ensembl.org/pub',
+                 gtf_store_dir=None,
+                 gtf_file=None,
+                 ref_dir=None,
+                 profile=False):
+        # A local GTF is used as is, and names the reference by default
+        self._gtf_file = gtf_file
+        if gtf_file and genome_version is None:
+            genome_version = os.path.basename(gtf_file)
+            for ext in ['.gz', '.gtf']:
+                if genome_version.endswith(ext):
+                    genome_version = genome_version[:-len(ext)]
         self._genome_version = genome_version
+        self._tmp_dir = tmp_dir
+        self._base_url = base_url.rstrip('/')
 
         # Ensure the ref directory exists
-        self._ref_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
-                                     '../data/reference')
+        self._ref_dir = ref_dir or default_ref_dir()
         os.makedirs(self._ref_dir, exist_ok=True)
 
+        # Downloaded GTFs are kept, so switching releases never refetches
+        self._gtf_store_dir = gtf_store_dir or \
+            os.path.join(self._ref_dir, 'gtf_store')
+
         # Set filenames
         self._annot_file_full = \
             os.path.join(self._ref_dir,
@@ -22,99 +59,59 @@ class ReferencePreprocessor():
             os.path.join(self._ref_dir,
                          f'{genome_version}.allium.annotations.filtered.csv')
 
-    def run(self):
-        self._download_ref()
-        self._parse_gtf()
-        self._filter()
-        self._cleanup()
+        # Optional timing and resource use of every stage
+        self._profiler = StageProfiler(
+            f'{genome_version}.reference_preprocessor', self._ref_dir, profile)
 
-    def _download_ref(self):
-        REFERENCE_GENOME = f'{self._genome_version}.gtf.gz'
-        REFERENCE_GENOME_URL = f'http://ftp.ensembl.org/pub/release-103/gtf/homo_sapiens/{REFERENCE_GENOME}'
+    def run(self):
+        with self._profiler.stage('run'):
+            for name, stage in [('download', self._download_ref),
+                                ('parse_gtf', self._parse_gtf),
+                                ('filter', self._filter),
+                                ('build_index', self._build_index),
+                                ('translations', self._translations)]:
+                with self._profiler.stage(name):
+                    stage()
+        print("Done.")
 
-        # If reference file already exists, say so and exit
-        self._gtf_file_path = os.path.join(self._ref_dir, REFERENCE_GENOME)
+    def genome_version(self):
+        return self._genome_version
+
+    def outputs(self):
+        # What a run produces, as recorded in the reference registry
+        return {'full': os.path.basename(self._annot_file_full),
+                'filtered': os.path.basename(self._annot_file_filtered),
+                'index': os.path.basename(
+                    index_path(self._annot_file_filtered)),
+                'translations': os.path.basename(
+                    translations_path(self._annot_file_filtered)),
+                'source': self._gtf_file or self._gtf_url()}
+
+    def _gtf_url(self):
+        # Ensembl keeps every release under the same layout
+        species, _, release = parse_genome_version(self._genome_version)
+        return f'{self._base_url}/release-{release}/gtf/{species}/' \
+            f'{self._genome_version}.gtf.gz'
 
-        if os.path.exists(self._gtf_file_path):
-            print(f"{REFERENCE_GENOME} already exists at {self._gtf_file_path}. Done.")
+    def _download_ref(self):
+        if self._gtf_file:
+            self._gtf_file_path = self._gtf_file
             return
 
-        print(f"Downloading reference from {REFERENCE_GENOME_URL} to {self._ref_dir}...")
-        # Download the file
-        response = requests.get(REFERENCE_GENOME_URL, stream=True)
-        response.raise_for_status()  # Check if the request was successful
+        REFERENCE_GENOME_URL = self._gtf_url()
+        REFERENCE_GENOME_DIR = REFERENCE_GENOME_URL.rsplit('/', 1)[0]
 
-        # Save the file to the specified directory
-        with open(self._gtf_file_path, 'wb') as file:
-            for chunk in response.iter_content(chunk_size=8192):
-                file.write(chunk)
-
-        print(f"Downloaded {REFERENCE_GENOME}.gz to {self._gtf_file_path}")
+        # Resumes partial downloads and checks against Ensembl's CHECKSUMS
+        downloader = ReferenceDownloader(self._gtf_store_dir)
+        self._gtf_file_path = downloader.fetch(
+            REFERENCE_GENOME_URL,
+            checksums_url=f'{REFERENCE_GENOME_DIR}/CHECKSUMS')
 
     def _parse_gtf(self):
         print('Parsing GTF...')
 
-        robjects.r('''
-            library(Rsubread)
-            library(sva)
-            library(ballgown)
-
-            parse_gtf <- function(gtf_file_path, output_file_path) {
-                SAF <- Rsubread::flattenGTF(gtf_file_path)
-                GeneLength <- rowsum(SAF$End-SAF$Start+1, SAF$GeneID)
-                annot <- gffRead(gtf_file_path)
-
-                # Retrieve the attributes
-                annot$gene_id = getAttributeField(annot$attributes,
-                    field = "gene_id")
-
-                annot$gene_name = getAttributeField(annot$attributes,
-                    field = "gene_name")
-
-                annot$gene_biotype = getAttributeField(annot$attributes,
-                    field = "gene_biotype")
-
-                tokeep <- c("seqname", "feature", "gene_id", "gene_name", "gene_biotype")
-                annot_filtered <- annot[tokeep]
-
-                # Remove quotes
-                annot_filtered[] <- lapply(annot_filtered, gsub, pattern='"', replacement='')
-
-                # Keep only genes
-                annot_filtered <- annot_filtered[annot_filtered$feature == 'gene', ]
-
-                # Convert gene lengths to dataframe
-                gene_lengths <- as.data.frame(GeneLength)
-                gene_lengths$gene_id <- rownames(GeneLength)
-
-                # Reorder columns to have gene_id as the first column
-                gene_lengths <- gene_lengths[, c("gene_id", names(gene_lengths)[-ncol(gene_lengths)])]
-
-                # Name the columns
-                colnames(gene_lengths) <- c("gene_id", "gene_length")
-
-                # Join DataFrames on 'gene_id' column
-                full_annot <- merge(annot_filtered, gene_lengths, by = "gene_id", all = TRUE)
-
-                # Rename columns
-                colnames(full_annot) <- c("id", "chr", "feature", "name", "biotype", "length")
-
-                # Drop feature column
-                full_annot$feature <- NULL
-
-                # Strip trailing semicolons from the biotype column
-                full_annot$biotype <- sub(";$", "", full_annot$biotype)
-
-                # Sort annotations by id
-                full_annot <- full_annot[order(full_annot$id), ]
-
-                # Write processed metadata
-                write.table(full_annot, output_file_path, col.names = TRUE, row.names = FALSE, sep = ',', quote = FALSE)
-            }
-        ''')
-
-        r_parse_gtf = robjects.r['parse_gtf']
-        r_parse_gtf(self._gtf_file_path, self._annot_file_full)
+        # Gene records and union exon lengths, in one pass over the GTF
+        GtfParser(self._gtf_file_path).write_annotations(self._annot_file_full)
         print(f"Created {self._annot_file_full}")
 
     def _filter(self):
@@ -138,8 +135,15 @@ class ReferencePreprocessor():
         # Write the filtered DataFrame to a CSV file
         filtered_annot.to_csv(self._annot_file_filtered, index=False)
 
-    def _cleanup(self):
-        print("Cleaning up...")
-        # Remove the original GTF file
-        os.remove(self._gtf_file_path)
-        print("Done.")
+    def _build_index(self):
+        # Binary index that GexPreprocessor memory maps instead of the CSV
+        path = index_path(self._annot_file_filtered)
+        print(f'Building reference index {path}...')
+        gt = TranslationCache(data_dir=self._tmp_dir)
+        ReferenceIndex.from_csv(self._annot_file_filtered, gt).save(path)
+
+    def _translations(self):
+        # Gene lookups of the reference, so that GexPreprocessor runs
+        # against the same HGNC data start with them
+        TranslationCache(data_dir=self._tmp_dir).precompute(
+            self._annot_file_filtered)
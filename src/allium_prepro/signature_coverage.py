@@ -0,0 +1,89 @@
+import numpy as np
+import pandas as pd
+
+# Columns of ALLIUM's signature gene tables
+ID_COL = 'Gene ID'
+IMPORTANCE_COL = 'feature_importance_mean'
+
+
+def read_missing_genes(path):
+    # Ids of the reference genes a dataset lacked, as GexPreprocessor writes
+    # them. Older files are zero matrices, which have the ids as index too
+    return pd.read_csv(path, index_col=0, usecols=[0]).index
+
+
+class SignatureCoverage():
+    # Which of ALLIUM's signature genes datasets are missing, ranked by
+    # feature importance, as missing genes are zero filled before prediction
+    def __init__(self, signature_file):
+        signatures = pd.read_csv(signature_file, index_col=0)
+        absent = [col for col in [ID_COL, IMPORTANCE_COL]
+                  if col not in signatures.columns]
+        if absent:
+            raise ValueError(f'{signature_file} has no '
+                             f'{" or ".join(absent)} column')
+        self._signatures = signatures.sort_values(IMPORTANCE_COL,
+                                                  ascending=False,
+                                                  kind='stable')
+
+        # A gene in several signatures counts by its total importance
+        self._importance = self._signatures \
+            .groupby(ID_COL, sort=False)[IMPORTANCE_COL].sum()
+
+    def report(self, missing_ids):
+        # Every signature row, most important first, flagged if missing
+        report = self._signatures.copy()
+        report['missing'] = report[ID_COL].isin(missing_ids)
+        return report
+
+    def coverage(self, missing_ids):
+        missing = self._importance.index.isin(missing_ids)
+        return {'signature_genes': len(self._importance),
+                'missing_genes': int(missing.sum()),
+                'missing_importance': float(
+                    self._importance[missing].sum() /
+                    self._importance.sum())}
+
+    def write_report(self, missing_ids, path):
+        report = self.report(missing_ids)
+        report.to_csv(path)
+        coverage = self.coverage(missing_ids)
+        print(f'{coverage["missing_genes"]} of '
+              f'{coverage["signature_genes"]} signature genes are missing, '
+              f'with {coverage["missing_importance"]:.1%} of the feature '
+              f'importance. Wrote report to {path}')
+        return report
+
+    def summarize(self, missing_genes):
+        # missing_genes maps a dataset name to its missing gene ids. All
+        # datasets are matched against the signatures at once
+        names = list(missing_genes)
+        ids = np.concatenate([np.asarray(missing_genes[name], dtype=str)
+                              for name in names])
+        datasets = np.repeat(names, [len(missing_genes[name])
+                                     for name in names])
+        in_signature = np.isin(ids, self._importance.index.values)
+        missing = pd.crosstab(pd.Index(ids[in_signature], name=ID_COL),
+                              pd.Index(datasets[in_signature],
+                                       name='dataset')) > 0
+
+        flags = missing.reindex(index=self._importance.index,
+                                columns=names,
+                                fill_value=False)
+        flags.columns.name = None
+
+        # Signature genes by importance, with where they are missing
+        genes = flags[flags.any(axis=1)].copy()
+        genes.insert(0, IMPORTANCE_COL, self._importance)
+        genes.insert(1, 'missing_in', flags.sum(axis=1))
+        genes = genes.sort_values(IMPORTANCE_COL, ascending=False,
+                                  kind='stable')
+
+        # And one row of coverage per dataset
+        importance = self._importance.values
+        datasets = pd.DataFrame({
+            'signature_genes': len(importance),
+            'missing_genes': flags.sum(axis=0),
+            'missing_importance': importance @ flags.values /
+            importance.sum()}, index=pd.Index(names, name='dataset'))
+        return genes, datasets
@@ -0,0 +1,63 @@
+import re
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from .matrix_io import detect_format, read_matrix
+
+INT32_MAX = np.iinfo(np.int32).max
+
+
+def _narrow(matrix, int32):
+    # Whole counts fit int32 far more often than not
+    if int32 and np.issubdtype(matrix.dtype, np.integer) and \
+            (matrix.nnz == 0 or matrix.data.max() <= INT32_MAX):
+        return matrix.astype(np.int32)
+    return matrix
+
+
+class SparseCounts():
+    # Genes x samples counts as a CSR matrix, with the labels of a DataFrame
+    def __init__(self, matrix, index, columns):
+        self.matrix = sparse.csr_matrix(matrix)
+        self.index = pd.Index(index)
+        self.columns = pd.Index(columns)
+
+    @classmethod
+    def from_frame(cls, data, int32=False):
+        matrix = _narrow(sparse.csr_matrix(data.values), int32)
+        return cls(matrix, data.index, data.columns)
+
+    @classmethod
+    def read(cls, path, sample_col_regex, int32=False, chunksize=5000):
+        # Only sample columns are kept, as the rest can't be stored sparse
+        if detect_format(path) != 'csv':
+            data = read_matrix(path)
+            columns = [col for col in data.columns
+                       if re.match(sample_col_regex, col)]
+            return cls.from_frame(data[columns], int32)
+
+        # Stream CSVs in blocks of genes, so the dense matrix never exists
+        header = pd.read_csv(path, index_col=0, nrows=0).columns
+        columns = [col for col in header if re.match(sample_col_regex, col)]
+        blocks = []
+        index = []
+        for chunk in pd.read_csv(path, index_col=0, chunksize=chunksize,
+                                 usecols=lambda col: col not in header or
+                                 col in columns):
+            chunk = chunk[columns]
+            blocks.append(_narrow(sparse.csr_matrix(chunk.values), int32))
+            index.append(chunk.index)
+        matrix = sparse.vstack(blocks, format='csr') if blocks else \
+            sparse.csr_matrix((0, len(columns)))
+        index = index[0].append(index[1:]) if index else pd.Index([])
+        return cls(_narrow(matrix, int32), index, columns)
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    def to_frame(self):
+        # Dense, for the algorithms and file formats that need it
+        return pd.DataFrame(self.matrix.toarray(),
+                            index=self.index,
+                            columns=self.columns)
@@ -0,0 +1,88 @@
+import hashlib
+import json
+import os
+import pickle
+
+
+def hash_file(path):
+    # Hash file content in chunks, so large matrices don't need to fit
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_parts(*parts):
+    # Key anything JSON serializable, e.g. a parent key and some settings
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+
+class StageCache():
+    # Pickled stage outputs stored under their key, evicted least recently
+    # used first once the directory grows past max_bytes
+    def __init__(self, cache_dir, max_bytes=10 * 1024**3):
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self._cache_dir, f'{key}.pkl')
+
+    def get(self, key):
+        # None on a miss, so an entry another process evicts between a
+        # check and a read can't fail the read
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return None
+
+        # Touch the entry, so eviction sees it as recently used
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return value
+
+    def put(self, key, value):
+        # Write to a temporary file first, so readers never see half a pickle
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        self._evict(keep=path)
+
+    def invalidate(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self, keep=None):
+        entries = []
+        for filename in os.listdir(self._cache_dir):
+            if not filename.endswith('.pkl'):
+                continue
+            path = os.path.join(self._cache_dir, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        # Remove the oldest entries until the cache fits, but never the
+        # entry that was just written
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self._max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -1,59 +1,119 @@
-import yaml
+import functools
+import json
 import os
+import types
+import numpy as np
+import pandas as pd
+import yaml
+from .stage_cache import hash_file
+
+_PACKAGE_DIR = os.path.dirname(os.path.realpath(__file__))
+SUBTYPES_YML = os.path.join(_PACKAGE_DIR, 'subtypes.yml')
+
+# Optional precompiled form of the YAML, used while the YAML is unchanged
+COMPILED_JSON = os.path.join(_PACKAGE_DIR, 'subtypes.compiled.json')
+
+
+def _parse_yml(yml_path):
+    with open(yml_path, 'r') as f:
+        subtypes = yaml.safe_load(f)['subtypes']
+
+    # Every id and alias maps to its id, later entries winning
+    aliases = {}
+    for subtype in subtypes:
+        aliases[subtype['id']] = subtype['id']
+        for alias in subtype.get('aliases', []):
+            aliases[alias] = subtype['id']
+    return {'subtypes': [subtype['id'] for subtype in subtypes],
+            'groups': list(dict.fromkeys(subtype['parent_id']
+                                         for subtype in subtypes
+                                         if 'parent_id' in subtype)),
+            'aliases': aliases}
+
+
+@functools.lru_cache(maxsize=None)
+def _load_tables(yml_path, compiled_path):
+    # Loaded once per process, from the compiled JSON if it was compiled
+    # from this very YAML
+    tables = None
+    if os.path.exists(compiled_path):
+        with open(compiled_path, 'r') as f:
+            compiled = json.load(f)
+        if compiled.get('source_sha256') == hash_file(yml_path):
+            tables = compiled
+    if tables is None:
+        tables = _parse_yml(yml_path)
+
+    groups = frozenset(tables['groups'])
+    return types.SimpleNamespace(
+        ordered_subtypes=tuple(tables['subtypes']),
+        subtypes=frozenset(tables['subtypes']),
+        leaf_subtypes=tuple(subtype for subtype in tables['subtypes']
+                            if subtype not in groups),
+        aliases=dict(tables['aliases']))
 
 
 class SubtypeThesaurus():
+    _shared = None
+
     def __init__(self):
-        self._dict = {}
-        self._allium_subtypes = []
-        self._allium_groups = []
-        # Get current path
-        current_path = os.path.dirname(os.path.realpath(__file__))
-        CONSTANTS_YML = f'{current_path}/subtypes.yml'
-        # Load subtype mapping
-        with open(CONSTANTS_YML, 'r') as f:
-            constants = yaml.safe_load(f)
-            subtypes = constants['subtypes']
-            # Loop through subtypes
-            for subtype in subtypes:
-                self._allium_subtypes.append(subtype['id'])
-                if 'parent_id' in subtype:
-                    self._allium_groups.append(subtype['parent_id'])
-                self._dict[subtype['id']] = subtype['id']
-                if 'aliases' in subtype:
-                    for alias in subtype['aliases']:
-                        self._dict[alias] = subtype['id']
-            # Dedupe groups
-            self._allium_groups = list(set(self._allium_groups))
+        # Tables are compiled once and shared by every instance
+        self._tables = _load_tables(SUBTYPES_YML, COMPILED_JSON)
+        self._dict = self._tables.aliases
+
+    @classmethod
+    def shared(cls):
+        # One instance for the whole process
+        if cls._shared is None:
+            cls._shared = cls()
+        return cls._shared
+
+    @staticmethod
+    def compile(compiled_path=COMPILED_JSON):
+        # Precompile the YAML to JSON, which loads without PyYAML's parser
+        tables = _parse_yml(SUBTYPES_YML)
+        tables['source_sha256'] = hash_file(SUBTYPES_YML)
+        with open(compiled_path, 'w') as f:
+            json.dump(tables, f, indent=1)
+        return compiled_path
 
     def is_allium_subtype(self, s):
-        return s in self._allium_subtypes
+        return s in self._tables.subtypes
 
     def allium_subtypes(self, include_groups=False):
         if include_groups:
-            return self._allium_subtypes
+            return list(self._tables.ordered_subtypes)
         # Return subtypes that are not also in groups
-        return list(set(self._allium_subtypes) - set(self._allium_groups))
+        return list(self._tables.leaf_subtypes)
 
     def translate(self, s):
         s = s.strip()
         return self._dict.get(s, f"UNRECOGNIZED_SUBTYPE: {s}")
 
+    def _translate_unique(self, entries):
+        # Translations of distinct entries, each part of a comma separated
+        # entry translated on its own
+        parts = pd.Series(entries, dtype=object).astype(str) \
+            .str.split(',').explode().str.strip()
+        translated = parts.map(self._dict)
+        unknown = translated.isna()
+        translated[unknown] = 'UNRECOGNIZED_SUBTYPE: ' + parts[unknown]
+        return translated.groupby(level=0).agg(','.join).tolist()
+
     def translate_subtype_list(self, subtypes):
-        translated = {}
-        for entry in subtypes:
-            split_subtypes = entry.split(',')
-            if len(split_subtypes) > 1:
-                translated_split_subtypes = []
-                for x in split_subtypes:
-                    translated_split_subtypes.append(self.translate(x))
-                translated[entry] = ','.join(translated_split_subtypes)
-            else:
-                translated[entry] = self.translate(entry)
-        return translated
+        entries = list(dict.fromkeys(subtypes))
+        return dict(zip(entries, self._translate_unique(entries)))
 
     def translate_subtype_column(self, column):
-        return column.replace(self.translate_subtype_list(column))
+        # Each distinct entry is translated once, then mapped back. Missing
+        # values stay missing
+        codes, entries = pd.factorize(column)
+        translated = np.array(self._translate_unique(entries) + [np.nan],
+                              dtype=object)
+        return pd.Series(translated[codes],
+                         index=column.index,
+                         name=column.name)
 
     def thesaurus(self):
-        return self._dict
+        # Read only, as every instance shares it
+        return types.MappingProxyType(self._dict)
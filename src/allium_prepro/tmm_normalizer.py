@@ -0,0 +1,271 @@
+import numpy as np
+from scipy import sparse
+from scipy.stats import rankdata
+
+# Columns densified at a time when computing log CPM of sparse counts
+_BLOCK_SIZE = 256
+
+
+class TmmNormalizer():
+    # Port of edgeR's calcNormFactors(method="TMM") and cpm()
+    def __init__(self,
+                 counts,
+                 logratio_trim=0.3,
+                 sum_trim=0.05,
+                 do_weighting=True,
+                 a_cutoff=-1e10):
+        # Sparse counts are kept sparse, by column, and densified a column
+        # at a time where the algorithm needs it
+        self._sparse = sparse.issparse(counts)
+        if self._sparse:
+            counts = sparse.csc_matrix(counts, dtype=np.float64)
+            values = counts.data
+        else:
+            counts = np.ascontiguousarray(counts, dtype=np.float64)
+            values = counts
+        if np.isnan(values).any():
+            raise ValueError('NA counts not permitted')
+
+        self._counts = counts
+        self._logratio_trim = logratio_trim
+        self._sum_trim = sum_trim
+        self._do_weighting = do_weighting
+        self._a_cutoff = a_cutoff
+
+        # Accumulate in extended precision like R's colSums, since tied
+        # log ratios make the trimming sensitive to the last bit
+        if self._sparse:
+            # Row by row, in the same order as the dense column sums
+            counts.sort_indices()
+            self.lib_size = np.array([
+                np.cumsum(counts.data[start:end], dtype=np.longdouble)[-1]
+                if end > start else 0
+                for start, end in zip(counts.indptr[:-1],
+                                      counts.indptr[1:])]).astype(np.float64)
+        else:
+            self.lib_size = counts.sum(axis=0, dtype=np.longdouble) \
+                .astype(np.float64)
+        self.norm_factors = self._calc_norm_factors()
+
+    def _calc_norm_factors(self):
+        if self._sparse:
+            return self._calc_norm_factors_sparse()
+
+        x = self._counts
+        n_samples = x.shape[1]
+
+        # Remove all zero rows
+        x = x[(x > 0).any(axis=1)]
+
+        # Degenerate cases
+        if x.shape[0] == 0 or n_samples == 1:
+            return np.ones(n_samples)
+
+        # Pick the sample whose upper quartile is closest to the mean
+        f75 = np.quantile(x, 0.75, axis=0) / self.lib_size
+        if np.median(f75) < 1e-20:
+            ref_column = np.argmax(np.sqrt(x).sum(axis=0))
+        else:
+            ref_column = np.argmin(np.abs(f75 - f75.mean()))
+
+        f = np.array([
+            self._calc_factor_tmm(x[:, i], x[:, ref_column],
+                                  self.lib_size[i],
+                                  self.lib_size[ref_column])
+            for i in range(n_samples)])
+
+        # Factors should multiply to one
+        return f / np.exp(np.mean(np.log(f)))
+
+    def _calc_norm_factors_sparse(self):
+        x = self._counts
+        n_samples = x.shape[1]
+
+        # Remove all zero rows
+        x = x[np.asarray((x > 0).sum(axis=1)).ravel() > 0]
+
+        # Degenerate cases
+        if x.shape[0] == 0 or n_samples == 1:
+            return np.ones(n_samples)
+
+        def column(i):
+            return x[:, i].toarray().ravel()
+
+        # Pick the sample whose upper quartile is closest to the mean
+        f75 = np.array([np.quantile(column(i), 0.75)
+                        for i in range(n_samples)]) / self.lib_size
+        if np.median(f75) < 1e-20:
+            ref_column = np.argmax(np.asarray(x.sqrt().sum(axis=0)).ravel())
+        else:
+            ref_column = np.argmin(np.abs(f75 - f75.mean()))
+
+        ref = column(ref_column)
+        f = np.array([
+            self._calc_factor_tmm(column(i), ref,
+                                  self.lib_size[i],
+                                  self.lib_size[ref_column])
+            for i in range(n_samples)])
+
+        # Factors should multiply to one
+        return f / np.exp(np.mean(np.log(f)))
+
+    def _calc_factor_tmm(self, obs, ref, n_obs, n_ref):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Log ratio and absolute expression, given library sizes
+            log_r = np.log2((obs / n_obs) / (ref / n_ref))
+            abs_e = (np.log2(obs / n_obs) + np.log2(ref / n_ref)) / 2
+            # Estimated asymptotic variance
+            v = (n_obs - obs) / n_obs / obs + (n_ref - ref) / n_ref / ref
+
+        # Remove infinite values, cutoff based on A
+        fin = np.isfinite(log_r) & np.isfinite(abs_e) & \
+            (abs_e > self._a_cutoff)
+        log_r = log_r[fin]
+        abs_e = abs_e[fin]
+        v = v[fin]
+
+        if len(log_r) == 0 or np.max(np.abs(log_r)) < 1e-6:
+            return 1.0
+
+        # Trim the extremes of both the log ratios and the abundances
+        n = len(log_r)
+        lo_l = np.floor(n * self._logratio_trim) + 1
+        hi_l = n + 1 - lo_l
+        lo_s = np.floor(n * self._sum_trim) + 1
+        hi_s = n + 1 - lo_s
+        rank_r = rankdata(log_r)
+        rank_e = rankdata(abs_e)
+        keep = (rank_r >= lo_l) & (rank_r <= hi_l) & \
+            (rank_e >= lo_s) & (rank_e <= hi_s)
+
+        if self._do_weighting:
+            f = np.nansum(log_r[keep] / v[keep]) / np.nansum(1 / v[keep])
+        else:
+            f = np.nanmean(log_r[keep])
+
+        # Libraries that share no positive features get unity
+        if np.isnan(f):
+            f = 0
+        return 2 ** f
+
+    def effective_lib_size(self):
+        return self.lib_size * self.norm_factors
+
+    def cpm(self, log=False, prior_count=2, dtype=np.float64):
+        lib_size = self.effective_lib_size()
+        if self._sparse:
+            return self._cpm_sparse(lib_size, log, prior_count, dtype)
+
+        if not log:
+            return self._counts / lib_size * 1e6
+
+        # Library size-adjusted prior count, added twice to the lib size
+        prior = prior_count * lib_size / lib_size.mean()
+        return np.log2((self._counts + prior) / (lib_size + 2 * prior) * 1e6)
+
+    def _cpm_sparse(self, lib_size, log, prior_count, dtype):
+        x = self._counts
+        if not log:
+            # Zeros stay zero, so scale the stored values only
+            columns = np.repeat(np.arange(x.shape[1]), np.diff(x.indptr))
+            data = (x.data / lib_size[columns] * 1e6).astype(dtype)
+            return sparse.csc_matrix((data, x.indices, x.indptr),
+                                     shape=x.shape)
+
+        # Log CPM is dense, so fill it a block of columns at a time
+        prior = prior_count * lib_size / lib_size.mean()
+        normalized = np.empty(x.shape, dtype=dtype)
+        for start in range(0, x.shape[1], _BLOCK_SIZE):
+            block = slice(start, start + _BLOCK_SIZE)
+            normalized[:, block] = np.log2(
+                (x[:, block].toarray() + prior[block]) /
+                (lib_size[block] + 2 * prior[block]) * 1e6)
+        return normalized
+
+
+class ChunkedTmmNormalizer(TmmNormalizer):
+    # TMM and CPM over a matrix too large for memory, read as blocks of
+    # columns; every pass sees the same values as the in-memory version
+    def __init__(self,
+                 read_block,
+                 shape,
+                 block_size,
+                 logratio_trim=0.3,
+                 sum_trim=0.05,
+                 do_weighting=True,
+                 a_cutoff=-1e10):
+        self._read_block = read_block
+        self._shape = shape
+        self._block_size = block_size
+        self._logratio_trim = logratio_trim
+        self._sum_trim = sum_trim
+        self._do_weighting = do_weighting
+        self._a_cutoff = a_cutoff
+
+        # First pass: library sizes, and the rows that are ever non-zero
+        lib_size = []
+        self._nonzero = np.zeros(shape[0], dtype=bool)
+        for block in self._blocks():
+            x = self._read_block(block)
+            if np.isnan(x).any():
+                raise ValueError('NA counts not permitted')
+            lib_size.append(x.sum(axis=0, dtype=np.longdouble)
+                            .astype(np.float64))
+            self._nonzero |= (x > 0).any(axis=1)
+        self.lib_size = np.concatenate(lib_size) if lib_size \
+            else np.zeros(0)
+        self.norm_factors = self._calc_norm_factors()
+
+    def _blocks(self):
+        for start in range(0, self._shape[1], self._block_size):
+            yield slice(start, min(start + self._block_size, self._shape[1]))
+
+    def _calc_norm_factors(self):
+        n_samples = self._shape[1]
+
+        # Degenerate cases
+        if not self._nonzero.any() or n_samples == 1:
+            return np.ones(n_samples)
+
+        # Second pass: upper quartiles, without the all zero rows
+        f75 = []
+        sqrt_sums = []
+        for block in self._blocks():
+            x = self._read_block(block)[self._nonzero]
+            f75.append(np.quantile(x, 0.75, axis=0))
+            sqrt_sums.append(np.sqrt(x).sum(axis=0))
+        f75 = np.concatenate(f75) / self.lib_size
+
+        # Pick the sample whose upper quartile is closest to the mean
+        if np.median(f75) < 1e-20:
+            ref_column = np.argmax(np.concatenate(sqrt_sums))
+        else:
+            ref_column = np.argmin(np.abs(f75 - f75.mean()))
+        ref = self._read_block(
+            slice(ref_column, ref_column + 1))[self._nonzero, 0]
+
+        # Third pass: each sample against the reference
+        f = []
+        for block in self._blocks():
+            x = self._read_block(block)[self._nonzero]
+            for j, i in enumerate(range(block.start, block.stop)):
+                f.append(self._calc_factor_tmm(x[:, j], ref,
+                                               self.lib_size[i],
+                                               self.lib_size[ref_column]))
+        f = np.array(f)
+
+        # Factors should multiply to one
+        return f / np.exp(np.mean(np.log(f)))
+
+    def cpm_blocks(self, log=False, prior_count=2):
+        # Yields each block of columns with its CPM values
+        lib_size = self.effective_lib_size()
+        prior = prior_count * lib_size / lib_size.mean()
+        for block in self._blocks():
+            x = self._read_block(block)
+            if not log:
+                yield block, x / lib_size[block] * 1e6
+            else:
+                yield block, np.log2((x + prior[block]) /
+                                     (lib_size[block] + 2 * prior[block]) *
+                                     1e6)
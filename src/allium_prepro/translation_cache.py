@@ -0,0 +1,162 @@
+import glob
+import json
+import os
+import pandas as pd
+from gene_thesaurus import GeneThesaurus
+
+# HGNC data downloaded by GeneThesaurus, named after its release date
+_HGNC_FILE_PATTERN = 'hgnc_complete_set_*.json'
+
+# Lookups precomputed for a reference: its symbols to the latest symbols,
+# and its Ensembl ids to symbols
+_REFERENCE_TABLES = [('symbol', 'latest_symbol'), ('ensembl_id', 'symbol')]
+
+
+def translations_path(annot_file_path):
+    # X.allium.annotations.filtered.csv ->
+    # X.allium.annotations.filtered.translations.json
+    root, _ = os.path.splitext(annot_file_path)
+    return f'{root}.translations.json'
+
+
+class TranslationCache():
+    # Persistent memo of GeneThesaurus lookups, keyed on source, target and
+    # HGNC data version, shared by every dataset and process using cache_dir
+    def __init__(self, data_dir='/tmp', cache_dir=None, precomputed=None):
+        self._data_dir = data_dir
+        self._cache_dir = cache_dir or os.path.join(data_dir,
+                                                    'allium_translations')
+        os.makedirs(self._cache_dir, exist_ok=True)
+
+        # Optional lookups precomputed for a reference, which fill the
+        # tables of the same HGNC data version
+        self._precomputed_path = precomputed
+        self._precomputed = None
+
+        # Only loaded when a gene is not in the cache
+        self._gt = None
+        self._tables = {}
+
+    def _thesaurus(self):
+        if self._gt is None:
+            self._gt = GeneThesaurus(data_dir=self._data_dir)
+        return self._gt
+
+    def data_version(self):
+        # Release dates sort like strings, so the newest file wins
+        paths = glob.glob(os.path.join(self._data_dir, _HGNC_FILE_PATTERN))
+        if not paths:
+            return None
+        return os.path.basename(max(paths))[len('hgnc_complete_set_'):-5]
+
+    def _table_path(self, source, target, version):
+        return os.path.join(self._cache_dir,
+                            f'{source}_to_{target}_{version}.json')
+
+    def _load(self, source, target, version):
+        key = (source, target, version)
+        if key not in self._tables:
+            table = {}
+            if version:
+                table = dict(self._precomputed_table(*key))
+                path = self._table_path(*key)
+                if os.path.exists(path):
+                    with open(path, 'r') as f:
+                        table.update(json.load(f))
+            self._tables[key] = table
+        return self._tables[key]
+
+    def _precomputed_table(self, source, target, version):
+        if not self._precomputed_path or \
+                not os.path.exists(self._precomputed_path):
+            return {}
+        if self._precomputed is None:
+            with open(self._precomputed_path, 'r') as f:
+                self._precomputed = json.load(f)
+        if self._precomputed['hgnc_version'] != version:
+            return {}
+        return self._precomputed.get(f'{source}_to_{target}', {})
+
+    def precompute(self, annot_file_path):
+        # Looks up every symbol and Ensembl id of a reference, and writes
+        # the lookups next to it for TranslationCache(precomputed=...)
+        annot = pd.read_csv(annot_file_path)
+        genes = {'symbol': annot['name'].values,
+                 'ensembl_id': annot['id'].values}
+        self.update_gene_symbols(genes['symbol'])
+        self.translate_genes(genes['ensembl_id'],
+                             source='ensembl_id',
+                             target='symbol')
+
+        version = self.data_version()
+        precomputed = {'hgnc_version': version}
+        for source, target in _REFERENCE_TABLES:
+            table = self._load(source, target, version)
+            precomputed[f'{source}_to_{target}'] = {
+                g: table[g] for g in dict.fromkeys(genes[source])
+                if isinstance(g, str)}
+
+        path = translations_path(annot_file_path)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(precomputed, f)
+        os.replace(tmp_path, path)
+        print(f'Wrote translations of {len(annot)} reference genes to {path}')
+        return path
+
+    def _save(self, source, target, version, table):
+        path = self._table_path(source, target, version)
+
+        # Merge with entries other processes may have added meanwhile
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                on_disk = json.load(f)
+            on_disk.update(table)
+            table.update(on_disk)
+
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(table, f)
+        os.replace(tmp_path, path)
+
+    def _lookup(self, gene_list, source, target, translate):
+        # NaNs and other non-strings never translate, so skip them
+        genes = list(dict.fromkeys(g for g in gene_list
+                                   if isinstance(g, str)))
+
+        version = self.data_version()
+        table = self._load(source, target, version)
+        missing = [g for g in genes if g not in table]
+        if missing:
+            print(f'Translating {len(missing)} genes not in the cache...')
+            found = translate(missing)
+
+            # The thesaurus may have fetched newer HGNC data on first use
+            new_version = self.data_version()
+            if new_version != version:
+                # Lookups against older data have to be redone
+                outdated = version is not None
+                version = new_version
+                table = self._load(source, target, version)
+                missing = [g for g in genes if g not in table]
+                if outdated:
+                    found = translate(missing)
+
+            # Genes without a translation are cached too, as None
+            table.update({g: found.get(g) for g in missing})
+            self._save(source, target, version, table)
+
+        return {g: table[g] for g in genes if table[g] is not None}
+
+    def update_gene_symbols(self, gene_list):
+        # Same result as GeneThesaurus: only the symbols that changed
+        return self._lookup(
+            gene_list, 'symbol', 'latest_symbol',
+            lambda genes: self._thesaurus().update_gene_symbols(genes))
+
+    def translate_genes(self, gene_list, source='symbol', target='ensembl_id'):
+        return self._lookup(
+            gene_list, source, target,
+            lambda genes: self._thesaurus().translate_genes(genes,
+                                                            source=source,
+                                                            target=target))
@@ -0,0 +1,6 @@
+import os
+
+# UMAP's numba code starts a TBB thread pool, which hangs the test process
+# on exit once a later test forks it, as batch correction variants do. The
+# workqueue threading layer is fork safe
+os.environ.setdefault('NUMBA_THREADING_LAYER', 'workqueue')
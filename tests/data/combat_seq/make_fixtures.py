@@ -0,0 +1,18 @@
+# Writes inmoose's ComBat-seq output for counts.csv and batches.csv, which
+# tests/test_combat_seq.py compares the Python port to. inmoose's
+# pycombat_seq is a port of sva's ComBat_seq by its own authors, and is
+# pip installable where R is not. Run from the repository root:
+# python tests/data/combat_seq/make_fixtures.py
+import os
+import numpy as np
+import pandas as pd
+from inmoose.pycombat import pycombat_seq
+
+dir = 'tests/data/combat_seq'
+x = pd.read_csv(os.path.join(dir, 'counts.csv'), index_col=0)
+batches = pd.read_csv(os.path.join(dir, 'batches.csv'), index_col=0)
+adjusted = pycombat_seq(x.values, batches.loc[x.columns, 'batch'].values)
+pd.DataFrame(np.asarray(adjusted, dtype=np.int64),
+             index=x.index,
+             columns=x.columns) \
+    .to_csv(os.path.join(dir, 'inmoose.adjusted.csv'))
@@ -0,0 +1,49 @@
+# Writes the filtered counts and missing genes of counts.csv as the baseline
+# GexPreprocessor, which matched genes row by row with iterrows, wrote them,
+# for tests/test_gex_preprocessor.py to compare the current one to. Run from
+# the repository root: python tests/data/gex_preprocessor/make_fixtures.py
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import types
+
+BASELINE = '39020cd'
+dir = 'tests/data/gex_preprocessor'
+
+
+class TableThesaurus():
+    # The symbol updates of translations.json, instead of HGNC data
+    def __init__(self, data_dir='/tmp'):
+        with open(os.path.join(dir, 'translations.json'), 'r') as f:
+            self._latest = json.load(f)
+
+    def update_gene_symbols(self, gene_list):
+        return {g: self._latest[g] for g in gene_list
+                if self._latest.get(g) is not None}
+
+
+# Only the R stages, which aren't run here, use rpy2
+sys.modules.setdefault('rpy2', types.ModuleType('rpy2'))
+sys.modules.setdefault('rpy2.robjects', types.ModuleType('rpy2.robjects'))
+
+source = subprocess.run(
+    ['git', 'show', f'{BASELINE}:src/allium_prepro/gex_preprocessor.py'],
+    check=True, capture_output=True, text=True).stdout
+baseline = types.ModuleType('baseline_gex_preprocessor')
+exec(source, baseline.__dict__)
+baseline.GeneThesaurus = TableThesaurus
+
+with tempfile.TemporaryDirectory() as output_dir:
+    baseline.GexPreprocessor('baseline',
+                             os.path.join(dir, 'counts.csv'),
+                             output_dir,
+                             'symbol',
+                             '^S',
+                             ref_data_dir=dir,
+                             ref_genome='Test_genome')._preprocess_genes()
+    for name in ['tmp.counts.filtered.csv', 'missing_genes.csv']:
+        shutil.copy(os.path.join(output_dir, f'baseline.{name}'),
+                    os.path.join(dir, f'baseline.{name}'))
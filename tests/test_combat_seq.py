@@ -0,0 +1,72 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from allium_prepro.combat_seq import CombatSeq
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data', 'combat_seq')
+
+# ComBat-seq implementations whose output for the fixture is committed
+REFERENCES = ['inmoose']
+
+
+def _fixture():
+    counts = pd.read_csv(os.path.join(DATA_DIR, 'counts.csv'), index_col=0)
+    batches = pd.read_csv(os.path.join(DATA_DIR, 'batches.csv'), index_col=0)
+    return counts, batches.loc[counts.columns, 'batch'].values
+
+
+@pytest.mark.parametrize('reference', REFERENCES)
+def test_same_as_reference(reference):
+    # Written by make_fixtures.py, or make_fixtures.R for sva
+    expected = pd.read_csv(
+        os.path.join(DATA_DIR, f'{reference}.adjusted.csv'),
+        index_col=0).to_numpy()
+
+    counts, batch = _fixture()
+    adjusted = CombatSeq(n_jobs=1).run(counts.values, batch)
+    np.testing.assert_array_equal(adjusted, expected)
+
+
+def test_adjusted_counts():
+    counts, batch = _fixture()
+    x = counts.to_numpy(dtype=np.float64)
+    adjusted = CombatSeq(n_jobs=1).run(x, batch)
+
+    # Counts stay whole, and counts of 0 and 1 are kept as they are
+    assert adjusted.shape == x.shape
+    np.testing.assert_array_equal(adjusted, np.round(adjusted))
+    np.testing.assert_array_equal(adjusted[x <= 1], x[x <= 1])
+
+    # Genes with only zero counts in a batch are not adjusted
+    np.testing.assert_array_equal(adjusted[[5, 9]], x[[5, 9]])
+
+    # The gene-wise batch effects are largely removed
+    def batch_spread(y):
+        log_cpm = np.log2(y / y.sum(axis=0) * 1e6 + 1)
+        means = np.column_stack([log_cpm[:, batch == k].mean(axis=1)
+                                 for k in np.unique(batch)])
+        return np.ptp(means, axis=1).mean()
+    assert batch_spread(adjusted) < batch_spread(x) / 2
+
+
+def test_same_for_any_blocks_and_jobs():
+    counts, batch = _fixture()
+    adjusted = CombatSeq(n_jobs=1).run(counts.values, batch)
+    np.testing.assert_array_equal(
+        CombatSeq(n_jobs=2, block_size=7).run(counts.values, batch),
+        adjusted)
+
+
+def test_one_sample_batch():
+    counts, batch = _fixture()
+    with pytest.raises(ValueError):
+        CombatSeq(n_jobs=1).run(counts.values[:, 2:], batch[2:])
+
+
+def test_sample_without_batch():
+    counts, batch = _fixture()
+    batch = batch.astype(object)
+    batch[4] = np.nan
+    with pytest.raises(ValueError, match='Every sample needs a batch'):
+        CombatSeq(n_jobs=1).run(counts.values, batch)
@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+from allium_prepro.gene_matcher import GeneMatcher
+
+REF_IDS = ['ENSG01', 'ENSG02', 'ENSG03', 'ENSG04 ', 'ENSG05']
+REF_SYMBOLS = ['ETV6', 'SARS1', np.nan, 'DOC2B', 'ETV6']
+
+
+def _per_gene(matcher, gene_ids, symbols):
+    keys = [matcher.find_ref_key(gene_id, symbol)
+            for gene_id, symbol in zip(gene_ids, symbols)]
+    return [key.strip() if key is not None else None for key in keys]
+
+
+def test_match_same_as_per_gene_lookup():
+    matcher = GeneMatcher(REF_IDS, REF_SYMBOLS)
+    gene_ids = ['ENSG02', 'ETV6', 'ENSG04 ', 'unknown', 'ENSG02', 'x', 'y']
+    symbols = ['DOC2B', 'ETV6', np.nan, 'unknown', 'SARS1', np.nan, 'DOC2B']
+
+    keys = matcher.match(gene_ids, symbols)
+
+    # Ids win over symbols, the first ref row wins a symbol, keys are
+    # stripped and unmatched genes are None
+    assert keys.tolist() == ['ENSG02', 'ENSG01', 'ENSG04', None, 'ENSG02',
+                             None, 'ENSG04']
+    assert keys.tolist() == _per_gene(matcher, gene_ids, symbols)
+    assert keys.index.tolist() == gene_ids
+
+
+def test_match_with_prebuilt_symbols():
+    matcher = GeneMatcher(REF_IDS, symbol_to_id={'ETV6': 'ENSG05'})
+    keys = matcher.match(pd.Index(['ETV6', 'ENSG03']), ['ETV6', 'ETV6'])
+    assert keys.tolist() == ['ENSG05', 'ENSG03']
+
+
+def test_match_random_genes():
+    rng = np.random.default_rng(0)
+    ref_ids = [f'ENSG{i:05d}' for i in range(500)]
+    ref_symbols = rng.choice([f'G{i}' for i in range(400)] + [np.nan], 500)
+    matcher = GeneMatcher(ref_ids, ref_symbols)
+
+    gene_ids = rng.choice(ref_ids + [f'G{i}' for i in range(600)], 2000)
+    symbols = rng.choice([f'G{i}' for i in range(600)] + [np.nan], 2000)
+    assert matcher.match(gene_ids, symbols).tolist() == \
+        _per_gene(matcher, gene_ids, symbols)
@@ -0,0 +1,353 @@
+import inspect
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+import pytest
+from allium_prepro.gex_preprocessor import GexPreprocessor
+from allium_prepro.stage_cache import StageCache
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data', 'gex_preprocessor')
+GENOME = 'Test_genome'
+HGNC_VERSION = '2024-01-01'
+SYMBOLS = [f'GENE{i}' for i in range(30)]
+
+
+def _setup(tmp_path):
+    # A small reference, and translations cached for every symbol, so the
+    # gene thesaurus never has to download HGNC data
+    ref_dir = tmp_path / 'reference'
+    ref_dir.mkdir()
+    pd.DataFrame({'id': [f'ENSG{i:011d}' for i in range(30)],
+                  'chr': '1',
+                  'name': SYMBOLS,
+                  'biotype': 'protein_coding',
+                  'length': np.arange(30) * 100 + 500}) \
+        .to_csv(ref_dir / f'{GENOME}.allium.annotations.filtered.csv',
+                index=False)
+
+    tmp_dir = tmp_path / 'tmp'
+    (tmp_dir / 'allium_translations').mkdir(parents=True)
+    (tmp_dir / f'hgnc_complete_set_{HGNC_VERSION}.json').write_text('{}')
+    genes = SYMBOLS + ['unknown']
+    with open(tmp_dir / 'allium_translations' /
+              f'symbol_to_latest_symbol_{HGNC_VERSION}.json', 'w') as f:
+        json.dump(dict.fromkeys(genes), f)
+
+    rng = np.random.default_rng(0)
+    samples = [f'S{i}' for i in range(8)]
+    counts = pd.DataFrame(rng.negative_binomial(5, 0.05, (26, 8)),
+                          index=SYMBOLS[:25] + ['unknown'],
+                          columns=samples)
+    counts.to_csv(tmp_path / 'counts.csv')
+    pd.DataFrame({'batch': ['a', 'b'] * 4},
+                 index=pd.Index(samples, name='id')) \
+        .to_csv(tmp_path / 'batches.csv')
+    pd.DataFrame({'Gene ID': [f'ENSG{i:011d}' for i in [0, 26, 28]],
+                  'feature_importance_mean': [0.5, 0.3, 0.2]}) \
+        .to_csv(tmp_path / 'signatures.csv')
+
+    return {'input_file': str(tmp_path / 'counts.csv'),
+            'gene_format': 'symbol',
+            'sample_col_regex': '^S',
+            'batches_file': str(tmp_path / 'batches.csv'),
+            'ref_data_dir': str(ref_dir),
+            'ref_genome': GENOME,
+            'tmp_dir': str(tmp_dir),
+            'batch_corrector': 'python',
+            'n_jobs': 1}
+
+
+def test_same_as_baseline_matching(tmp_path):
+    # Duplicate and missing symbols, symbols renamed in the data or in both,
+    # genes given by id and by symbol, and an id with trailing whitespace.
+    # make_fixtures.py wrote what the baseline's row by row matching made
+    # of them
+    tmp_dir = tmp_path / 'tmp'
+    (tmp_dir / 'allium_translations').mkdir(parents=True)
+    (tmp_dir / f'hgnc_complete_set_{HGNC_VERSION}.json').write_text('{}')
+    shutil.copy(os.path.join(DATA_DIR, 'translations.json'),
+                tmp_dir / 'allium_translations' /
+                f'symbol_to_latest_symbol_{HGNC_VERSION}.json')
+    output_dir = tmp_path / 'output'
+    output_dir.mkdir()
+    GexPreprocessor('current',
+                    os.path.join(DATA_DIR, 'counts.csv'),
+                    str(output_dir),
+                    'symbol',
+                    '^S',
+                    ref_data_dir=DATA_DIR,
+                    ref_genome=GENOME,
+                    tmp_dir=str(tmp_dir),
+                    keep_intermediates=True).run()
+
+    with open(os.path.join(DATA_DIR, 'baseline.tmp.counts.filtered.csv'),
+              'r') as f:
+        assert (output_dir / 'current.tmp.counts.filtered.csv')\
+            .read_text() == f.read()
+
+    # Missing genes are listed by id alone now, not zero filled
+    baseline = pd.read_csv(os.path.join(DATA_DIR,
+                                        'baseline.missing_genes.csv'))
+    assert pd.read_csv(output_dir / 'current.missing_genes.csv')['id']\
+        .tolist() == baseline['id'].tolist()
+
+
+def test_cache_hit_writes_side_outputs(tmp_path, capsys):
+    kwargs = _setup(tmp_path)
+    output_dir = tmp_path / 'output'
+    output_dir.mkdir()
+    for prefix in ['first', 'second']:
+        GexPreprocessor(prefix,
+                        output_dir=str(output_dir),
+                        keep_intermediates=True,
+                        cache_dir=str(tmp_path / 'cache'),
+                        signature_file=str(tmp_path / 'signatures.csv'),
+                        **kwargs).run()
+    assert 'Using cached normalize output' in capsys.readouterr().out
+
+    # The second run skips every stage, but writes the same files
+    outputs = sorted(os.listdir(output_dir))
+    assert outputs == sorted(
+        f'{prefix}.{name}' for prefix in ['first', 'second']
+        for name in ['counts.allium.csv',
+                     'missing_genes.csv',
+                     'signature_coverage.csv',
+                     'tmp.counts.batch_corrected.csv',
+                     'tmp.counts.filtered.csv',
+                     'tmp.counts.norm.csv',
+                     'tmp.counts.norm.nolog.csv'])
+    for name in outputs:
+        if name.startswith('first.'):
+            second = name.replace('first.', 'second.', 1)
+            assert (output_dir / name).read_bytes() == \
+                (output_dir / second).read_bytes(), name
+
+    missing = pd.read_csv(output_dir / 'second.missing_genes.csv')
+    assert missing['id'].tolist() == [f'ENSG{i:011d}' for i in range(25, 30)]
+
+
+def test_cache_hit_diagnostics(tmp_path):
+    pytest.importorskip('umap')
+    kwargs = _setup(tmp_path)
+    output_dir = tmp_path / 'output'
+    output_dir.mkdir()
+    results = {}
+    for prefix in ['first', 'second']:
+        GexPreprocessor(prefix,
+                        output_dir=str(output_dir),
+                        keep_intermediates=True,
+                        cache_dir=str(tmp_path / 'cache'),
+                        diagnostics=True,
+                        **kwargs).run()
+        with open(output_dir / f'{prefix}.batch_diagnostics.json', 'r') as f:
+            results[prefix] = json.load(f)['matrices']
+
+    # The second run diagnoses the raw input and the cached outputs, and
+    # says which are which
+    assert {name: result['cached']
+            for name, result in results['first'].items()} == \
+        {'raw': False, 'batch_corrected': False, 'normalized': False}
+    assert {name: result['cached']
+            for name, result in results['second'].items()} == \
+        {'raw': False, 'batch_corrected': True, 'normalized': True}
+    for name, result in results['second'].items():
+        assert result['explained_variance_ratio'] == \
+            results['first'][name]['explained_variance_ratio']
+
+
+def test_clone_keeps_every_argument(tmp_path):
+    kwargs = _setup(tmp_path)
+    gex = GexPreprocessor('first', output_dir=str(tmp_path), **kwargs)
+    parameters = list(inspect.signature(GexPreprocessor).parameters)
+    assert list(gex._args) == parameters
+
+    # Variants differ from their parent only in the overridden arguments
+    variant = gex._clone(prefix='first.v1', batches_file=None)
+    assert variant._args == dict(gex._args, prefix='first.v1',
+                                 batches_file=None)
+
+
+def _write_sites(tmp_path, samples):
+    pd.DataFrame({'batch': ['x'] * 4 + ['y'] * 4},
+                 index=pd.Index([f'S{i}' for i in range(8)], name='id')) \
+        .loc[samples].to_csv(tmp_path / 'sites.csv')
+    return str(tmp_path / 'sites.csv')
+
+
+def test_variants_same_as_single_runs(tmp_path):
+    kwargs = _setup(tmp_path)
+    batches_file = kwargs.pop('batches_file')
+    sites_file = _write_sites(tmp_path, [f'S{i}' for i in range(8)])
+    output_dir = tmp_path / 'output'
+    output_dir.mkdir()
+    GexPreprocessor('cohort',
+                    output_dir=str(output_dir),
+                    batches_file={'batch': batches_file,
+                                  'both': [batches_file, sites_file]},
+                    n_variant_workers=2,
+                    **kwargs).run()
+
+    # Combined covariates give a batch per combination
+    combined = pd.read_csv(output_dir / 'cohort.both.batches.csv',
+                           index_col=0)['batch']
+    assert combined.tolist() == ['a+x', 'b+x'] * 2 + ['a+y', 'b+y'] * 2
+
+    # Each variant writes what a run on its batches alone does
+    for suffix, path in [('batch', batches_file),
+                         ('both', output_dir / 'cohort.both.batches.csv')]:
+        GexPreprocessor(f'single.{suffix}',
+                        output_dir=str(output_dir),
+                        batches_file=str(path),
+                        **kwargs).run()
+        assert (output_dir / f'cohort.{suffix}.counts.allium.csv')\
+            .read_bytes() == \
+            (output_dir / f'single.{suffix}.counts.allium.csv').read_bytes()
+
+
+def test_variant_sample_without_batch(tmp_path):
+    kwargs = _setup(tmp_path)
+    batches_file = kwargs.pop('batches_file')
+    sites_file = _write_sites(tmp_path,
+                              [f'S{i}' for i in range(8) if i != 3])
+    output_dir = tmp_path / 'output'
+    output_dir.mkdir()
+    with pytest.raises(ValueError, match='1 samples have no batch.*: S3$'):
+        GexPreprocessor('cohort',
+                        output_dir=str(output_dir),
+                        batches_file={'batch': batches_file,
+                                      'both': [batches_file, sites_file]},
+                        **kwargs).run()
+    assert not any(name.endswith('counts.allium.csv')
+                   for name in os.listdir(output_dir))
+
+
+def test_failed_variant(tmp_path, capsys):
+    kwargs = _setup(tmp_path)
+    batches_file = kwargs.pop('batches_file')
+    # A batch of one sample, which ComBat-seq refuses
+    pd.DataFrame({'batch': ['a'] * 7 + ['b']},
+                 index=pd.Index([f'S{i}' for i in range(8)], name='id')) \
+        .to_csv(tmp_path / 'single.csv')
+    output_dir = tmp_path / 'output'
+    output_dir.mkdir()
+    with pytest.raises(RuntimeError, match='1 of 2 batch correction '
+                                           'variants failed: single'):
+        GexPreprocessor('cohort',
+                        output_dir=str(output_dir),
+                        batches_file={'batch': batches_file,
+                                      'single': str(tmp_path / 'single.csv')},
+                        n_variant_workers=2,
+                        **kwargs).run()
+
+    # The other variant still runs, and the failure is shown
+    assert (output_dir / 'cohort.batch.counts.allium.csv').exists()
+    out = capsys.readouterr().out
+    assert 'batch      done' in out and 'single     failed' in out
+    assert "1 sample per batch" in out
+
+
+def test_chunked_same_as_in_memory(tmp_path):
+    kwargs = _setup(tmp_path)
+    kwargs.pop('batches_file')
+    # Symbols repeated near the end, so genes are split across chunks
+    counts = pd.read_csv(kwargs['input_file'], index_col=0)
+    pd.concat([counts, counts.iloc[[0, 3, 20]]]) \
+        .to_csv(kwargs['input_file'])
+    output_dir = tmp_path / 'output'
+    output_dir.mkdir()
+    GexPreprocessor('memory',
+                    output_dir=str(output_dir),
+                    normalizer='numpy',
+                    keep_intermediates=True,
+                    **kwargs).run()
+
+    # Five genes per chunk and one sample per block
+    budget = 8 * 8 * 4 * 5
+    chunked = GexPreprocessor('chunked',
+                              output_dir=str(output_dir),
+                              normalizer='numpy',
+                              memory_budget=budget,
+                              **kwargs)
+    assert chunked._block_size(8) == 5
+    assert chunked._block_size(30) == 1
+    chunked.run()
+
+    filtered = pd.read_csv(output_dir / 'memory.tmp.counts.filtered.csv',
+                           index_col=0)
+    with tempfile.TemporaryDirectory(dir=tmp_path) as buffer_dir:
+        buffered, case_columns = \
+            chunked._preprocess_genes_chunked(buffer_dir)
+        assert case_columns == filtered.columns.tolist()
+        np.testing.assert_allclose(np.asarray(buffered), filtered.values)
+
+    # The ALLIUM output is the normalized matrix, one sample per row
+    result = pd.read_csv(output_dir / 'chunked.counts.allium.csv',
+                         index_col=0)
+    normalized = pd.read_csv(output_dir / 'memory.tmp.counts.norm.csv',
+                             index_col=0)
+    assert result.columns.tolist() == normalized.index.tolist()
+    np.testing.assert_allclose(result.values, normalized.values.T,
+                               rtol=1e-12)
+    pd.testing.assert_frame_equal(
+        result,
+        pd.read_csv(output_dir / 'memory.counts.allium.csv', index_col=0),
+        rtol=1e-12)
+    assert (output_dir / 'chunked.missing_genes.csv').read_text() == \
+        (output_dir / 'memory.missing_genes.csv').read_text()
+
+
+@pytest.mark.parametrize('options', [{'sparse': True},
+                                     {'float32': True},
+                                     {'int32': True},
+                                     {'sparse': True, 'float32': True,
+                                      'int32': True}])
+def test_memory_options_same_as_dense(tmp_path, options):
+    kwargs = _setup(tmp_path)
+    output_dir = tmp_path / 'output'
+    output_dir.mkdir()
+    for prefix, extra in [('dense', {}), ('lean', options)]:
+        GexPreprocessor(prefix,
+                        output_dir=str(output_dir),
+                        **kwargs,
+                        **extra).run()
+
+    # Batch corrected, then normalized, with float32 keeping about seven
+    # significant digits
+    tolerance = 1e-5 if options.get('float32') else 1e-12
+    dense = pd.read_csv(output_dir / 'dense.counts.allium.csv', index_col=0)
+    lean = pd.read_csv(output_dir / 'lean.counts.allium.csv', index_col=0)
+    pd.testing.assert_frame_equal(lean, dense, check_exact=False,
+                                  rtol=tolerance, atol=tolerance)
+
+
+def test_cache_entry_evicted_while_resuming(tmp_path, monkeypatch):
+    kwargs = _setup(tmp_path)
+    output_dir = tmp_path / 'output'
+    output_dir.mkdir()
+    GexPreprocessor('first',
+                    output_dir=str(output_dir),
+                    cache_dir=str(tmp_path / 'cache'),
+                    **kwargs).run()
+
+    # Another process evicts the normalize output just as it is read, so
+    # the run resumes from the stage before instead
+    get = StageCache.get
+    evicted = []
+
+    def get_after_eviction(self, key):
+        if not evicted:
+            evicted.append(key)
+            os.remove(self._path(key))
+        return get(self, key)
+
+    monkeypatch.setattr(StageCache, 'get', get_after_eviction)
+    GexPreprocessor('second',
+                    output_dir=str(output_dir),
+                    cache_dir=str(tmp_path / 'cache'),
+                    **kwargs).run()
+    assert len(evicted) == 1
+    assert (output_dir / 'first.counts.allium.csv').read_bytes() == \
+        (output_dir / 'second.counts.allium.csv').read_bytes()
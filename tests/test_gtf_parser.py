@@ -0,0 +1,45 @@
+import os
+from allium_prepro.gtf_parser import GtfParser
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data', 'gtf')
+
+
+def test_same_as_r_preprocessor(tmp_path):
+    # GRCh38.103 genes in position order, with the rows the R preprocessor
+    # wrote for them to the bundled annotations.full.csv
+    output_file = tmp_path / 'annotations.full.csv'
+    GtfParser(os.path.join(DATA_DIR, 'Homo_sapiens.GRCh38.103.sample.gtf.gz')) \
+        .write_annotations(str(output_file))
+    expected = os.path.join(
+        DATA_DIR, 'Homo_sapiens.GRCh38.103.sample.annotations.full.csv')
+    with open(expected, 'r') as f:
+        assert output_file.read_text() == f.read()
+
+
+def test_edge_cases(tmp_path):
+    gtf_file = tmp_path / 'edge.gtf'
+    gtf_file.write_text('\n'.join([
+        '#!genome-build test',
+        # Overlapping and abutting exons, a comment after the attributes
+        '1\tx\tgene\t1\t300\t.\t+\t.\tgene_id "G2"; gene_name "B"; '
+        'gene_biotype "lncRNA"; # comment',
+        '1\tx\texon\t1\t100\t.\t+\t.\tgene_id "G2"; transcript_id "T1";',
+        '1\tx\texon\t51\t150\t.\t+\t.\tgene_id "G2"; transcript_id "T2";',
+        '1\tx\texon\t151\t160\t.\t+\t.\tgene_id "G2"; transcript_id "T2";',
+        '1\tx\texon\t201\t300\t.\t+\t.\tgene_id "G2"; transcript_id "T2";',
+        # Exons on two chromosomes, and out of order
+        'X\tx\tgene\t1\t50\t.\t+\t.\tgene_id "G1"; gene_biotype "TEC";',
+        'X\tx\texon\t31\t50\t.\t+\t.\tgene_id "G1"; transcript_id "T3";',
+        'Y\tx\texon\t1\t10\t.\t+\t.\tgene_id "G1"; transcript_id "T4";',
+        'X\tx\texon\t1\t20\t.\t+\t.\tgene_id "G1"; transcript_id "T3";',
+        # Exons without a gene record, and a gene without exons
+        '2\tx\texon\t5\t9\t.\t+\t.\tgene_id "G4"; transcript_id "T5";',
+        '2\tx\tgene\t5\t9\t.\t+\t.\tgene_id "G3"; gene_name "C"; '
+        'gene_biotype "miRNA";',
+        '']))
+
+    assert GtfParser(str(gtf_file)).parse() == [
+        ['G1', 'X', None, 'TEC', 50],
+        ['G2', '1', 'B', 'lncRNA', 260],
+        ['G3', '2', 'C', 'miRNA', None],
+        ['G4', None, None, None, 5]]
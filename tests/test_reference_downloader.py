@@ -0,0 +1,192 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import pytest
+import requests
+from allium_prepro.reference_downloader import ReferenceDownloader, bsd_sum
+
+# Four ranges of 200 kB, so a range cut off halfway has written some of its
+# 64 kB chunks
+CONTENT = np.random.default_rng(0).integers(0, 256, 800000, dtype=np.uint8) \
+    .tobytes()
+RANGES = [(0, 199999), (200000, 399999), (400000, 599999), (600000, 799999)]
+
+
+def _bsd_sum_per_byte(content):
+    checksum = 0
+    for byte in content:
+        checksum = ((checksum >> 1) + ((checksum & 1) << 15) + byte) & 0xffff
+    return checksum, (len(content) + 1023) // 1024
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Serves server.files, with byte ranges if server.ranges is set. The
+    # first server.drops range requests are cut off halfway
+    def do_HEAD(self):
+        self._respond(send_body=False)
+
+    def do_GET(self):
+        self._respond(send_body=True)
+
+    def _respond(self, send_body):
+        content = self.server.files.get(self.path)
+        if content is None:
+            self.send_error(404)
+            return
+        requested = self.headers.get('Range')
+        self.server.log.append((self.command, self.path, requested))
+
+        start, end = 0, len(content) - 1
+        if requested and self.server.ranges:
+            start, end = [int(value) for value in
+                          requested[len('bytes='):].split('-')]
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             f'bytes {start}-{end}/{len(content)}')
+        else:
+            self.send_response(200)
+        if self.server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if not send_body:
+            return
+
+        body = content[start:end + 1]
+        with self.server.lock:
+            drop = requested is not None and self.server.drops > 0
+            self.server.drops -= drop
+        if drop:
+            body = body[:len(body) // 2]
+            self.close_connection = True
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    server.files = {}
+    server.ranges = True
+    server.drops = 0
+    server.log = []
+    server.lock = threading.Lock()
+    server.url = f'http://127.0.0.1:{server.server_address[1]}'
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _serve(server, name, content, checksum=None):
+    server.files[f'/{name}'] = content
+    checksum = checksum or _bsd_sum_per_byte(content)
+    server.files['/CHECKSUMS'] = \
+        f'{checksum[0]} {checksum[1]} {name}\n'.encode()
+    return f'{server.url}/{name}', f'{server.url}/CHECKSUMS'
+
+
+def _ranges(server, name):
+    # Requested (start, end) byte ranges, in file order
+    return sorted(tuple(int(value) for value in
+                        requested[len('bytes='):].split('-'))
+                  for command, path, requested in server.log
+                  if command == 'GET' and path == f'/{name}')
+
+
+def _downloader(tmp_path, **kwargs):
+    return ReferenceDownloader(str(tmp_path / 'store'),
+                               min_range_size=100000,
+                               timeout=5,
+                               **kwargs)
+
+
+@pytest.mark.parametrize('content', [
+    b'', b'\x01', b'\xff' * 70000, b'\x00' * 3000 + b'\xff' * 5000,
+    CONTENT, bytes(range(256)) * 300])
+def test_bsd_sum(tmp_path, content):
+    path = tmp_path / 'file'
+    path.write_bytes(content)
+    assert bsd_sum(str(path)) == _bsd_sum_per_byte(content)
+
+
+def test_ranges_and_store(tmp_path, server):
+    url, checksums_url = _serve(server, 'a.gtf.gz', CONTENT)
+    downloader = _downloader(tmp_path)
+    path = downloader.fetch(url, checksums_url=checksums_url)
+    with open(path, 'rb') as f:
+        assert f.read() == CONTENT
+
+    # Four ranges, covering the file once
+    assert _ranges(server, 'a.gtf.gz') == RANGES
+
+    # Stored files are not downloaded again
+    server.log.clear()
+    assert _downloader(tmp_path).fetch(url) == path
+    assert server.log == []
+
+
+def test_resume(tmp_path, server):
+    url, checksums_url = _serve(server, 'a.gtf.gz', CONTENT)
+
+    # Every range is cut off halfway, and not retried
+    server.drops = 4
+    with pytest.raises(requests.RequestException):
+        _downloader(tmp_path, retries=0).fetch(url)
+
+    # The next run asks for the rest of every range only
+    server.log.clear()
+    path = _downloader(tmp_path).fetch(url, checksums_url=checksums_url)
+    with open(path, 'rb') as f:
+        assert f.read() == CONTENT
+    resumed = _ranges(server, 'a.gtf.gz')
+    assert len(resumed) == len(RANGES)
+    for (start, end), (full_start, full_end) in zip(resumed, RANGES):
+        assert full_start < start and end == full_end
+
+
+def test_retry_within_run(tmp_path, server):
+    url, _ = _serve(server, 'a.gtf.gz', CONTENT)
+    server.drops = 2
+    path = _downloader(tmp_path, retries=1).fetch(url)
+    with open(path, 'rb') as f:
+        assert f.read() == CONTENT
+
+
+def test_without_ranges(tmp_path, server):
+    url, checksums_url = _serve(server, 'a.gtf.gz', CONTENT)
+    server.ranges = False
+    path = _downloader(tmp_path).fetch(url, checksums_url=checksums_url)
+    with open(path, 'rb') as f:
+        assert f.read() == CONTENT
+    assert [requested for command, _, requested in server.log
+            if command == 'GET'] == [None, None]
+
+
+def test_checksum_mismatch(tmp_path, server):
+    checksum, blocks = _bsd_sum_per_byte(CONTENT)
+    url, checksums_url = _serve(server, 'a.gtf.gz', CONTENT,
+                                checksum=((checksum + 1) % 65536, blocks))
+    downloader = _downloader(tmp_path)
+    with pytest.raises(ValueError, match='Checksum mismatch'):
+        downloader.fetch(url, checksums_url=checksums_url)
+
+    # Nothing is stored, so a corrected listing downloads it again
+    assert not os.path.exists(tmp_path / 'store' / 'index.json')
+    url, checksums_url = _serve(server, 'a.gtf.gz', CONTENT)
+    assert downloader.fetch(url, checksums_url=checksums_url)
+
+
+def test_concurrent_fetches_keep_every_entry(tmp_path, server):
+    urls = [_serve(server, f'{i}.gtf.gz', CONTENT[i:])[0] for i in range(12)]
+    with ThreadPoolExecutor(max_workers=12) as executor:
+        list(executor.map(lambda url: _downloader(tmp_path).fetch(url),
+                          urls))
+    with open(tmp_path / 'store' / 'index.json', 'r') as f:
+        assert sorted(json.load(f)) == sorted(urls)
@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+from allium_prepro.reference_index import ReferenceIndex
+
+# Not sorted by id, with ETV6 first on the larger id and SARS renamed
+ANNOTATIONS = pd.DataFrame({
+    'id': ['ENSG05', 'ENSG03', 'ENSG01', 'ENSG04', 'ENSG02'],
+    'name': ['ETV6', 'SARS', 'ETV6', np.nan, 'SARS1'],
+    'length': [500, 300, 100, 400, 200]})
+
+
+class FakeTranslations():
+    # Stands in for TranslationCache, with a fixed HGNC version
+    def __init__(self, version='2024-01-01'):
+        self.version = version
+
+    def data_version(self):
+        return self.version
+
+    def update_gene_symbols(self, gene_list):
+        return {g: 'SARS1' for g in gene_list if g == 'SARS'}
+
+
+def test_symbols_follow_csv_order(tmp_path):
+    path = tmp_path / 'annotations.csv'
+    ANNOTATIONS.to_csv(path, index=False)
+    index = ReferenceIndex.from_csv(str(path), FakeTranslations())
+    assert index.ids.tolist() == [f'ENSG0{i}' for i in range(1, 6)]
+    assert index.lengths.tolist() == [100, 200, 300, 400, 500]
+
+    # The first CSV row wins a symbol, not the smallest id
+    expected = {'ETV6': 'ENSG05', 'SARS1': 'ENSG03'}
+    assert index.symbol_to_id() == expected
+
+    # Also once saved, and once the symbols are redone for other HGNC data
+    index.save(str(tmp_path / 'index'))
+    for version in ['2024-01-01', '2025-01-01']:
+        loaded = ReferenceIndex.load(str(tmp_path / 'index'),
+                                     FakeTranslations(version))
+        assert loaded.symbol_to_id() == expected
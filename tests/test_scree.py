@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('matplotlib')
+
+from allium_prepro import scree  # noqa: E402
+from allium_prepro.scree import ScreePlotter, \
+    explained_variance_ratio  # noqa: E402
+
+
+def _noise(rng):
+    return rng.standard_normal((3000, 2500))
+
+
+def _counts(rng):
+    counts = rng.poisson(rng.gamma(2, 5, (1, 2500)), (3000, 2500))
+    counts[:, :5] = 3
+    return counts
+
+
+def _low_rank(rng):
+    return rng.standard_normal((3000, 20)) @ \
+        rng.standard_normal((20, 2500)) + rng.standard_normal((3000, 2500))
+
+
+# Both sides above _GRAM_MAX, so the randomized path is taken. Noise has a
+# flat spectrum, the hardest case, and the counts have constant genes
+@pytest.mark.parametrize('make, tolerance', [(_noise, 5e-3),
+                                             (_counts, 5e-3),
+                                             (_low_rank, 1e-10)])
+def test_randomized_close_to_exact(monkeypatch, make, tolerance):
+    x = make(np.random.default_rng(1))
+    randomized = explained_variance_ratio(x)
+
+    # The exact spectrum, from the Gram matrix of the smaller side
+    monkeypatch.setattr(scree, '_GRAM_MAX', max(x.shape))
+    exact = explained_variance_ratio(x)
+    assert len(randomized) == len(exact) == 10
+    np.testing.assert_allclose(randomized, exact, rtol=tolerance)
+
+
+def test_exact_same_as_pca():
+    rng = np.random.default_rng(0)
+    x = rng.standard_normal((200, 50)) @ rng.standard_normal((50, 300))
+    x[:, 7] = 1
+    ratio = explained_variance_ratio(x, n_components=5)
+
+    # The spectrum of the standardized matrix, constant columns left out
+    varying = x[:, x.std(axis=0) > 0]
+    z = (varying - varying.mean(axis=0)) / varying.std(axis=0)
+    singular_values = np.linalg.svd(z, compute_uv=False)
+    expected = singular_values[:5] ** 2 / (singular_values ** 2).sum()
+    np.testing.assert_allclose(ratio, expected, rtol=1e-10)
+
+
+def test_plotter_reports_failed_datasets(tmp_path, capsys):
+    rng = np.random.default_rng(0)
+    matrix_file = tmp_path / 'good.csv'
+    np.savetxt(matrix_file, rng.standard_normal((30, 20)), delimiter=',')
+    datasets = {'good': [(str(matrix_file), str(tmp_path / 'good.png'))],
+                'missing': [(str(tmp_path / 'missing.csv'),
+                             str(tmp_path / 'missing.png'))]}
+    with pytest.raises(RuntimeError, match='1 of 2 datasets failed: missing'):
+        ScreePlotter(datasets, n_workers=2).run()
+
+    # The good dataset is still plotted, and the failure shown
+    assert (tmp_path / 'good.png').exists()
+    out = capsys.readouterr().out
+    assert 'good       done' in out and 'missing    failed' in out
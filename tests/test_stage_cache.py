@@ -0,0 +1,14 @@
+import os
+from allium_prepro.stage_cache import StageCache
+
+
+def test_get_missing_entry(tmp_path):
+    cache = StageCache(str(tmp_path))
+    assert cache.get('missing') is None
+    cache.put('key', ('data', None))
+    assert cache.get('key') == ('data', None)
+
+    # Removed by another process, e.g. evicted, it is just a miss
+    os.remove(tmp_path / 'key.pkl')
+    assert cache.get('key') is None
+    cache.invalidate('key')
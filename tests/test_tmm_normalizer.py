@@ -0,0 +1,113 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+from allium_prepro.tmm_normalizer import ChunkedTmmNormalizer, TmmNormalizer
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data', 'tmm')
+CASES = ['nb', 'ties', 'zero_rows', 'single', 'sparse', 'gtex']
+
+# Cases with edgeR's norm factors next to their counts
+EDGER_CASES = ['gtex']
+
+
+def _counts(case):
+    return pd.read_csv(os.path.join(DATA_DIR, f'{case}.counts.csv'),
+                       index_col=0).to_numpy()
+
+
+def _edger_norm_factors(case):
+    # Written by make_fixtures.R
+    path = os.path.join(DATA_DIR, f'{case}.edger.norm_factors.csv')
+    return pd.read_csv(path, index_col=0)['norm_factors'].to_numpy()
+
+
+@pytest.mark.parametrize('case', EDGER_CASES)
+@pytest.mark.parametrize('as_sparse', [False, True])
+def test_same_as_edger(case, as_sparse):
+    counts = _counts(case)
+    tmm = TmmNormalizer(sparse.csc_matrix(counts) if as_sparse else counts)
+
+    # edgeR wrote its factors to 15 significant digits
+    norm_factors = _edger_norm_factors(case)
+    np.testing.assert_allclose(tmm.norm_factors, norm_factors, rtol=1e-13)
+
+    # edgeR's cpm(log=TRUE) scales the prior count of 2 by the effective
+    # library sizes, and adds it to them twice over
+    lib_size = counts.sum(axis=0) * norm_factors
+    prior_count = 2 * lib_size / lib_size.mean()
+    np.testing.assert_allclose(
+        tmm.cpm(log=True),
+        np.log2((counts + prior_count) / (lib_size + 2 * prior_count) * 1e6),
+        rtol=1e-12)
+
+
+def test_tied_log_ratios():
+    # Both upper quartiles are equally far from their mean, and either sample
+    # as the reference gives the same factors. Ratios of 1/8, 1/2 (x3), 1, 2,
+    # 4 (x3) and 16, the tied ones from equal counts, rank 1, 3 (x3), 5, 6,
+    # 8 (x3) and 10 when ties share their average rank. So only the ratios
+    # of 1 and 2 lie within ranks 4 to 7 and are kept
+    counts = _counts('ties')
+    ref, obs = counts[:, 0], counts[:, 1]
+    n_ref, n_obs = ref.sum(), obs.sum()
+    kept = [4, 5]
+    log_r = np.log2((obs[kept] / n_obs) / (ref[kept] / n_ref))
+    v = (n_obs - obs[kept]) / n_obs / obs[kept] + \
+        (n_ref - ref[kept]) / n_ref / ref[kept]
+    f = 2 ** (np.sum(log_r / v) / np.sum(1 / v))
+
+    np.testing.assert_allclose(TmmNormalizer(counts).norm_factors,
+                               [f ** -0.5, f ** 0.5], rtol=1e-14)
+
+
+def test_all_zero_rows_ignored():
+    with_zeros = TmmNormalizer(_counts('zero_rows'))
+    without = TmmNormalizer(_counts('nb'))
+    np.testing.assert_array_equal(with_zeros.norm_factors,
+                                  without.norm_factors)
+    np.testing.assert_array_equal(with_zeros.lib_size, without.lib_size)
+
+
+def test_single_sample():
+    tmm = TmmNormalizer(_counts('single'))
+    assert tmm.norm_factors.tolist() == [1.0]
+
+    # With a factor of one, the prior count is the plain prior count
+    counts = _counts('single')[:, 0]
+    lib_size = counts.sum()
+    np.testing.assert_allclose(tmm.cpm(log=True)[:, 0],
+                               np.log2((counts + 2) / (lib_size + 4) * 1e6))
+
+
+def test_proportional_samples():
+    counts = _counts('nb')[:, :1] * np.array([1, 2, 5])
+    np.testing.assert_array_equal(TmmNormalizer(counts).norm_factors,
+                                  [1.0, 1.0, 1.0])
+
+
+@pytest.mark.parametrize('case', CASES)
+def test_sparse_same_as_dense(case):
+    counts = _counts(case)
+    dense = TmmNormalizer(counts)
+    tmm = TmmNormalizer(sparse.csr_matrix(counts))
+    np.testing.assert_array_equal(tmm.norm_factors, dense.norm_factors)
+    np.testing.assert_array_equal(tmm.cpm(log=True), dense.cpm(log=True))
+    np.testing.assert_allclose(tmm.cpm().toarray(), dense.cpm(), rtol=1e-15)
+
+
+@pytest.mark.parametrize('case', CASES)
+@pytest.mark.parametrize('block_size', [1, 3, 1000])
+def test_chunked_same_as_in_memory(case, block_size):
+    counts = _counts(case).astype(np.float64)
+    tmm = TmmNormalizer(counts)
+    chunked = ChunkedTmmNormalizer(lambda block: counts[:, block],
+                                   counts.shape, block_size)
+    np.testing.assert_array_equal(chunked.norm_factors, tmm.norm_factors)
+
+    for log in [False, True]:
+        normalized = np.empty(counts.shape)
+        for block, values in chunked.cpm_blocks(log=log):
+            normalized[:, block] = values
+        np.testing.assert_array_equal(normalized, tmm.cpm(log=log))
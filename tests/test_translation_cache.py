@@ -0,0 +1,114 @@
+import json
+import os
+import pandas as pd
+import pytest
+from allium_prepro import translation_cache
+from allium_prepro.translation_cache import TranslationCache, \
+    translations_path
+
+HGNC_VERSION = '2024-01-01'
+LATEST = {'SARS': 'SARS1', 'C10orf2': 'TWNK'}
+ENSEMBL = {'ENSG01': 'SARS1', 'ENSG02': 'ETV6', 'ENSG03': 'TWNK'}
+
+
+class FakeThesaurus():
+    # Stands in for GeneThesaurus, which downloads HGNC data on first use
+    calls = []
+
+    def __init__(self, data_dir='/tmp'):
+        path = os.path.join(data_dir, f'hgnc_complete_set_{HGNC_VERSION}.json')
+        with open(path, 'w') as f:
+            f.write('{}')
+
+    def update_gene_symbols(self, gene_list):
+        FakeThesaurus.calls.append(list(gene_list))
+        return {g: LATEST[g] for g in gene_list if g in LATEST}
+
+    def translate_genes(self, gene_list, source='symbol', target='ensembl_id'):
+        FakeThesaurus.calls.append(list(gene_list))
+        table = ENSEMBL if source == 'ensembl_id' else \
+            {symbol: id for id, symbol in ENSEMBL.items()}
+        return {g: table[g] for g in gene_list if g in table}
+
+
+@pytest.fixture(autouse=True)
+def thesaurus(monkeypatch):
+    FakeThesaurus.calls = []
+    monkeypatch.setattr(translation_cache, 'GeneThesaurus', FakeThesaurus)
+
+
+def _lookups(gt):
+    genes = ['SARS', 'ETV6', 'C10orf2', 'unknown', float('nan'), 'SARS']
+    return [gt.update_gene_symbols(genes),
+            gt.translate_genes(['ENSG01', 'ENSG03', 'ENSG09'],
+                               source='ensembl_id',
+                               target='symbol'),
+            gt.translate_genes(['SARS1', 'ETV6', 'SARS'])]
+
+
+def test_cached_same_as_uncached(tmp_path):
+    thesaurus = FakeThesaurus(str(tmp_path))
+    uncached = [thesaurus.update_gene_symbols(['SARS', 'ETV6', 'C10orf2',
+                                               'unknown']),
+                thesaurus.translate_genes(['ENSG01', 'ENSG03', 'ENSG09'],
+                                          source='ensembl_id',
+                                          target='symbol'),
+                thesaurus.translate_genes(['SARS1', 'ETV6', 'SARS'])]
+    FakeThesaurus.calls = []
+
+    first = _lookups(TranslationCache(data_dir=str(tmp_path)))
+    assert len(FakeThesaurus.calls) == 3
+
+    # A new cache on the same directory answers from disk alone
+    second = _lookups(TranslationCache(data_dir=str(tmp_path)))
+    assert len(FakeThesaurus.calls) == 3
+    assert first == uncached
+    assert second == uncached
+
+
+def test_precomputed_reference(tmp_path):
+    annot_file = tmp_path / 'ref.allium.annotations.filtered.csv'
+    pd.DataFrame({'id': list(ENSEMBL) + ['ENSG09'],
+                  'name': ['SARS', 'ETV6', 'C10orf2', None]}) \
+        .to_csv(annot_file, index=False)
+
+    builder_dir = tmp_path / 'builder'
+    builder_dir.mkdir()
+    path = TranslationCache(data_dir=str(builder_dir)).precompute(
+        str(annot_file))
+    assert path == translations_path(str(annot_file))
+    with open(path, 'r') as f:
+        assert json.load(f)['hgnc_version'] == HGNC_VERSION
+
+    # Another cache on the same HGNC data needs no thesaurus for them
+    data_dir = tmp_path / 'data'
+    data_dir.mkdir()
+    (data_dir / f'hgnc_complete_set_{HGNC_VERSION}.json').write_text('{}')
+    FakeThesaurus.calls = []
+    gt = TranslationCache(data_dir=str(data_dir), precomputed=path)
+    assert gt.update_gene_symbols(['SARS', 'ETV6', 'C10orf2']) == \
+        {'SARS': 'SARS1', 'C10orf2': 'TWNK'}
+    assert gt.translate_genes(list(ENSEMBL) + ['ENSG09'],
+                              source='ensembl_id', target='symbol') == ENSEMBL
+    assert FakeThesaurus.calls == []
+
+    # Genes outside the reference are still looked up
+    assert gt.update_gene_symbols(['unknown']) == {}
+    assert FakeThesaurus.calls == [['unknown']]
+
+
+def test_precomputed_other_hgnc_version(tmp_path):
+    annot_file = tmp_path / 'ref.allium.annotations.filtered.csv'
+    pd.DataFrame({'id': ['ENSG01'], 'name': ['SARS']}) \
+        .to_csv(annot_file, index=False)
+    path = TranslationCache(data_dir=str(tmp_path)).precompute(
+        str(annot_file))
+
+    # Lookups against other HGNC data are not used
+    data_dir = tmp_path / 'data'
+    data_dir.mkdir()
+    (data_dir / 'hgnc_complete_set_2025-01-01.json').write_text('{}')
+    FakeThesaurus.calls = []
+    gt = TranslationCache(data_dir=str(data_dir), precomputed=path)
+    gt.update_gene_symbols(['SARS'])
+    assert FakeThesaurus.calls == [['SARS']]